@@ -0,0 +1,55 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from operations_config import get_secret
+
+# Least recently used artifacts are dropped once their total size passes this
+ARTIFACT_STORE_MAX_BYTES = int(get_secret('ARTIFACT_STORE_MAX_BYTES', 100 * 1024 * 1024))
+# Handles in older messages stop resolving after this long, the tool can be called again
+ARTIFACT_TTL_SECONDS = int(get_secret('ARTIFACT_TTL_SECONDS', 60 * 60))
+
+
+# Binary tool outputs (e.g. images) kept out of the message state. Tools put the bytes here and return only the
+# handle, the UI resolves handles for display, so prompts and checkpoints never carry the bytes
+class ArtifactStore:
+    def __init__(self, max_bytes=ARTIFACT_STORE_MAX_BYTES, ttl_seconds=ARTIFACT_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # artifact id -> (stored_at, data), oldest first
+        self._artifacts = OrderedDict()
+        self._size = 0
+
+    # Returns a handle for the data, the same content always gets the same id
+    def put(self, data, name, kind):
+        artifact_id = hashlib.sha256(data).hexdigest()[:32]
+        with self._lock:
+            self._size -= len(self._artifacts.pop(artifact_id, (0, b''))[1])
+            self._artifacts[artifact_id] = (time.monotonic(), data)
+            self._size += len(data)
+            while self._size > self.max_bytes and len(self._artifacts) > 1:
+                _, (_, evicted) = self._artifacts.popitem(last=False)
+                self._size -= len(evicted)
+        return {"artifact_id": artifact_id, "name": name, "kind": kind}
+
+    def get(self, artifact_id):
+        with self._lock:
+            entry = self._artifacts.get(artifact_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= self.ttl_seconds:
+                del self._artifacts[artifact_id]
+                self._size -= len(entry[1])
+                return None
+            self._artifacts.move_to_end(artifact_id)
+            return entry[1]
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {"artifacts": len(self._artifacts), "bytes": self._size}
+
+
+artifact_store = ArtifactStore()
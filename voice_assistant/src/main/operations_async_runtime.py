@@ -0,0 +1,56 @@
+import asyncio
+import threading
+
+from neo4j import AsyncGraphDatabase, READ_ACCESS, RoutingControl
+
+from operations_config import get_secret
+
+NEO4J_URI = get_secret('NEO4J_URI')
+NEO4J_USER = get_secret('NEO4J_USER')
+NEO4J_PASSWORD = get_secret('NEO4J_PASSWORD')
+
+_loop = None
+_driver = None
+_lock = threading.Lock()
+
+
+# One event loop per process running on a daemon thread. Streamlit reruns and the graph stream are synchronous,
+# async work (tools, async Neo4j driver) is submitted to this loop so clients bound to it are reused across calls
+def get_loop():
+    global _loop
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='async-runtime', daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+# Runs the coroutine on the background loop and waits for its result from the calling thread
+def run_async(coroutine, timeout=None):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result(timeout=timeout)
+
+
+# The async driver keeps a connection pool bound to the background loop, only use it from coroutines on that loop
+def get_async_driver():
+    global _driver
+    if _driver is None:
+        with _lock:
+            if _driver is None:
+                _driver = AsyncGraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+    return _driver
+
+
+# Read query returning records as dicts, the same shape as Neo4jGraph.query
+async def aquery(cypher, params=None):
+    records, _, _ = await get_async_driver().execute_query(cypher, params or {}, routing_=RoutingControl.READ)
+    return [record.data() for record in records]
+
+
+# Yields records as dicts while they arrive, stopping early (aclosing the generator) leaves the rest unread
+async def astream(cypher, params=None):
+    async with get_async_driver().session(default_access_mode=READ_ACCESS) as session:
+        result = await session.run(cypher, params or {})
+        async for record in result:
+            yield record.data()
@@ -0,0 +1,209 @@
+# Headless bulk ingestion, runs the same pipeline as the Streamlit uploader for a given username.
+# Example:
+#   python operations_batch_ingest.py --username alice --dir /data/archive --checkpoint alice_ingest.jsonl
+#   python operations_batch_ingest.py --username alice --manifest files.txt --parse-workers 8 --ingest-workers 16
+# Configuration is read from environment variables or .streamlit/secrets.toml (see operations_config.get_secret).
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from langchain_neo4j import Neo4jGraph
+
+from operations_file_chunk_node import parse_file, ingest_parsed_file, process_file
+from operations_text_files import TEXT_FILE_EXTENSIONS
+
+PARSED_FILE_EXTENSIONS = ('.pdf', '.doc', '.docx', '.xlsx')
+SUPPORTED_FILE_EXTENSIONS = PARSED_FILE_EXTENSIONS + TEXT_FILE_EXTENSIONS + ('.png', '.jpeg')
+
+
+def collect_files(directory=None, manifest=None):
+    files = []
+    if directory is not None:
+        for root, _, names in os.walk(directory):
+            for name in sorted(names):
+                if name.lower().endswith(SUPPORTED_FILE_EXTENSIONS):
+                    files.append(os.path.abspath(os.path.join(root, name)))
+    if manifest is not None:
+        # One path per line, blank lines and lines starting with # are ignored
+        with open(manifest, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line != '' and not line.startswith('#'):
+                    files.append(os.path.abspath(line))
+    return list(dict.fromkeys(files))
+
+
+# File nodes are keyed by file name, so of several files sharing a name only the first is ingested. Returns
+# {path: path of the earlier file with the same name} for the others
+def duplicate_names(files):
+    first_by_name = {}
+    duplicates = {}
+    for file in files:
+        name = os.path.basename(file)
+        if name in first_by_name:
+            duplicates[file] = first_by_name[name]
+        else:
+            first_by_name[name] = file
+    return duplicates
+
+
+def file_signature(file):
+    stat = os.stat(file)
+    return f"{file}|{stat.st_size}|{int(stat.st_mtime)}"
+
+
+# Checkpoint is an append-only JSON lines file, a file is skipped on resume if it was ingested with the same
+# size and modification time
+def load_checkpoint(checkpoint_path):
+    completed = set()
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return completed
+    with open(checkpoint_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Partially written last line after a crash
+                continue
+            if record.get('status') == 'done':
+                completed.add(record['signature'])
+    return completed
+
+
+class IngestionStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.done, self.failed, self.skipped = 0, 0, 0
+        self.bytes_done = 0
+        self.parse_seconds, self.ingest_seconds = 0.0, 0.0
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            "files_done": self.done,
+            "files_failed": self.failed,
+            "files_skipped": self.skipped,
+            "megabytes_done": round(self.bytes_done / (1024 * 1024), 2),
+            "elapsed_seconds": round(elapsed, 2),
+            "files_per_second": round(self.done / elapsed, 3) if elapsed > 0 else 0,
+            "megabytes_per_second": round(self.bytes_done / (1024 * 1024) / elapsed, 3) if elapsed > 0 else 0,
+            "parse_seconds_total": round(self.parse_seconds, 2),
+            "ingest_seconds_total": round(self.ingest_seconds, 2),
+        }
+
+
+async def ingest_worker(queue, username, process_pool, checkpoint_file, stats, total):
+    loop = asyncio.get_running_loop()
+    while True:
+        file = await queue.get()
+        if file is None:
+            queue.task_done()
+            return
+        record = {"file": file, "signature": None}
+        size = 0
+        # A file removed or unreadable since it was queued is recorded as failed, the worker keeps going
+        try:
+            record['signature'] = file_signature(file)
+            size = os.path.getsize(file)
+            if file.lower().endswith(PARSED_FILE_EXTENSIONS):
+                # CPU bound parsing runs in a worker process, the network bound part on a thread
+                parse_start = time.perf_counter()
+                parsed_file = await loop.run_in_executor(process_pool, parse_file, file, username)
+                stats.parse_seconds += time.perf_counter() - parse_start
+
+                ingest_start = time.perf_counter()
+                summary_dict = await asyncio.to_thread(ingest_parsed_file, file, username, parsed_file)
+            else:
+                ingest_start = time.perf_counter()
+                summary_dict = await asyncio.to_thread(process_file, file, username)
+            stats.ingest_seconds += time.perf_counter() - ingest_start
+
+            record['status'] = 'done' if summary_dict is not None else 'failed'
+        except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = str(e)
+
+        if record['status'] == 'done':
+            stats.done += 1
+            stats.bytes_done += size
+        else:
+            stats.failed += 1
+        if checkpoint_file is not None:
+            checkpoint_file.write(json.dumps(record) + '\n')
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        print(f"[{stats.done + stats.failed}/{total}] {record['status']}: {file}", flush=True)
+        queue.task_done()
+
+
+async def run_ingestion(files, username, checkpoint_path=None, parse_workers=None, ingest_workers=8):
+    stats = IngestionStats()
+    completed = load_checkpoint(checkpoint_path)
+    pending = []
+    duplicates = duplicate_names(files)
+    for file in files:
+        if file in duplicates:
+            stats.failed += 1
+            print(f"duplicate name: {file} has the same file name as {duplicates[file]}, rename it to ingest it",
+                  flush=True)
+        elif not os.path.isfile(file):
+            stats.failed += 1
+            print(f"missing: {file}", flush=True)
+        elif file_signature(file) in completed:
+            stats.skipped += 1
+        else:
+            pending.append(file)
+
+    # Bounded queue keeps parsed documents in memory only for files that are about to be ingested
+    queue = asyncio.Queue(maxsize=ingest_workers * 2)
+    checkpoint_file = open(checkpoint_path, 'a', encoding='utf-8') if checkpoint_path is not None else None
+    try:
+        with ProcessPoolExecutor(max_workers=parse_workers) as process_pool:
+            workers = [asyncio.create_task(
+                ingest_worker(queue, username, process_pool, checkpoint_file, stats, len(pending)))
+                for _ in range(ingest_workers)]
+            for file in pending:
+                await queue.put(file)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+    finally:
+        if checkpoint_file is not None:
+            checkpoint_file.close()
+
+    return stats.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk ingest documents for a user without the Streamlit UI')
+    parser.add_argument('--username', required=True, help='Existing username the files are uploaded for')
+    parser.add_argument('--dir', help='Directory walked recursively for supported files')
+    parser.add_argument('--manifest', help='Text file with one file path per line')
+    parser.add_argument('--checkpoint', help='JSON lines checkpoint file, re-running with it resumes the job')
+    parser.add_argument('--parse-workers', type=int, default=None, help='Processes used for parsing files')
+    parser.add_argument('--ingest-workers', type=int, default=8, help='Concurrent LLM/embedding/Neo4j workers')
+    args = parser.parse_args()
+
+    if args.dir is None and args.manifest is None:
+        parser.error('one of --dir or --manifest is required')
+
+    user_response = Neo4jGraph().query('''MATCH (u:User{username: $username}) RETURN COUNT(u) AS COUNT''',
+                                       params={'username': args.username})
+    if user_response[0]['COUNT'] == 0:
+        print(f"User {args.username} does not exist", file=sys.stderr)
+        sys.exit(1)
+
+    files = collect_files(args.dir, args.manifest)
+    summary = asyncio.run(run_ingestion(files, args.username, args.checkpoint, args.parse_workers,
+                                        args.ingest_workers))
+    print(json.dumps(summary, indent=2))
+    if summary['files_failed'] > 0:
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+import asyncio
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.memory import MemorySaver
+
+from operations_config import get_secret
+
+# memory | sqlite | postgres
+CHECKPOINT_BACKEND = get_secret('CHECKPOINT_BACKEND', 'sqlite')
+CHECKPOINT_SQLITE_PATH = get_secret('CHECKPOINT_SQLITE_PATH', 'checkpoints.sqlite')
+# Shared server for several app replicas, a local postgres container works as stand-in during development
+CHECKPOINT_POSTGRES_URI = get_secret('CHECKPOINT_POSTGRES_URI', None)
+# Threads idle for longer than this are deleted from the backend
+CHECKPOINT_TTL_SECONDS = int(get_secret('CHECKPOINT_TTL_SECONDS', 7 * 24 * 60 * 60))
+# In-memory backend keeps about this many threads. Past it, least recently used threads idle for longer than the TTL
+# are evicted right away instead of at the next prune, active conversations are never evicted so the limit is soft
+CHECKPOINT_MAX_RESIDENT_THREADS = int(get_secret('CHECKPOINT_MAX_RESIDENT_THREADS', 500))
+PRUNE_INTERVAL_SECONDS = 15 * 60
+# SQLite waits this long for a lock held by the other connection (saver or activity table) before failing
+SQLITE_BUSY_TIMEOUT_SECONDS = 30
+# Activity of a thread is written at most this often
+ACTIVITY_WRITE_INTERVAL_SECONDS = 60
+
+
+# Last activity per thread, stored next to the checkpoints so every replica prunes with the same view
+class _ActivityStore:
+    def __init__(self, connection, placeholder):
+        self._connection = connection
+        self._placeholder = placeholder
+        self._lock = threading.Lock()
+        self._execute("CREATE TABLE IF NOT EXISTS thread_activity (thread_id TEXT PRIMARY KEY, "
+                      "last_seen DOUBLE PRECISION NOT NULL)")
+
+    def _execute(self, query, params=(), fetch=False):
+        query = query.replace('?', self._placeholder)
+        with self._lock:
+            cursor = self._connection.cursor()
+            try:
+                cursor.execute(query, params)
+                rows = cursor.fetchall() if fetch else None
+            finally:
+                cursor.close()
+            self._connection.commit()
+        return rows
+
+    def touch(self, thread_id, last_seen):
+        self._execute("INSERT INTO thread_activity (thread_id, last_seen) VALUES (?, ?) "
+                      "ON CONFLICT (thread_id) DO UPDATE SET last_seen = excluded.last_seen", (thread_id, last_seen))
+
+    def expired(self, before):
+        return [row[0] for row in self._execute("SELECT thread_id FROM thread_activity WHERE last_seen < ?",
+                                                (before,), fetch=True)]
+
+    def remove(self, thread_id):
+        self._execute("DELETE FROM thread_activity WHERE thread_id = ?", (thread_id,))
+
+
+# Wraps any LangGraph checkpointer with activity tracking, eviction of idle resident threads (in-memory
+# backend only, durable backends do not hold threads in RAM) and TTL based pruning
+class ManagedCheckpointer(BaseCheckpointSaver):
+    def __init__(self, backend, activity_store, ttl_seconds=CHECKPOINT_TTL_SECONDS,
+                 max_resident_threads=None):
+        super().__init__(serde=backend.serde)
+        self.backend = backend
+        self.activity_store = activity_store
+        self.ttl_seconds = ttl_seconds
+        self.max_resident_threads = max_resident_threads
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+
+    @property
+    def config_specs(self):
+        return self.backend.config_specs
+
+    def _touch(self, config):
+        thread_id = config.get('configurable', {}).get('thread_id')
+        if thread_id is None:
+            return
+        now = time.time()
+        evicted = []
+        with self._lock:
+            last_written = self._recent.pop(thread_id, 0.0)
+            self._recent[thread_id] = last_written
+            write_activity = now - last_written > ACTIVITY_WRITE_INTERVAL_SECONDS
+            if write_activity:
+                self._recent[thread_id] = now
+            limit = self.max_resident_threads if self.max_resident_threads is not None else 10000
+            # Oldest first, stops at the first thread still within the TTL
+            for recent_thread_id, last_seen in self._recent.items():
+                if len(self._recent) - len(evicted) <= limit or now - last_seen <= self.ttl_seconds:
+                    break
+                evicted.append(recent_thread_id)
+            for evicted_thread_id in evicted:
+                del self._recent[evicted_thread_id]
+            prune_due = now - self._last_prune > PRUNE_INTERVAL_SECONDS
+            if prune_due:
+                self._last_prune = now
+
+        if write_activity:
+            self.activity_store.touch(thread_id, now)
+        if self.max_resident_threads is not None:
+            for evicted_thread_id in evicted:
+                self.delete_thread(evicted_thread_id)
+        if prune_due:
+            threading.Thread(target=self.prune_expired, name='checkpoint-prune', daemon=True).start()
+
+    def prune_expired(self):
+        pruned = 0
+        for thread_id in self.activity_store.expired(time.time() - self.ttl_seconds):
+            self.delete_thread(thread_id)
+            pruned += 1
+        if pruned > 0:
+            print(f"[Checkpointer] pruned {pruned} idle threads")
+        return pruned
+
+    def get_tuple(self, config):
+        self._touch(config)
+        return self.backend.get_tuple(config)
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        return self.backend.list(config, filter=filter, before=before, limit=limit)
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        self._touch(config)
+        return self.backend.put(config, checkpoint, metadata, new_versions)
+
+    def put_writes(self, config, writes, task_id, task_path=''):
+        return self.backend.put_writes(config, writes, task_id, task_path)
+
+    def delete_thread(self, thread_id):
+        self.backend.delete_thread(thread_id)
+        self.activity_store.remove(thread_id)
+        with self._lock:
+            self._recent.pop(thread_id, None)
+
+    def get_next_version(self, current, channel):
+        return self.backend.get_next_version(current, channel)
+
+    # Sync backends (sqlite, postgres) are run on a worker thread for async graph execution
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        for item in await asyncio.to_thread(
+                lambda: list(self.list(config, filter=filter, before=before, limit=limit))):
+            yield item
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=''):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id):
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+
+# WAL lets the saver and the activity table read while the other connection writes, the timeout waits out writes
+def _sqlite_connect(path):
+    import sqlite3
+    connection = sqlite3.connect(path, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT_SECONDS)
+    connection.execute('PRAGMA journal_mode=WAL')
+    return connection
+
+
+def create_checkpointer(backend=CHECKPOINT_BACKEND):
+    if backend == 'memory':
+        import sqlite3
+        activity_store = _ActivityStore(sqlite3.connect(':memory:', check_same_thread=False), '?')
+        return ManagedCheckpointer(MemorySaver(), activity_store,
+                                   max_resident_threads=CHECKPOINT_MAX_RESIDENT_THREADS)
+    elif backend == 'sqlite':
+        try:
+            from langgraph.checkpoint.sqlite import SqliteSaver
+        except ImportError:
+            raise Exception('sqlite checkpointer needs the langgraph-checkpoint-sqlite package')
+        saver = SqliteSaver(_sqlite_connect(CHECKPOINT_SQLITE_PATH))
+        activity_store = _ActivityStore(_sqlite_connect(CHECKPOINT_SQLITE_PATH), '?')
+        return ManagedCheckpointer(saver, activity_store)
+    elif backend == 'postgres':
+        if CHECKPOINT_POSTGRES_URI is None:
+            raise Exception('CHECKPOINT_POSTGRES_URI must be set for the postgres checkpointer')
+        try:
+            from langgraph.checkpoint.postgres import PostgresSaver
+            from psycopg import Connection
+            from psycopg.rows import dict_row
+        except ImportError:
+            raise Exception('postgres checkpointer needs the langgraph-checkpoint-postgres package')
+        saver = PostgresSaver(Connection.connect(CHECKPOINT_POSTGRES_URI, autocommit=True, prepare_threshold=0,
+                                                 row_factory=dict_row))
+        saver.setup()
+        activity_store = _ActivityStore(Connection.connect(CHECKPOINT_POSTGRES_URI, autocommit=True), '%s')
+        return ManagedCheckpointer(saver, activity_store)
+    raise Exception(f'Unknown checkpointer backend {backend}')
+
+
+_checkpointer = None
+_checkpointer_lock = threading.Lock()
+
+
+def get_checkpointer():
+    global _checkpointer
+    with _checkpointer_lock:
+        if _checkpointer is None:
+            _checkpointer = create_checkpointer()
+        return _checkpointer
+
+
+# One thread per conversation session, shared by every replica the user's requests land on
+def new_thread_id(username):
+    return f"{username}:{uuid.uuid4().hex}"
@@ -0,0 +1,143 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, SystemMessage, ToolMessage
+from langchain_openai import AzureChatOpenAI
+
+from operations_config import get_secret
+from operations_context_budget import context_budget, truncate_text_tokens, count_text_tokens
+
+AZURE_OPENAI_MODEL = get_secret('AZURE_OPENAI_MODEL')
+AZURE_OPENAI_ENDPOINT = get_secret('AZURE_OPENAI_ENDPOINT')
+AZURE_OPENAI_KEY = get_secret('AZURE_OPENAI_KEY')
+AZURE_OPENAI_VERSION = get_secret('AZURE_OPENAI_VERSION')
+
+# History above this many tokens is compacted after the turn finishes
+COMPACTION_TRIGGER_TOKENS = int(get_secret('COMPACTION_TRIGGER_TOKENS', 12000))
+# Most recent turns always stay verbatim
+KEEP_RECENT_TURNS = int(get_secret('COMPACTION_KEEP_RECENT_TURNS', 4))
+# Each folded tool output contributes at most this many tokens to the summarisation prompt
+TOOL_OUTPUT_SUMMARY_TOKENS = 1500
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='compaction')
+_pending = {}
+_pending_lock = threading.Lock()
+_thread_locks = {}
+
+
+# Held by a turn while it streams and by compaction while it writes, so the two never both extend the same
+# checkpoint of a thread
+def thread_lock(thread_id):
+    with _pending_lock:
+        return _thread_locks.setdefault(thread_id, threading.Lock())
+
+
+@lru_cache(maxsize=1)
+def _summary_model():
+    return AzureChatOpenAI(
+        model=AZURE_OPENAI_MODEL,
+        azure_endpoint=AZURE_OPENAI_ENDPOINT,
+        api_key=AZURE_OPENAI_KEY,
+        api_version=AZURE_OPENAI_VERSION,
+    )
+
+
+def summary_message(summary):
+    return SystemMessage(content=f"Summary of the earlier part of this conversation: {summary}")
+
+
+def _render_message(message):
+    if isinstance(message, HumanMessage):
+        return f"User: {message.content}"
+    if isinstance(message, ToolMessage):
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        if count_text_tokens(content) > TOOL_OUTPUT_SUMMARY_TOKENS:
+            content = truncate_text_tokens(content, TOOL_OUTPUT_SUMMARY_TOKENS)
+        return f"Tool {message.name} returned: {content}"
+    if isinstance(message, AIMessage):
+        if message.tool_calls:
+            return 'Assistant called tools: ' + ', '.join(
+                f"{call['name']}({call.get('args', {})})" for call in message.tool_calls)
+        return f"Assistant: {message.content}"
+    return f"{message.type}: {message.content}"
+
+
+def messages_to_compact(messages):
+    human_positions = [i for i, message in enumerate(messages) if isinstance(message, HumanMessage)]
+    if len(human_positions) <= KEEP_RECENT_TURNS:
+        return []
+    if context_budget.count(messages) <= COMPACTION_TRIGGER_TOKENS:
+        return []
+    # Everything before the oldest verbatim turn is folded into the summary
+    return messages[:human_positions[-KEEP_RECENT_TURNS]]
+
+
+def summarise(previous_summary, messages):
+    prompt = ("You maintain a running summary of a conversation between a user and a document assistant. "
+              "Update the summary with the new part of the conversation below. Keep file names, dates, figures, "
+              "decisions and open questions; drop greetings and repetition. Respond with the summary only, at most "
+              "250 words.\n")
+    if previous_summary:
+        prompt += f"Current summary:\n{previous_summary}\n"
+    prompt += "New part of the conversation:\n" + '\n'.join(_render_message(message) for message in messages)
+    return _summary_model().invoke([SystemMessage(prompt)]).content
+
+
+def compact_thread(react_graph, config):
+    snapshot = react_graph.get_state(config)
+    messages = snapshot.values.get('messages', [])
+    old_messages = messages_to_compact(messages)
+    if len(old_messages) == 0:
+        return False
+
+    summary = summarise(snapshot.values.get('summary', ''), old_messages)
+    with thread_lock(config['configurable']['thread_id']):
+        # A turn may have run during summarisation, it only appends, so the summary still holds as long as the
+        # folded messages are still there
+        current = react_graph.get_state(config).values
+        current_ids = set(message.id for message in current.get('messages', []))
+        if current.get('summary', '') != snapshot.values.get('summary', '') \
+                or any(message.id not in current_ids for message in old_messages):
+            print("[Compaction] skipped, the thread changed during summarisation")
+            return False
+        # Stored with the thread by the checkpointer, the assistant sends it in place of the removed turns
+        react_graph.update_state(config, {
+            "messages": [RemoveMessage(id=message.id) for message in old_messages],
+            "summary": summary
+        }, as_node='assistant')
+    print(f"[Compaction] folded {len(old_messages)} messages into summary")
+    return True
+
+
+# Runs compaction off the interactive path once a turn has been answered
+def schedule_compaction(react_graph, config):
+    thread_id = config['configurable']['thread_id']
+    with _pending_lock:
+        future = _pending.get(thread_id)
+        if future is not None and not future.done():
+            return future
+        future = _executor.submit(compact_thread, react_graph, config)
+        _pending[thread_id] = future
+    future.add_done_callback(lambda f: _discard(thread_id, f))
+    return future
+
+
+def _discard(thread_id, future):
+    if future.exception() is not None:
+        print(f"[Compaction Failed] {future.exception()}")
+    with _pending_lock:
+        if _pending.get(thread_id) is future:
+            del _pending[thread_id]
+
+
+# A new turn starts from the compacted history when the compaction finishes in time, otherwise it is applied after
+# the turn (see thread_lock)
+def wait_for_compaction(thread_id, timeout=30):
+    with _pending_lock:
+        future = _pending.get(thread_id)
+    if future is not None:
+        try:
+            future.result(timeout=timeout)
+        except Exception:
+            pass
@@ -0,0 +1,18 @@
+import os
+
+import streamlit as st
+
+_MISSING = object()
+
+
+# Environment variables take precedence over .streamlit/secrets.toml so modules can be imported by
+# headless jobs (batch ingestion, background workers) without a running Streamlit app
+def get_secret(key, default=_MISSING):
+    if key in os.environ:
+        return os.environ[key]
+    try:
+        return st.secrets[key]
+    except (KeyError, FileNotFoundError):
+        if default is _MISSING:
+            raise KeyError(f'Missing configuration value {key}, set it in secrets.toml or as environment variable')
+        return default
@@ -0,0 +1,213 @@
+import json
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from langchain_core.messages import HumanMessage, ToolMessage
+
+from operations_config import get_secret
+
+# Token budget for the messages sent with each model call, the system prompt is counted against it as well
+PROMPT_TOKEN_BUDGET = int(get_secret('PROMPT_TOKEN_BUDGET', 24000))
+# Single tool output is cut to this many tokens before it is considered for the prompt
+TOOL_MESSAGE_TOKEN_LIMIT = int(get_secret('TOOL_MESSAGE_TOKEN_LIMIT', 8000))
+TOKEN_CACHE_SIZE = 20000
+# Chat API adds a few tokens of framing per message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+TRUNCATION_NOTE = '...message is too long, truncating rest'
+EVICTED_TOOL_OUTPUT = '[Older tool output removed to save context, call the tool again if it is needed]'
+
+# Tools whose responses carry UI only data under 'metadata'
+METADATA_TOOL_NAMES = ('file-filter-search',)
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    # tiktoken loads encodings from its local cache, fall back to a character estimate when it is unavailable
+    try:
+        import tiktoken
+        return tiktoken.get_encoding('o200k_base')
+    except Exception as e:
+        print(f"[Tokenizer unavailable, estimating tokens] {e}")
+        return None
+
+
+def count_text_tokens(text):
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_text_tokens(text, limit):
+    encoding = _encoding()
+    if encoding is None:
+        return text[:limit * 4] + TRUNCATION_NOTE
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:limit]) + TRUNCATION_NOTE
+
+
+def _content_text(message):
+    if isinstance(message.content, str):
+        return message.content
+    return json.dumps(message.content)
+
+
+def _message_key(message):
+    if message.id is not None:
+        return message.id
+    return str(hash((message.type, _content_text(message))))
+
+
+class _LRUDict(OrderedDict):
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def get_item(self, key):
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        return None
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        if len(self) > self.max_size:
+            self.popitem(last=False)
+
+
+class ContextBudget:
+    def __init__(self, budget=PROMPT_TOKEN_BUDGET, tool_message_limit=TOOL_MESSAGE_TOKEN_LIMIT):
+        self.budget = budget
+        self.tool_message_limit = tool_message_limit
+        # message key -> (prepared message, token count), shared by all threads since message ids are unique
+        self._prepared = _LRUDict(TOKEN_CACHE_SIZE)
+        # thread id -> prepared messages, token counts, human message positions and running total so far
+        self._running = _LRUDict(1000)
+        self._metrics = _LRUDict(1000)
+        self._lock = threading.Lock()
+
+    # Strips UI only data and caps oversized tool outputs once per message instead of on every turn
+    def _prepare(self, message):
+        key = _message_key(message)
+        with self._lock:
+            cached = self._prepared.get_item(key)
+        if cached is not None:
+            return cached
+
+        prepared = message
+        if isinstance(message, ToolMessage) and isinstance(message.content, str):
+            content = message.content
+            if message.name in METADATA_TOOL_NAMES:
+                try:
+                    tool_response = json.loads(content)
+                    if isinstance(tool_response, dict) and 'metadata' in tool_response:
+                        del tool_response['metadata']
+                        content = json.dumps(tool_response).replace('\\\\', '\\')
+                except json.JSONDecodeError:
+                    pass
+            if count_text_tokens(content) > self.tool_message_limit:
+                content = truncate_text_tokens(content, self.tool_message_limit)
+            if content != message.content:
+                prepared = message.model_copy(update={'content': content})
+
+        tokens = count_text_tokens(_content_text(prepared)) + MESSAGE_OVERHEAD_TOKENS
+        tool_calls = getattr(prepared, 'tool_calls', None)
+        if tool_calls:
+            tokens += count_text_tokens(json.dumps([call.get('args', {}) for call in tool_calls], default=str))
+        with self._lock:
+            self._prepared.put(key, (prepared, tokens))
+        return prepared, tokens
+
+    # Prepared messages of a thread are kept between calls, only messages appended since the previous call are
+    # prepared and counted. History that changed otherwise (e.g. messages removed by compaction) starts over from the
+    # per message cache. Returns lists owned by the thread, callers copy them before changing anything
+    def _prepare_thread(self, thread_id, messages):
+        with self._lock:
+            previous = self._running.get_item(thread_id) if thread_id is not None else None
+        if previous is not None and 0 < len(previous['keys']) <= len(messages) \
+                and _message_key(messages[0]) == previous['keys'][0] \
+                and _message_key(messages[len(previous['keys']) - 1]) == previous['keys'][-1]:
+            state = previous
+        else:
+            state = {"keys": [], "selected": [], "counts": [], "human_positions": [], "total": 0}
+        for i in range(len(state['keys']), len(messages)):
+            prepared, tokens = self._prepare(messages[i])
+            state['keys'].append(_message_key(messages[i]))
+            state['selected'].append(prepared)
+            state['counts'].append(tokens)
+            if isinstance(prepared, HumanMessage):
+                state['human_positions'].append(i)
+            state['total'] += tokens
+        if thread_id is not None:
+            with self._lock:
+                self._running.put(thread_id, state)
+        return state
+
+    def count(self, messages):
+        return sum(self._prepare(message)[1] for message in messages)
+
+    def fit(self, messages, system_tokens=0, thread_id=None):
+        state = self._prepare_thread(thread_id, messages)
+        selected, counts, human_positions = list(state['selected']), list(state['counts']), state['human_positions']
+        total = state['total'] + system_tokens
+        metrics = {"history_tokens": total, "tool_outputs_evicted": 0, "turns_dropped": 0, "truncated": 0}
+
+        # Current turn starts at the latest human message and is never evicted
+        current_turn_start = human_positions[-1] if len(human_positions) > 0 else 0
+
+        # 1. Old tool outputs, oldest first
+        evicted_tokens = count_text_tokens(EVICTED_TOOL_OUTPUT) + MESSAGE_OVERHEAD_TOKENS
+        for i in range(current_turn_start):
+            if total <= self.budget:
+                break
+            if isinstance(selected[i], ToolMessage) and counts[i] > evicted_tokens:
+                selected[i] = selected[i].model_copy(update={'content': EVICTED_TOOL_OUTPUT})
+                total -= counts[i] - evicted_tokens
+                counts[i] = evicted_tokens
+                metrics['tool_outputs_evicted'] += 1
+
+        # 2. Old turns, oldest first, a turn is dropped whole so tool calls keep their responses
+        start = 0
+        for turn_end in human_positions[1:]:
+            if total <= self.budget:
+                break
+            total -= sum(counts[start:turn_end])
+            start = turn_end
+            metrics['turns_dropped'] += 1
+        selected, counts = selected[start:], counts[start:]
+
+        # 3. Current turn alone is too large, shrink its largest tool outputs
+        while total > self.budget:
+            tool_positions = [i for i, message in enumerate(selected) if isinstance(message, ToolMessage)]
+            if len(tool_positions) == 0:
+                break
+            largest = max(tool_positions, key=lambda i: counts[i])
+            keep = counts[largest] - (total - self.budget) - MESSAGE_OVERHEAD_TOKENS
+            if keep < 50:
+                keep = 50
+            if keep >= counts[largest]:
+                break
+            content = truncate_text_tokens(_content_text(selected[largest]), keep)
+            selected[largest] = selected[largest].model_copy(update={'content': content})
+            new_count = count_text_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+            if new_count >= counts[largest]:
+                break
+            total -= counts[largest] - new_count
+            counts[largest] = new_count
+            metrics['truncated'] += 1
+
+        metrics['prompt_tokens'] = total
+        metrics['messages_sent'] = len(selected)
+        if thread_id is not None:
+            with self._lock:
+                self._metrics.put(thread_id, metrics)
+        return selected, metrics
+
+    def last_metrics(self, thread_id):
+        with self._lock:
+            return self._metrics.get_item(thread_id)
+
+
+context_budget = ContextBudget()
@@ -0,0 +1,152 @@
+from contextlib import aclosing
+
+from operations_async_runtime import aquery, astream
+from operations_config import get_secret
+from operations_context_budget import count_text_tokens, TOOL_MESSAGE_TOKEN_LIMIT
+from operations_retrieval import embeddings, VECTOR_INDEX_CANDIDATES, VECTOR_SEARCH_OVERSAMPLE
+
+# Tokens of file text a whole-file search returns, kept below the tool message limit so nothing is cut afterwards
+FILE_CONTEXT_TOKEN_BUDGET = min(int(get_secret('FILE_CONTEXT_TOKEN_BUDGET', 6000)), TOOL_MESSAGE_TOKEN_LIMIT - 1000)
+# Streaming stops once less than this is left, the remaining files are represented by their summaries
+MIN_PACK_TOKENS = 100
+# Most similar chunks considered when a file has to be cut down
+RELEVANT_CHUNK_CANDIDATES = 50
+
+# One row per chunk, files in the given order and chunks in file order
+_FILE_CHUNKS_QUERY = """UNWIND range(0, size($files) - 1) AS file_index
+    WITH file_index, $files[file_index] AS ref
+    MATCH (f:File {name: ref.name, username: ref.username})-[r:CHUNKED_INTO]->(c:Chunk)
+    RETURN file_index, r.chunk_no AS chunk_no, c.text AS text
+    ORDER BY file_index, chunk_no"""
+
+_RELEVANT_CHUNKS_QUERY = VECTOR_INDEX_CANDIDATES + """
+    MATCH (f:File {name: $name, username: $username})-[r:CHUNKED_INTO]->(c)
+    WITH r, c, similarity_score
+    ORDER BY similarity_score DESC LIMIT $limit
+    RETURN r.chunk_no AS chunk_no, c.text AS text, similarity_score"""
+
+# Exact scan over the chunks of the file, used while the vector index is missing or being rebuilt
+_RELEVANT_CHUNKS_SCAN_QUERY = """MATCH (f:File {name: $name, username: $username})-[r:CHUNKED_INTO]->(c:Chunk)
+    WITH r, c, vector.similarity.cosine(c.embedding, $embedding) AS similarity_score
+    ORDER BY similarity_score DESC LIMIT $limit
+    RETURN r.chunk_no AS chunk_no, c.text AS text, similarity_score"""
+
+_FIRST_CHUNKS_QUERY = """MATCH (f:File {name: $name, username: $username})-[r:CHUNKED_INTO]->(c:Chunk)
+    RETURN r.chunk_no AS chunk_no, c.text AS text
+    ORDER BY chunk_no LIMIT $limit"""
+
+
+class _PackedFile:
+    def __init__(self, file_details, chunk_count, chunks=None, tokens=0, overflowed=False):
+        self.file_details = file_details
+        self.chunk_count = chunk_count
+        self.chunks = chunks if chunks is not None else []
+        self.tokens = tokens
+        self.overflowed = overflowed
+
+    # Plain data, so the whole-file pass can be kept in the query cache
+    def state(self):
+        return {"file_details": self.file_details, "chunk_count": self.chunk_count, "chunks": self.chunks,
+                "tokens": self.tokens, "overflowed": self.overflowed}
+
+    def result(self):
+        if not self.overflowed:
+            coverage = 'full'
+        elif len(self.chunks) > 0:
+            coverage = 'partial'
+        else:
+            coverage = 'summary_only'
+        return {"file_details": self.file_details, "coverage": coverage,
+                "file_contents": ' '.join(text for _, text in sorted(self.chunks)),
+                "included_chunks": len(self.chunks), "total_chunks": self.chunk_count}
+
+
+# Fills the budget with whole files in the given order, streaming chunks and stopping once the budget is used. Does
+# not depend on the question, the result can be cached and completed per question with fill_packed_files
+async def pack_whole_files(files, budget=FILE_CONTEXT_TOKEN_BUDGET):
+    packed = [_PackedFile(file['file_details'], file['chunk_count']) for file in files]
+    remaining = budget
+    if len(packed) > 0:
+        refs = [{"name": file.file_details['name'], "username": file.file_details['username']} for file in packed]
+        async with aclosing(astream(_FILE_CHUNKS_QUERY, {"files": refs})) as rows:
+            async for row in rows:
+                file = packed[row['file_index']]
+                if file.overflowed:
+                    continue
+                tokens = count_text_tokens(row['text'])
+                if tokens > remaining - file.tokens:
+                    # Only whole files are packed in order, a file cut down is filled by relevance afterwards
+                    file.overflowed = True
+                    file.chunks, file.tokens = [], 0
+                    continue
+                file.chunks.append((row['chunk_no'], row['text']))
+                file.tokens += tokens
+                # Last chunk of the file, its tokens are committed
+                if len(file.chunks) == file.chunk_count:
+                    remaining -= file.tokens
+                    if remaining < MIN_PACK_TOKENS:
+                        break
+        for file in packed:
+            # Files the stream stopped before
+            if not file.overflowed and len(file.chunks) < file.chunk_count:
+                file.overflowed = True
+                file.chunks, file.tokens = [], 0
+    return {"files": [file.state() for file in packed], "token_budget": budget, "remaining": remaining}
+
+
+# Files that did not fit get their most relevant chunks for the question in the budget that is left, files that get
+# no chunks are only represented by their summary. Returns the packed files and a report of what was dropped
+async def fill_packed_files(packing, question=None):
+    # Chunk lists are copied, the whole-file pass stays as it was for the next question
+    packed = [_PackedFile(**{**file, "chunks": list(file['chunks'])}) for file in packing['files']]
+    cut_files = [file for file in packed if file.overflowed]
+    # Only this overflow path depends on the question
+    if len(cut_files) > 0 and packing['remaining'] >= MIN_PACK_TOKENS:
+        await _fill_by_relevance(cut_files, question, packing['remaining'])
+
+    results = [file.result() for file in packed]
+    report = {
+        "token_budget": packing['token_budget'],
+        "tokens_used": sum(file.tokens for file in packed),
+        "dropped": [{"name": result['file_details']['name'], "coverage": result['coverage'],
+                     "dropped_chunks": result['total_chunks'] - result['included_chunks']}
+                    for result in results if result['coverage'] != 'full'],
+    }
+    return results, report
+
+
+async def pack_file_contents(files, question=None, budget=FILE_CONTEXT_TOKEN_BUDGET):
+    return await fill_packed_files(await pack_whole_files(files, budget), question)
+
+
+async def _fill_by_relevance(cut_files, question, remaining):
+    embedding = await embeddings.aembed_query(question) if question else None
+    for i, file in enumerate(cut_files):
+        # Budget left is shared evenly by the files still to fill
+        share = remaining // (len(cut_files) - i)
+        if embedding is not None:
+            candidates = await _relevant_chunks(file, embedding)
+        else:
+            # Nothing to rank by, the start of the file is used
+            candidates = await aquery(_FIRST_CHUNKS_QUERY, {"name": file.file_details['name'],
+                                                            "username": file.file_details['username'],
+                                                            "limit": RELEVANT_CHUNK_CANDIDATES})
+        for candidate in candidates:
+            tokens = count_text_tokens(candidate['text'])
+            if file.tokens + tokens <= share:
+                file.chunks.append((candidate['chunk_no'], candidate['text']))
+                file.tokens += tokens
+        remaining -= file.tokens
+
+
+async def _relevant_chunks(file, embedding):
+    params = {"name": file.file_details['name'], "username": file.file_details['username'], "embedding": embedding,
+              "limit": RELEVANT_CHUNK_CANDIDATES, "candidates": RELEVANT_CHUNK_CANDIDATES * VECTOR_SEARCH_OVERSAMPLE}
+    try:
+        candidates = await aquery(_RELEVANT_CHUNKS_QUERY, params)
+        # Nearest chunks of other files crowd out this one's, when too few are left the exact scan decides
+        if len(candidates) >= min(RELEVANT_CHUNK_CANDIDATES, file.chunk_count):
+            return candidates
+    except Exception as e:
+        print(f"[Vector Index Unavailable] {e}")
+    return await aquery(_RELEVANT_CHUNKS_SCAN_QUERY, params)
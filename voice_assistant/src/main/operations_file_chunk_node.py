@@ -4,48 +4,142 @@ import hashlib
 import json
 import os
 import traceback
-import streamlit as st
+import uuid
 from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
 
 import fitz
 from langchain.text_splitter import CharacterTextSplitter
 from langchain_community.document_loaders import PyMuPDFLoader, UnstructuredWordDocumentLoader, UnstructuredExcelLoader
 from langchain_core.documents import Document
 from langchain_core.messages import SystemMessage
-from langchain_neo4j import Neo4jVector, Neo4jGraph
+from langchain_neo4j import Neo4jGraph
 from langchain_openai import AzureOpenAIEmbeddings, AzureChatOpenAI
 
 import operations_images_jpeg_png as img_ops
+from operations_config import get_secret
+from operations_query_cache import query_cache
+from operations_rate_limit import embedding_rate_limiter, estimate_tokens
+from operations_text_files import is_text_file, open_text_buffer, iter_text_chunks
+from operations_upload_spool import SpooledUpload
 
 # One time neo4j index creation:
 # CREATE INDEX file_name_index IF NOT EXISTS FOR (f:File) ON (f.name);
 # CREATE INDEX file_date_index IF NOT EXISTS FOR (f:File) ON (f.date);
 # CREATE INDEX file_timestamp_index IF NOT EXISTS FOR (f:File) ON (f.timestamp);
-# CREATE INDEX chunk_origin_filename_index IF NOT EXISTS FOR (c:Chunk) ON (c.origin_filename);
-# CREATE INDEX chunk_page_index IF NOT EXISTS FOR (c:Chunk) ON (c.page);
+# CREATE CONSTRAINT chunk_id_unique IF NOT EXISTS FOR (c:Chunk) REQUIRE c.id IS UNIQUE;
+# Chunks created before content addressing keep working once their per upload fields are copied to the relationship:
+# MATCH (f:File)-[r:CHUNKED_INTO]->(c:Chunk) WHERE r.chunk_no IS NULL SET r.chunk_no = c.chunk_no, r.chunk_create_ts = c.chunk_create_ts;
 
 # CREATE INDEX chat_username_index IF NOT EXISTS FOR (c:Chat) ON (c.username);
 # CREATE INDEX chat_timestamp_index IF NOT EXISTS FOR (c:Chat) ON (c.timestamp);
+# CREATE INDEX chat_id_index IF NOT EXISTS FOR (c:Chat) ON (c.id);
 
-NEO4J_URI = st.secrets['NEO4J_URI']
-NEO4J_USER = st.secrets['NEO4J_USER']
-NEO4J_PASSWORD = st.secrets['NEO4J_PASSWORD']
+NEO4J_URI = get_secret('NEO4J_URI')
+NEO4J_USER = get_secret('NEO4J_USER')
+NEO4J_PASSWORD = get_secret('NEO4J_PASSWORD')
 os.environ["NEO4J_URI"] = NEO4J_URI
 os.environ["NEO4J_USERNAME"] = NEO4J_USER
 os.environ["NEO4J_PASSWORD"] = NEO4J_PASSWORD
 
-AZURE_OPENAI_MODEL = st.secrets['AZURE_OPENAI_MODEL']
-AZURE_OPENAI_ENDPOINT = st.secrets['AZURE_OPENAI_ENDPOINT']
-AZURE_OPENAI_KEY = st.secrets['AZURE_OPENAI_KEY']
-AZURE_OPENAI_VERSION = st.secrets['AZURE_OPENAI_VERSION']
-
-AZURE_EMBEDDING_MODEL = st.secrets['AZURE_EMBEDDING_MODEL']
-AZURE_EMBEDDING_ENDPOINT = st.secrets['AZURE_EMBEDDING_ENDPOINT']
-AZURE_EMBEDDING_KEY = st.secrets['AZURE_EMBEDDING_KEY']
-
+AZURE_OPENAI_MODEL = get_secret('AZURE_OPENAI_MODEL')
+AZURE_OPENAI_ENDPOINT = get_secret('AZURE_OPENAI_ENDPOINT')
+AZURE_OPENAI_KEY = get_secret('AZURE_OPENAI_KEY')
+AZURE_OPENAI_VERSION = get_secret('AZURE_OPENAI_VERSION')
+
+AZURE_EMBEDDING_MODEL = get_secret('AZURE_EMBEDDING_MODEL')
+AZURE_EMBEDDING_ENDPOINT = get_secret('AZURE_EMBEDDING_ENDPOINT')
+AZURE_EMBEDDING_KEY = get_secret('AZURE_EMBEDDING_KEY')
+
+# Chunks embedded and written per round trip, also bounds memory for streamed text files
+EMBEDDING_BATCH_SIZE = 64
+SUMMARY_TEXT_LIMIT = 32000
+
+
+# Chunks are content addressed: identical text uploaded by any user maps to one Chunk node with one embedding.
+# Per upload details (chunk_no, page, chart metadata, ...) live on the File-[:CHUNKED_INTO]->Chunk relationship,
+# so ownership and access filtering always go through (User)-[:UPLOADED_FILE]->(File).
+def chunk_id(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _relationship_properties(metadata):
+    properties = {}
+    for k, v in metadata.items():
+        # Loader paths point into the upload spool, they are not kept
+        if k in ('username', 'origin_filename', 'source', 'file_path'):
+            continue
+        properties[k] = v if isinstance(v, (str, int, float, bool)) else str(v)
+    return properties
+
+
+def _embed_chunks(embeddings, texts):
+    embedding_rate_limiter.acquire(estimate_tokens(texts.values()))
+    return dict(zip(texts.keys(), embeddings.embed_documents(list(texts.values()))))
+
+
+def write_chunk_batch(graph, embeddings, file_name, username, documents, upload_id):
+    ids = [chunk_id(doc.page_content) for doc in documents]
+    texts = dict(zip(ids, (doc.page_content for doc in documents)))
+
+    # Only text that is not stored yet is sent for embedding
+    existing_ids = set(row['id'] for row in graph.query(
+        """MATCH (c:Chunk) WHERE c.id IN $ids AND c.embedding IS NOT NULL RETURN c.id AS id""",
+        params={"ids": ids}))
+    vectors = {}
+    new_chunks = {k: text for k, text in texts.items() if k not in existing_ids}
+    if len(new_chunks) > 0:
+        vectors = _embed_chunks(embeddings, new_chunks)
+        graph.query("""CREATE VECTOR INDEX vector IF NOT EXISTS FOR (c:Chunk) ON (c.embedding)
+            OPTIONS {indexConfig: {`vector.dimensions`: toInteger($dimensions), `vector.similarity_function`: 'cosine'}}""",
+                    params={"dimensions": len(next(iter(vectors.values())))})
+
+    # Chunks are merged in the same query that links them, a chunk another upload removed as orphaned after the
+    # check above is created again rather than silently left unlinked
+    missing_ids = [row['id'] for row in graph.query("""MATCH (f:File {name: $file_name, username: $username})
+        UNWIND $links AS link
+        MERGE (c:Chunk {id: link.id})
+        ON CREATE SET c.text = link.text, c.embedding_model = $embedding_model
+        WITH f, c, link, $vectors[link.id] AS vector
+        CALL {
+            WITH c, vector
+            WITH c, vector WHERE vector IS NOT NULL AND c.embedding IS NULL
+            CALL db.create.setNodeVectorProperty(c, 'embedding', vector)
+        }
+        MERGE (f)-[r:CHUNKED_INTO {chunk_no: link.chunk_no}]->(c)
+        SET r += link.properties, r.upload_id = $upload_id
+        WITH DISTINCT c WHERE c.embedding IS NULL
+        RETURN c.id AS id""",
+                                                    params={
+                                                        "file_name": file_name,
+                                                        "username": username,
+                                                        "upload_id": upload_id,
+                                                        "embedding_model": AZURE_EMBEDDING_MODEL,
+                                                        "vectors": vectors,
+                                                        "links": [{"id": k, "text": doc.page_content,
+                                                                   "chunk_no": doc.metadata['chunk_no'],
+                                                                   "properties": _relationship_properties(doc.metadata)}
+                                                                  for k, doc in zip(ids, documents)]
+                                                    })]
+
+    # Recreated chunks that were thought to be stored already
+    if len(missing_ids) > 0:
+        vectors = _embed_chunks(embeddings, {k: texts[k] for k in missing_ids})
+        graph.query("""UNWIND $rows AS row
+            MATCH (c:Chunk {id: row.id})
+            SET c.embedding_model = $embedding_model
+            WITH c, row
+            CALL db.create.setNodeVectorProperty(c, 'embedding', row.embedding)""",
+                    params={"embedding_model": AZURE_EMBEDDING_MODEL,
+                            "rows": [{"id": k, "embedding": vector} for k, vector in vectors.items()]})
+
+
+# Chunks of an earlier upload of the file stay linked until the new ones are, so unchanged text is neither deleted
+# nor embedded again. Calls sharing an upload_id add to one upload, delete_chunks then unlinks everything else
 def create_file_and_chunks(file, username, full_text, split_documents, file_abs_path=None, image_data=None,
-                           delete_chunks=True):
+                           delete_chunks=True, upload_id=None):
     graph = Neo4jGraph()
+    upload_id = upload_id or uuid.uuid4().hex
     current_timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
     file_name = file.split('\\')[-1] if '\\' in file else file.split('/')[-1]
 
@@ -59,8 +153,8 @@ def create_file_and_chunks(file, username, full_text, split_documents, file_abs_
     summary_prompt = ("You are given a text below from a file, summarise from the content and get a 2 line "
                       "context of the file. Keep your response in 2 lines. If text is in other language "
                       f"than English mention that and keep the context summary in English only:\n{full_text}")
-    if len(summary_prompt) > 32000:
-        summary_prompt = summary_prompt[:32000]
+    if len(summary_prompt) > SUMMARY_TEXT_LIMIT:
+        summary_prompt = summary_prompt[:SUMMARY_TEXT_LIMIT]
     sys_msg = SystemMessage(summary_prompt)
     summary = model.invoke([sys_msg]).content
 
@@ -69,38 +163,26 @@ def create_file_and_chunks(file, username, full_text, split_documents, file_abs_
         azure_endpoint=AZURE_EMBEDDING_ENDPOINT,
         api_key=AZURE_EMBEDDING_KEY
     )
-    if delete_chunks:
-        graph.query("""MATCH (n:Chunk{origin_filename: $file_name, username: $username}) DETACH DELETE n""",
-                    params={"file_name": file_name, "username": username})
     if image_data is None and file_abs_path is not None:
         # Read the image file in binary mode
         with open(file_abs_path, "rb") as image_file:
             image_data = base64.b64encode(image_file.read()).decode('utf-8')
 
-    # Generate Chunk ids
-    id_list, i = [], 0
-    for doc in split_documents:
-        key = str(doc.metadata['origin_filename']) + str(doc.metadata['username']) + str(i)
-        id_list.append(hashlib.md5(key.encode('utf-8')).hexdigest())
-        i += 1
-
-    db = Neo4jVector.from_documents(
-        split_documents,
-        embeddings,
-        ids=id_list
-    )
+    # split_documents may be a generator, embed and write in batches so it is never fully materialised
+    split_documents = iter(split_documents)
+    batch = list(islice(split_documents, EMBEDDING_BATCH_SIZE))
+    file_format = batch[0].metadata['format']
 
+    # Cached file reads of the user are dropped before and after the writes, a read in between is not kept
+    query_cache.invalidate('files', username)
     if image_data is not None:
         graph.query("""MERGE (f:File {name: $file_name, username: $username})
             ON CREATE SET f.timestamp = $timestamp, f.date = $date, f.type = $type, f.summary = $summary, f.data = $data, f.username = $username
-            ON MATCH SET f.timestamp = $timestamp, f.date = $date, f.type = $type, f.summary = $summary, f.data = $data, f.username = $username
-            WITH f    
-            MATCH (c:Chunk {origin_filename: $file_name, username: $username})
-            MERGE (f)-[:CHUNKED_INTO]->(c)""",
+            ON MATCH SET f.timestamp = $timestamp, f.date = $date, f.type = $type, f.summary = $summary, f.data = $data, f.username = $username""",
                     params={
                         "file_name": file_name,
                         "timestamp": current_timestamp,
-                        "type": split_documents[0].metadata['format'],
+                        "type": file_format,
                         "date": current_timestamp[:10],
                         "summary": summary,
                         "data": image_data,
@@ -111,20 +193,31 @@ def create_file_and_chunks(file, username, full_text, split_documents, file_abs_
         graph.query(
             """MERGE (f:File {name: $file_name, username: $username})
             ON CREATE SET f.timestamp = $timestamp, f.date = $date, f.type = $type, f.summary = $summary, f.username = $username
-            ON MATCH SET f.timestamp = $timestamp, f.date = $date, f.type = $type, f.summary = $summary, f.username = $username
-            WITH f    
-            MATCH (c:Chunk {origin_filename: $file_name, username: $username})
-            MERGE (f)-[:CHUNKED_INTO]->(c)""",
+            ON MATCH SET f.timestamp = $timestamp, f.date = $date, f.type = $type, f.summary = $summary, f.username = $username""",
             params={
                 "file_name": file_name,
                 "timestamp": current_timestamp,
-                "type": split_documents[0].metadata['format'],
+                "type": file_format,
                 "date": current_timestamp[:10],
                 "summary": summary,
                 "username": username
             }
         )
 
+    while len(batch) > 0:
+        write_chunk_batch(graph, embeddings, file_name, username, batch, upload_id)
+        batch = list(islice(split_documents, EMBEDDING_BATCH_SIZE))
+
+    if delete_chunks:
+        # Unlink previous uploads of this file, chunks no other file points to are removed
+        graph.query("""MATCH (f:File {name: $file_name, username: $username})-[r:CHUNKED_INTO]->(c:Chunk)
+            WHERE r.upload_id IS NULL OR r.upload_id <> $upload_id
+            DELETE r
+            WITH DISTINCT c
+            WHERE NOT ()-[:CHUNKED_INTO]->(c)
+            DETACH DELETE c""",
+                    params={"file_name": file_name, "username": username, "upload_id": upload_id})
+
     # Link to current user
     graph.query("""MATCH (f:File {name: $file_name, username: $username})
         MATCH (u:User {username: $username})
@@ -135,7 +228,8 @@ def create_file_and_chunks(file, username, full_text, split_documents, file_abs_
                     "username": username
                 }
                 )
-    return {"name": file_name, "type": split_documents[0].metadata['format'], "summary": summary}
+    query_cache.invalidate('files', username)
+    return {"name": file_name, "type": file_format, "summary": summary}
 
 
 def process_chart(chart_detail, image_name, image_bytes, i, page_num, img_index, file, username):
@@ -159,146 +253,103 @@ def process_chart(chart_detail, image_name, image_bytes, i, page_num, img_index,
     return doc
 
 
-def process_file(file, username):
-    if file.endswith('.pdf'):
-        loader = PyMuPDFLoader(file)
+def iter_text_documents(buffer, file, username):
+    i = 1
+    for text in iter_text_chunks(buffer, chunk_size=2000):
+        doc = Document(page_content=text)
+        doc.metadata['chunk_no'] = i
+        doc.metadata['chunk_create_ts'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        doc.metadata['origin_filename'] = file.split('\\')[-1] if '\\' in file else file.split('/')[-1]
+        doc.metadata['format'] = file.split('.')[-1]
+        doc.metadata['username'] = username
+        i += 1
+        yield doc
 
-        # Image search
-        pdf_doc = fitz.open(file)
-        i = 1
-        image_summary = ''
-        for page_num in range(len(pdf_doc)):
-            page = pdf_doc[page_num]
-            images = page.get_images(full=True)
-
-            for img_index, img in enumerate(images):
-                xref = img[0]
-                base_image = pdf_doc.extract_image(xref)
-                image_bytes = base64.b64encode(base_image["image"]).decode('utf-8')
-                error_message = ''
-                image_summary_text = ''
-                chart_summary_list = []
-                image_name = file + '_image' + str(img_index)
-
-                for retry in range(3):
-                    try:
-                        image_summary_text = img_ops.get_image_summary(image_name, image_bytes, error_message)
-                        chart_summary_list = json.loads(image_summary_text)
-                        break
-
-                    except Exception as e:
-                        error_message = str(traceback.print_exc(limit=1))
-
-                if len(chart_summary_list) > 0:
-                    split_documents = []
-                    ip_params = []
-                    for chart_detail in chart_summary_list:
-                        ip_params.append(
-                            (chart_detail, image_name, image_bytes, i, page_num, img_index, file, username))
-                        i += 1
-
-                    with ThreadPoolExecutor() as executor:
-                        result = executor.map(lambda p: process_chart(*p), ip_params)
-                    for doc in result:
-                        split_documents.append(doc)
-
-                    # Create Neo4j Nodes and Relations
-                    summary_dict = create_file_and_chunks(file, username, image_summary_text, split_documents,
-                                                          image_data=image_bytes)
-
-                    if 'summary' in summary_dict:
-                        image_summary += summary_dict['summary']
-        pdf_doc.close()
-
-        documents = loader.load()
-        full_text = documents[0].page_content
-
-        # Split the text into smaller chunks using CharacterTextSplitter
-        text_splitter = CharacterTextSplitter(chunk_size=2000, chunk_overlap=0)
-        split_documents = text_splitter.split_documents(documents)
-
-        for doc in split_documents:
-            doc.metadata['chunk_no'] = i
-            doc.metadata['chunk_create_ts'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
-            doc.metadata['origin_filename'] = file.split('\\')[-1] if '\\' in file else file.split('/')[-1]
-            doc.metadata['username'] = username
-            doc.metadata = {k: v for k, v in doc.metadata.items() if v != ''}
-            i += 1
 
-        # Create Neo4j Nodes and Relations
-        summary_dict = create_file_and_chunks(file, username, full_text, split_documents, delete_chunks=False)
-        if image_summary != '':
-            summary_dict['summary'] += 'File contains image, summary of those: ' + image_summary
+def split_loaded_documents(loader, file, username, set_format=True):
+    documents = loader.load()
+    full_text = documents[0].page_content
 
-        return summary_dict
+    # Split the text into smaller chunks using CharacterTextSplitter
+    text_splitter = CharacterTextSplitter(chunk_size=2000, chunk_overlap=0)
+    split_documents = text_splitter.split_documents(documents)
 
-    elif file.endswith('.doc') or file.endswith('.docx'):
-        loader = UnstructuredWordDocumentLoader(file)
-        documents = loader.load()
-        full_text = documents[0].page_content
+    i = 1
+    for doc in split_documents:
+        doc.metadata['chunk_no'] = i
+        doc.metadata['chunk_create_ts'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        doc.metadata['origin_filename'] = file.split('\\')[-1] if '\\' in file else file.split('/')[-1]
+        if set_format:
+            doc.metadata['format'] = file.split('.')[-1]
+        doc.metadata['username'] = username
+        doc.metadata = {k: v for k, v in doc.metadata.items() if v != ''}
+        i += 1
 
-        # Split the text into smaller chunks using CharacterTextSplitter
-        text_splitter = CharacterTextSplitter(chunk_size=2000, chunk_overlap=0)
-        split_documents = text_splitter.split_documents(documents)
+    return full_text, split_documents
 
-        i = 1
-        for doc in split_documents:
-            doc.metadata['chunk_no'] = i
-            doc.metadata['chunk_create_ts'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
-            doc.metadata['origin_filename'] = file.split('\\')[-1] if '\\' in file else file.split('/')[-1]
-            doc.metadata['format'] = file.split('.')[-1]
-            doc.metadata['username'] = username
-            doc.metadata = {k: v for k, v in doc.metadata.items() if v != ''}
-            i += 1
 
-        # Create Neo4j Nodes and Relations
-        summary_dict = create_file_and_chunks(file, username, full_text, split_documents)
+def extract_pdf_images(file):
+    pdf_doc = fitz.open(file)
+    pdf_images = []
+    for page_num in range(len(pdf_doc)):
+        page = pdf_doc[page_num]
+        images = page.get_images(full=True)
 
-        return summary_dict
-    elif file.endswith('.xlsx'):
-        loader = UnstructuredExcelLoader(file)
-        documents = loader.load()
-        full_text = documents[0].page_content
+        for img_index, img in enumerate(images):
+            xref = img[0]
+            base_image = pdf_doc.extract_image(xref)
+            pdf_images.append((page_num, img_index, base64.b64encode(base_image["image"]).decode('utf-8')))
+    pdf_doc.close()
+    return pdf_images
 
-        # Split the text into smaller chunks using CharacterTextSplitter
-        text_splitter = CharacterTextSplitter(chunk_size=2000, chunk_overlap=0)
-        split_documents = text_splitter.split_documents(documents)
 
-        i = 1
-        for doc in split_documents:
-            doc.metadata['chunk_no'] = i
-            doc.metadata['chunk_create_ts'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
-            doc.metadata['origin_filename'] = file.split('\\')[-1] if '\\' in file else file.split('/')[-1]
-            doc.metadata['format'] = file.split('.')[-1]
-            doc.metadata['username'] = username
-            doc.metadata = {k: v for k, v in doc.metadata.items() if v != ''}
-            i += 1
+# CPU bound stage of ingestion (parsing and splitting), makes no network calls and returns picklable results so
+# it can run in a worker process. Returns None for file types that are parsed while being ingested.
+def parse_file(file, username):
+    if file.endswith('.pdf'):
+        full_text, split_documents = split_loaded_documents(PyMuPDFLoader(file), file, username, set_format=False)
+        return {"full_text": full_text, "split_documents": split_documents, "pdf_images": extract_pdf_images(file)}
+    elif file.endswith('.doc') or file.endswith('.docx'):
+        full_text, split_documents = split_loaded_documents(UnstructuredWordDocumentLoader(file), file, username)
+        return {"full_text": full_text, "split_documents": split_documents}
+    elif file.endswith('.xlsx'):
+        full_text, split_documents = split_loaded_documents(UnstructuredExcelLoader(file), file, username)
+        return {"full_text": full_text, "split_documents": split_documents}
+    return None
 
-        # Create Neo4j Nodes and Relations
-        summary_dict = create_file_and_chunks(file, username, full_text, split_documents)
 
-        return summary_dict
-    elif file.endswith('.png') or file.endswith('.jpeg'):
+# Network bound stage of ingestion (LLM calls, embeddings and Neo4j writes) for the output of parse_file
+def ingest_parsed_file(file, username, parsed_file):
+    if 'pdf_images' not in parsed_file:
+        # Create Neo4j Nodes and Relations
+        return create_file_and_chunks(file, username, parsed_file['full_text'], parsed_file['split_documents'])
+
+    # Image and text chunks are one upload, earlier chunks are unlinked once all of them are written
+    upload_id = uuid.uuid4().hex
+    # Image search
+    i = 1
+    image_summary = ''
+    for page_num, img_index, image_bytes in parsed_file['pdf_images']:
         error_message = ''
         image_summary_text = ''
         chart_summary_list = []
+        image_name = file + '_image' + str(img_index)
 
         for retry in range(3):
             try:
-                image_summary_text = img_ops.get_image_summary(file, error_message=error_message)
+                image_summary_text = img_ops.get_image_summary(image_name, image_bytes, error_message)
                 chart_summary_list = json.loads(image_summary_text)
-                print(chart_summary_list)
                 break
 
             except Exception as e:
                 error_message = str(traceback.print_exc(limit=1))
 
         if len(chart_summary_list) > 0:
-            i = 1
             split_documents = []
             ip_params = []
             for chart_detail in chart_summary_list:
-                ip_params.append((chart_detail, file, None, i, None, None, file, username))
+                ip_params.append(
+                    (chart_detail, image_name, image_bytes, i, page_num, img_index, file, username))
                 i += 1
 
             with ThreadPoolExecutor() as executor:
@@ -307,9 +358,106 @@ def process_file(file, username):
                 split_documents.append(doc)
 
             # Create Neo4j Nodes and Relations
-            summary_dict = create_file_and_chunks(file, username, image_summary_text, split_documents, file)
+            summary_dict = create_file_and_chunks(file, username, image_summary_text, split_documents,
+                                                  image_data=image_bytes, delete_chunks=False, upload_id=upload_id)
+
+            if 'summary' in summary_dict:
+                image_summary += summary_dict['summary']
+
+    # Text chunks are numbered after the image chunks
+    for doc in parsed_file['split_documents']:
+        doc.metadata['chunk_no'] = i
+        i += 1
+
+    # Create Neo4j Nodes and Relations
+    summary_dict = create_file_and_chunks(file, username, parsed_file['full_text'], parsed_file['split_documents'],
+                                          upload_id=upload_id)
+    if image_summary != '':
+        summary_dict['summary'] += 'File contains image, summary of those: ' + image_summary
+
+    return summary_dict
+
+
+def process_text_buffer(buffer, file, username):
+    split_documents = iter_text_documents(buffer, file, username)
+
+    # Only the head of the file is needed for the summary, the rest streams straight into embedding
+    head_documents, head_length = [], 0
+    for doc in split_documents:
+        head_documents.append(doc)
+        head_length += len(doc.page_content)
+        if head_length >= SUMMARY_TEXT_LIMIT:
+            break
+    if len(head_documents) == 0:
+        return None
+    full_text = '\n'.join(doc.page_content for doc in head_documents)
+
+    # Create Neo4j Nodes and Relations
+    return create_file_and_chunks(file, username, full_text, chain(head_documents, split_documents))
+
+
+def process_image_data(image_data, file, username):
+    error_message = ''
+    image_summary_text = ''
+    chart_summary_list = []
 
-            return summary_dict
+    for retry in range(3):
+        try:
+            image_summary_text = img_ops.get_image_summary(file, image_data, error_message=error_message)
+            chart_summary_list = json.loads(image_summary_text)
+            break
+
+        except Exception as e:
+            error_message = str(traceback.print_exc(limit=1))
+
+    if len(chart_summary_list) > 0:
+        i = 1
+        split_documents = []
+        ip_params = []
+        for chart_detail in chart_summary_list:
+            ip_params.append((chart_detail, file, image_data, i, None, None, file, username))
+            i += 1
+
+        with ThreadPoolExecutor() as executor:
+            result = executor.map(lambda p: process_chart(*p), ip_params)
+        for doc in result:
+            split_documents.append(doc)
+
+        # Create Neo4j Nodes and Relations
+        summary_dict = create_file_and_chunks(file, username, image_summary_text, split_documents,
+                                              image_data=image_data)
+
+        return summary_dict
+
+
+def is_image_file(file):
+    return file.endswith('.png') or file.endswith('.jpeg')
+
+
+# file is either a path or a SpooledUpload from operations_upload_spool
+def process_file(file, username):
+    if isinstance(file, SpooledUpload):
+        # Text and images are read straight from the spooled buffer, other loaders need a path on disk
+        if is_text_file(file.name):
+            with file.buffer() as buffer:
+                return process_text_buffer(buffer, file.name, username)
+        elif is_image_file(file.name):
+            with file.buffer() as buffer:
+                image_data = base64.b64encode(buffer).decode('utf-8')
+            return process_image_data(image_data, file.name, username)
+        file = file.path
+
+    parsed_file = parse_file(file, username)
+    if parsed_file is not None:
+        return ingest_parsed_file(file, username, parsed_file)
+    elif is_text_file(file):
+        with open_text_buffer(file) as buffer:
+            return process_text_buffer(buffer, file, username)
+    elif is_image_file(file):
+        # Read the image file in binary mode
+        with open(file, "rb") as image_file:
+            image_data = base64.b64encode(image_file.read()).decode('utf-8')
+        return process_image_data(image_data, file, username)
 
 
 def process_given_files(files, username):
@@ -1,15 +1,16 @@
 import base64
-import streamlit as st
 from openai import AzureOpenAI
 
+from operations_config import get_secret
+
 # === CONFIGURATION ===
 # Computer Vision Config
 
 
-AZURE_OPENAI_MODEL = st.secrets['AZURE_OPENAI_MODEL']
-AZURE_OPENAI_ENDPOINT = st.secrets['AZURE_OPENAI_ENDPOINT']
-AZURE_OPENAI_KEY = st.secrets['AZURE_OPENAI_KEY']
-AZURE_OPENAI_VERSION = st.secrets['AZURE_OPENAI_VERSION']
+AZURE_OPENAI_MODEL = get_secret('AZURE_OPENAI_MODEL')
+AZURE_OPENAI_ENDPOINT = get_secret('AZURE_OPENAI_ENDPOINT')
+AZURE_OPENAI_KEY = get_secret('AZURE_OPENAI_KEY')
+AZURE_OPENAI_VERSION = get_secret('AZURE_OPENAI_VERSION')
 
 # Initialize the OpenAI LLM with Azure configuration
 model = AzureOpenAI(
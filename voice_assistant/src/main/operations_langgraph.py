@@ -1,54 +1,81 @@
-import json
+import threading
 from functools import partial
-import streamlit as st
 
-from langchain_core.messages import SystemMessage, ToolMessage
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig
 from langchain_openai import AzureChatOpenAI
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import StateGraph, START, MessagesState
 from langgraph.prebuilt import tools_condition, ToolNode
 
+from operations_config import get_secret
+from operations_checkpointer import get_checkpointer
+from operations_compaction import summary_message
+from operations_context_budget import context_budget, count_text_tokens
+from operations_retrieval import excerpts_message, start_pre_retrieval
+from operations_tool_memo import memoised_tools
 from tool_files_filter_search import file_filter_search
 from tool_previous_chat_filter_search import previous_chat_filter_search
 
 # Azure OpenAI Config
-AZURE_OPENAI_MODEL = st.secrets['AZURE_OPENAI_MODEL']
-AZURE_OPENAI_ENDPOINT = st.secrets['AZURE_OPENAI_ENDPOINT']
-AZURE_OPENAI_KEY = st.secrets['AZURE_OPENAI_KEY']
-AZURE_OPENAI_VERSION = st.secrets['AZURE_OPENAI_VERSION']
-
-
-def assistant(state: MessagesState, sys_msg: SystemMessage, model):
-    for messages in state["messages"]:
-        if isinstance(messages, ToolMessage) and messages.name == 'file-based-data-retrieval':
-            # print(messages.content)
-            tool_response = json.loads(messages.content)
-            if 'metadata' in tool_response.keys():
-                del tool_response['metadata']
-                messages.content = json.dumps(tool_response).replace('\\\\', '\\')
-
-    # Dynamic trimming of longer messages in prompt
-    tokens = 30000
-    for i in range(len(state["messages"]) - 1, -1, -1):
-        if isinstance(state["messages"][i].content, str):
-            limit = int(tokens * 0.7)
-            if len(state["messages"][i].content) > limit:
-                state["messages"][i].content = state["messages"][i].content[
-                                               :limit] + '...message is too long, truncating rest'
-                tokens -= limit
-            if isinstance(state["messages"][i], ToolMessage) and '"root_node":' in state["messages"][i].content:
-                state["messages"][i].content = (
-                        '' + state["messages"][i].content)  # add extra details before tool response
-
-    messages = model.invoke([sys_msg] + state["messages"])
+AZURE_OPENAI_MODEL = get_secret('AZURE_OPENAI_MODEL')
+AZURE_OPENAI_ENDPOINT = get_secret('AZURE_OPENAI_ENDPOINT')
+AZURE_OPENAI_KEY = get_secret('AZURE_OPENAI_KEY')
+AZURE_OPENAI_VERSION = get_secret('AZURE_OPENAI_VERSION')
+
+
+class AssistantState(MessagesState):
+    # Running summary of turns removed by compaction
+    summary: str
+    # Pre-retrieved file excerpts of the current turn, replaced when the next user message arrives
+    turn_excerpts: str
+
+
+def user_message(user_details):
+    return SystemMessage(content=f"Current user name is {user_details['first_name']} "
+                                 f"with access role {user_details['role']}")
+
+
+def assistant(state: AssistantState, config: RunnableConfig, sys_msg: SystemMessage, model):
+    thread_id = config.get('configurable', {}).get('thread_id')
+    user_details = config.get('configurable', {}).get('user_details')
+    if user_details is None:
+        raise Exception('Langgraph model cannot be invoked, missing user details in config')
+    # First model call of a turn, the file search runs while the prompt is assembled
+    turn_started = isinstance(state["messages"][-1], HumanMessage)
+    pre_retrieval = None
+    if turn_started:
+        pre_retrieval = start_pre_retrieval(state["messages"][-1], user_details['username'])
+
+    # Static prompt first so it stays identical for every user
+    system_messages = [sys_msg, user_message(user_details)]
+    if state.get("summary"):
+        system_messages.append(summary_message(state["summary"]))
+
+    # Token budgeted copy of the history, state messages are never mutated
+    system_tokens = sum(count_text_tokens(message.content) for message in system_messages)
+    prompt_messages, metrics = context_budget.fit(state["messages"], system_tokens=system_tokens, thread_id=thread_id)
+    print(f"[Prompt tokens] {metrics}")
+
+    # Excerpts live outside the message history for one turn only, later calls of the turn reuse them and the
+    # next user message replaces them, so they never pile up in the prompt
+    turn_excerpts = state.get("turn_excerpts", '')
+    if turn_started:
+        # Excerpts retrieved while the user was still speaking come with the message
+        prefetched_excerpts = state["messages"][-1].metadata.get('prefetched_excerpts')
+        if isinstance(prefetched_excerpts, str) and prefetched_excerpts != '':
+            turn_excerpts = prefetched_excerpts
+        else:
+            turn_excerpts = pre_retrieval.excerpts() if pre_retrieval is not None else ''
+    excerpt_messages = [excerpts_message(turn_excerpts)] if turn_excerpts else []
+
+    messages = model.invoke(system_messages + prompt_messages + excerpt_messages)
     # print(messages)
+    if turn_started:
+        return {"messages": [messages], "turn_excerpts": turn_excerpts}
     return {"messages": [messages]}
 
 
-def build_graph(logged_user_details):
-    # Input validation
-    if 'first_name' not in logged_user_details or 'username' not in logged_user_details or 'role' not in logged_user_details:
-        raise Exception('Langgraph model cannot be built, missing mandatory user parameters')
+def build_graph():
     # Initialize the OpenAI LLM with Azure configuration
     model = AzureChatOpenAI(
         model=AZURE_OPENAI_MODEL,
@@ -74,19 +101,42 @@ file search. If similarity search does not bring results Do this step by default
 - Support both voice and chat input/output. Use the file tool when asked to show images.
 - If similarity search tools with similarity_search_message parameter is not retrieving results try again with just
 filters like name of the file or date range only.
-- Refer tool documentation on what each tool does and their parameter usage process. '''
-                     + f"Current user name is {logged_user_details['first_name']} with access role {logged_user_details['role']}")
+- Refer tool documentation on what each tool does and their parameter usage process. ''')
 
     sys_msg = SystemMessage(content=system_prompt)
 
     assistant_prefilled = partial(assistant, sys_msg=sys_msg, model=langgraph_model)
-    builder = StateGraph(MessagesState)
+    builder = StateGraph(AssistantState)
     builder.add_node("assistant", assistant_prefilled)
-    builder.add_node("tools", ToolNode(tools))
+    # Identical tool calls within a conversation are answered from the memo until the user's data changes
+    tools_memoised = partial(memoised_tools, tool_node=ToolNode(tools), tools_by_name={t.name: t for t in tools})
+    builder.add_node("tools", tools_memoised)
     # Define edges:
     builder.add_edge(START, "assistant")
     builder.add_conditional_edges("assistant", tools_condition)
     builder.add_edge("tools", "assistant")
 
-    react_graph = builder.compile(checkpointer=MemorySaver())
+    react_graph = builder.compile(checkpointer=get_checkpointer())
     return react_graph
+
+
+_react_graph = None
+_react_graph_lock = threading.Lock()
+
+
+# Compiled once per process and shared by every user and session, conversations are kept apart by thread id
+def get_graph():
+    global _react_graph
+    if _react_graph is None:
+        with _react_graph_lock:
+            if _react_graph is None:
+                _react_graph = build_graph()
+    return _react_graph
+
+
+def graph_config(logged_user_details, thread_id):
+    # Input validation
+    if 'first_name' not in logged_user_details or 'username' not in logged_user_details or 'role' not in logged_user_details:
+        raise Exception('Langgraph model cannot be invoked, missing mandatory user parameters')
+    user_details = {key: logged_user_details[key] for key in ('first_name', 'username', 'role')}
+    return {"configurable": {"thread_id": thread_id, "user_details": user_details}}
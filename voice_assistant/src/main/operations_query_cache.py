@@ -0,0 +1,117 @@
+import copy
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from operations_config import get_secret
+
+# Cached read results are dropped least recently used first once their estimated size passes this
+QUERY_CACHE_MAX_BYTES = int(get_secret('QUERY_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Writes from other processes (e.g. operations_batch_ingest) do not bump the generations here, entries expire
+# after this long so those show up eventually
+QUERY_CACHE_TTL_SECONDS = int(get_secret('QUERY_CACHE_TTL_SECONDS', 300))
+
+
+# Generation key bumped only when a domain is invalidated for every user
+_EVERY_USER = object()
+
+
+def _size_of(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_size_of(k) + _size_of(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(_size_of(item) for item in value)
+    return size
+
+
+# Read-through cache for Neo4j read results. Results belong to a data domain ('chats', 'files') and every user has a
+# generation counter per domain that writers bump, keys carry the generation they were read at so a write makes
+# older entries unreachable. Reads across all users (username None, e.g. Admin searches) use the global generation
+# of the domain, which every write to it bumps
+class QueryCache:
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES, ttl_seconds=QUERY_CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        # (domain, username) -> generation, username None is the global one
+        self._generations = {}
+        self._lock = threading.Lock()
+        # key -> (stored_at, size, result), oldest first
+        self._entries = OrderedDict()
+        self._size = 0
+
+    # Generation of the user's data together with the count of domain wide invalidations, so invalidating the domain
+    # for every user also makes the user's older entries unreachable
+    def _generation(self, domain, username):
+        return self._generations.get((domain, username), 0), self._generations.get((domain, _EVERY_USER), 0)
+
+    def generation(self, domain, username=None):
+        with self._lock:
+            return self._generation(domain, username)
+
+    def _lookup(self, domain, username, params):
+        now = time.monotonic()
+        with self._lock:
+            generation = self._generation(domain, username)
+            key = (domain, username, generation, json.dumps(params, sort_keys=True, default=str))
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return key, copy.deepcopy(entry[2])
+            self.misses += 1
+        return key, None
+
+    def _store(self, key, result):
+        size = _size_of(result)
+        domain, username, generation, _ = key
+        with self._lock:
+            # A write while loading bumped the generation, the result may already be stale
+            if generation == self._generation(domain, username):
+                self._size -= self._entries.pop(key, (0, 0, None))[1]
+                self._entries[key] = (time.monotonic(), size, result)
+                self._size += size
+                while self._size > self.max_bytes and len(self._entries) > 0:
+                    _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                    self._size -= evicted_size
+        return copy.deepcopy(result)
+
+    # Returns a copy of the cached result for these parameters, or loads, stores and returns it
+    def get_or_load(self, domain, username, params, loader):
+        key, result = self._lookup(domain, username, params)
+        if result is not None:
+            return result
+        return self._store(key, loader())
+
+    # Same as get_or_load for a loader returning a coroutine
+    async def aget_or_load(self, domain, username, params, loader):
+        key, result = self._lookup(domain, username, params)
+        if result is not None:
+            return result
+        return self._store(key, await loader())
+
+    # Called by writers after data of the user changed, username None invalidates the domain for every user
+    def invalidate(self, domain, username=None):
+        with self._lock:
+            scopes = {username, None} if username is not None else {None, _EVERY_USER}
+            for scope in scopes:
+                self._generations[(domain, scope)] = self._generations.get((domain, scope), 0) + 1
+            # Entries of older generations are unreachable, free them right away
+            for key in [key for key in self._entries
+                        if key[0] == domain and (username is None or key[1] in (username, None))]:
+                self._size -= self._entries.pop(key)[1]
+
+    @property
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_ratio": round(self.hits / requests, 3) if requests > 0 else None,
+                    "entries": len(self._entries), "bytes": self._size}
+
+
+query_cache = QueryCache()
@@ -0,0 +1,48 @@
+import threading
+import time
+
+from operations_config import get_secret
+
+
+# Token bucket over both requests and tokens per minute, shared by every caller in the process so background
+# jobs and interactive ingestion stay under the same Azure deployment quota together
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens=1):
+        # A single request larger than the bucket is allowed through once the bucket is full
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = max((1 - self._requests) * 60 / self.requests_per_minute,
+                           (tokens - self._tokens) * 60 / self.tokens_per_minute)
+            time.sleep(max(wait, 0.01))
+
+
+# Rough token estimate, good enough for pacing without loading a tokenizer
+def estimate_tokens(texts):
+    return sum(len(text) for text in texts) // 4 + len(texts)
+
+
+embedding_rate_limiter = RateLimiter(
+    requests_per_minute=int(get_secret('AZURE_EMBEDDING_RPM', 300)),
+    tokens_per_minute=int(get_secret('AZURE_EMBEDDING_TPM', 300000)),
+)
@@ -0,0 +1,246 @@
+# Rebuilds Chunk and Chat embeddings after an embedding model change.
+# New vectors are written to a shadow property while the old ones keep serving queries, the cutover then swaps
+# them in batches of REEMBED_CUTOVER_BATCH_SIZE nodes per transaction. Switch AZURE_EMBEDDING_MODEL for the app at
+# the same time as the cutover.
+# Nodes the app writes with the old model meanwhile are picked up right before the cutover, re-running the job
+# after the cutover embeds and swaps whatever was written until the app switched.
+# Example:
+#   python operations_reembed.py --model text-embedding-3-large --checkpoint reembed_checkpoint.json
+# Keyset pagination relies on:
+# CREATE CONSTRAINT chunk_id_unique IF NOT EXISTS FOR (c:Chunk) REQUIRE c.id IS UNIQUE;
+# CREATE INDEX chat_id_index IF NOT EXISTS FOR (c:Chat) ON (c.id);
+import argparse
+import json
+import os
+import threading
+import time
+
+from langchain_neo4j import Neo4jGraph
+from langchain_openai import AzureOpenAIEmbeddings
+
+from operations_config import get_secret
+from operations_rate_limit import embedding_rate_limiter, estimate_tokens
+from operations_user_chat_node import chat_embedding_text
+
+NEO4J_URI = get_secret('NEO4J_URI')
+NEO4J_USER = get_secret('NEO4J_USER')
+NEO4J_PASSWORD = get_secret('NEO4J_PASSWORD')
+os.environ["NEO4J_URI"] = NEO4J_URI
+os.environ["NEO4J_USERNAME"] = NEO4J_USER
+os.environ["NEO4J_PASSWORD"] = NEO4J_PASSWORD
+
+AZURE_EMBEDDING_MODEL = get_secret('AZURE_EMBEDDING_MODEL')
+AZURE_EMBEDDING_ENDPOINT = get_secret('AZURE_EMBEDDING_ENDPOINT')
+AZURE_EMBEDDING_KEY = get_secret('AZURE_EMBEDDING_KEY')
+
+REEMBED_BATCH_SIZE = 100
+# Nodes swapped per cutover transaction, keeps the transaction state small on large graphs
+REEMBED_CUTOVER_BATCH_SIZE = int(get_secret('REEMBED_CUTOVER_BATCH_SIZE', 10000))
+# Drop and create attempts before giving up on an index an app replica keeps recreating with the old dimensions
+REEMBED_INDEX_REBUILD_ATTEMPTS = 5
+REEMBED_CHECKPOINT_PATH = get_secret('REEMBED_CHECKPOINT_PATH', 'reembed_checkpoint.json')
+
+_SCAN_QUERIES = {
+    'Chunk': """MATCH (n:Chunk) WHERE n.id > $cursor AND coalesce(n.embedding_model, '') <> $model
+        AND n.embedding_shadow IS NULL
+        RETURN n.id AS id, n.text AS text ORDER BY n.id LIMIT $batch_size""",
+    'Chat': """MATCH (n:Chat) WHERE n.id > $cursor AND coalesce(n.embedding_model, '') <> $model
+        AND n.embedding_shadow IS NULL
+        RETURN n.id AS id, n {.user_first_name, .username, .user_timezone, .user_query, .agent_response, .timestamp}
+        AS properties ORDER BY n.id LIMIT $batch_size""",
+}
+
+_WRITE_QUERIES = {
+    # Chunk vectors are stored as float arrays for the vector index
+    'Chunk': """UNWIND $rows AS row MATCH (n:Chunk {id: row.id})
+        CALL db.create.setNodeVectorProperty(n, 'embedding_shadow', row.embedding)""",
+    # Chat vectors are stored as JSON strings, read back with apoc.convert.fromJsonList
+    'Chat': """UNWIND $rows AS row MATCH (n:Chat {id: row.id}) SET n.embedding_shadow = row.embedding""",
+}
+
+
+class ReembeddingJob:
+    def __init__(self, model=AZURE_EMBEDDING_MODEL, batch_size=REEMBED_BATCH_SIZE,
+                 checkpoint_path=REEMBED_CHECKPOINT_PATH, cutover=True):
+        self.model = model
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path
+        self.cutover_enabled = cutover
+        self.stop_requested = threading.Event()
+        self.state = self._load_checkpoint()
+        self.started = None
+        self.processed_this_run = 0
+
+    def _new_state(self):
+        return {"model": self.model, "cut_over": False,
+                "labels": {label: {"cursor": "", "processed": 0, "done": False} for label in _SCAN_QUERIES}}
+
+    def _load_checkpoint(self):
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            # Checkpoint of a migration to another model cannot be resumed
+            if state.get('model') == self.model:
+                return state
+        return self._new_state()
+
+    def _save_checkpoint(self):
+        if self.checkpoint_path is None:
+            return
+        # Write then rename so a crash never leaves a truncated checkpoint
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.checkpoint_path)
+
+    @property
+    def progress(self):
+        elapsed = time.perf_counter() - self.started if self.started is not None else 0
+        return {
+            "model": self.model,
+            "cut_over": self.state['cut_over'],
+            "labels": {label: dict(label_state) for label, label_state in self.state['labels'].items()},
+            "processed_this_run": self.processed_this_run,
+            "nodes_per_second": round(self.processed_this_run / elapsed, 2) if elapsed > 0 else 0,
+        }
+
+    def _embedding_text(self, label, row):
+        if label == 'Chunk':
+            return row['text'] or ''
+        return chat_embedding_text(row['properties'])
+
+    def _write_shadow(self, graph, embeddings, label, rows):
+        texts = [self._embedding_text(label, row) for row in rows]
+        embedding_rate_limiter.acquire(estimate_tokens(texts))
+        vectors = embeddings.embed_documents(texts)
+        if label == 'Chat':
+            vectors = [str(vector) for vector in vectors]
+        graph.query(_WRITE_QUERIES[label], params={
+            "rows": [{"id": row['id'], "embedding": vector} for row, vector in zip(rows, vectors)]})
+
+    def _reembed_label(self, graph, embeddings, label):
+        label_state = self.state['labels'][label]
+        while not label_state['done'] and not self.stop_requested.is_set():
+            rows = graph.query(_SCAN_QUERIES[label], params={
+                "cursor": label_state['cursor'], "model": self.model, "batch_size": self.batch_size})
+            if len(rows) == 0:
+                label_state['done'] = True
+                self._save_checkpoint()
+                break
+
+            self._write_shadow(graph, embeddings, label, rows)
+
+            # Cursor only advances after the batch is written, a crash re-embeds at most one batch
+            label_state['cursor'] = rows[-1]['id']
+            label_state['processed'] += len(rows)
+            self.processed_this_run += len(rows)
+            self._save_checkpoint()
+            print(f"[re-embed] {json.dumps(self.progress)}", flush=True)
+
+    # Nodes written with another model behind the cursor, i.e. while the scan ran or after a cutover. Scans from the
+    # start, shadowed nodes are skipped so this only finds the stragglers. Returns how many were embedded
+    def catch_up(self, graph, embeddings):
+        caught_up = 0
+        for label in _SCAN_QUERIES:
+            cursor = ''
+            while not self.stop_requested.is_set():
+                rows = graph.query(_SCAN_QUERIES[label], params={
+                    "cursor": cursor, "model": self.model, "batch_size": self.batch_size})
+                if len(rows) == 0:
+                    break
+                self._write_shadow(graph, embeddings, label, rows)
+                cursor = rows[-1]['id']
+                caught_up += len(rows)
+                self.processed_this_run += len(rows)
+        if caught_up > 0:
+            print(f"[re-embed] caught up {caught_up} nodes written during the migration", flush=True)
+        return caught_up
+
+    def _vector_index_dimensions(self, graph):
+        rows = graph.query("""SHOW VECTOR INDEXES YIELD name, options WHERE name = 'vector'
+            RETURN options.indexConfig['vector.dimensions'] AS dimensions""")
+        return rows[0]['dimensions'] if len(rows) > 0 else None
+
+    def cutover(self, graph):
+        # Shadow vectors give the new dimensions, after an interrupted cutover the already swapped nodes do
+        dimensions = graph.query("""MATCH (c:Chunk) WHERE c.embedding_shadow IS NOT NULL OR c.embedding_model = $model
+            RETURN size(coalesce(c.embedding_shadow, c.embedding)) AS dimensions LIMIT 1""",
+                                 params={"model": self.model})
+        new_dimensions = dimensions[0]['dimensions'] if len(dimensions) > 0 else None
+        # Neo4j holds one vector index per label and property, so an index with the new dimensions cannot be built
+        # next to the old one. With unchanged dimensions the index is kept and updated by the swap transactions
+        # themselves. Otherwise it is rebuilt right after the swap, chunk searches fall back to the exact scan
+        # meanwhile.
+        rebuild_index = new_dimensions is not None and self._vector_index_dimensions(graph) != new_dimensions
+        # Swapped nodes lose their shadow, an interrupted cutover continues with the rest when re-run. Searches see
+        # a mix of both models until the last batch is committed
+        for label in _SCAN_QUERIES:
+            graph.query(f"""MATCH (c:{label}) WHERE c.embedding_shadow IS NOT NULL
+                CALL {{
+                    WITH c
+                    SET c.embedding = c.embedding_shadow, c.embedding_model = $model
+                    REMOVE c.embedding_shadow
+                }} IN TRANSACTIONS OF $batch_size ROWS""",
+                        params={"model": self.model, "batch_size": REEMBED_CUTOVER_BATCH_SIZE})
+        # An app replica still on the old model may recreate the index with its dimensions while it is missing
+        attempts = 0
+        while rebuild_index and self._vector_index_dimensions(graph) != new_dimensions:
+            if attempts == REEMBED_INDEX_REBUILD_ATTEMPTS:
+                raise Exception(f"Vector index still has {self._vector_index_dimensions(graph)} dimensions instead "
+                                f"of {new_dimensions} after {attempts} rebuilds, an app replica on the old "
+                                f"embedding model keeps recreating it. Switch all replicas to {self.model} and "
+                                f"re-run the job to rebuild the index")
+            attempts += 1
+            graph.query("""DROP INDEX vector IF EXISTS""")
+            graph.query("""CREATE VECTOR INDEX vector IF NOT EXISTS FOR (c:Chunk) ON (c.embedding)
+                OPTIONS {indexConfig: {`vector.dimensions`: toInteger($dimensions), `vector.similarity_function`: 'cosine'}}""",
+                        params={"dimensions": new_dimensions})
+        self.state['cut_over'] = True
+        self._save_checkpoint()
+
+    def run(self):
+        self.started = time.perf_counter()
+        graph = Neo4jGraph()
+        embeddings = AzureOpenAIEmbeddings(
+            model=self.model,
+            azure_endpoint=AZURE_EMBEDDING_ENDPOINT,
+            api_key=AZURE_EMBEDDING_KEY,
+        )
+        for label in _SCAN_QUERIES:
+            self._reembed_label(graph, embeddings, label)
+
+        all_done = all(label_state['done'] for label_state in self.state['labels'].values())
+        if all_done and not self.stop_requested.is_set():
+            caught_up = self.catch_up(graph, embeddings)
+            if self.cutover_enabled and (caught_up > 0 or not self.state['cut_over']) \
+                    and not self.stop_requested.is_set():
+                self.cutover(graph)
+        print(f"[re-embed] finished {json.dumps(self.progress)}", flush=True)
+        return self.progress
+
+    def stop(self):
+        self.stop_requested.set()
+
+
+def start_background_reembedding(**kwargs):
+    job = ReembeddingJob(**kwargs)
+    thread = threading.Thread(target=job.run, name='reembedding-job', daemon=True)
+    thread.start()
+    return job, thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-embed Chunk and Chat nodes for a new embedding model')
+    parser.add_argument('--model', default=AZURE_EMBEDDING_MODEL, help='Target embedding deployment name')
+    parser.add_argument('--batch-size', type=int, default=REEMBED_BATCH_SIZE)
+    parser.add_argument('--checkpoint', default=REEMBED_CHECKPOINT_PATH, help='Checkpoint file used to resume')
+    parser.add_argument('--no-cutover', action='store_true', help='Only fill the shadow property')
+    args = parser.parse_args()
+
+    job = ReembeddingJob(model=args.model, batch_size=args.batch_size, checkpoint_path=args.checkpoint,
+                         cutover=not args.no_cutover)
+    job.run()
+
+
+if __name__ == '__main__':
+    main()
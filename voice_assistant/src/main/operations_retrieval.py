@@ -0,0 +1,211 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from langchain_core.messages import SystemMessage
+
+from langchain_openai import AzureOpenAIEmbeddings
+
+from operations_async_runtime import aquery, get_loop
+from operations_config import get_secret
+
+NEO4J_URI = get_secret('NEO4J_URI')
+NEO4J_USER = get_secret('NEO4J_USER')
+NEO4J_PASSWORD = get_secret('NEO4J_PASSWORD')
+os.environ["NEO4J_URI"] = NEO4J_URI
+os.environ["NEO4J_USERNAME"] = NEO4J_USER
+os.environ["NEO4J_PASSWORD"] = NEO4J_PASSWORD
+
+AZURE_EMBEDDING_MODEL = get_secret('AZURE_EMBEDDING_MODEL')
+AZURE_EMBEDDING_ENDPOINT = get_secret('AZURE_EMBEDDING_ENDPOINT')
+AZURE_EMBEDDING_KEY = get_secret('AZURE_EMBEDDING_KEY')
+
+# Speculative results are used when the final transcript starts with the speculated words and they cover at
+# least this share of it
+SPECULATION_MIN_COVERAGE = 0.7
+# How long the final transcript waits for a speculative search that is still running
+SPECULATION_WAIT_SECONDS = 2
+# Searches the files placed in the session for the incoming prompt before the first model call, so most answers
+# need no tool round trip
+PRE_RETRIEVAL = str(get_secret('PRE_RETRIEVAL', 'false')).lower() == 'true'
+PRE_RETRIEVAL_CHUNKS = int(get_secret('PRE_RETRIEVAL_CHUNKS', 4))
+# The model call does not wait longer than this for the search, it goes ahead without excerpts
+PRE_RETRIEVAL_TIMEOUT_SECONDS = 3
+
+embeddings = AzureOpenAIEmbeddings(
+    model=AZURE_EMBEDDING_MODEL,
+    azure_endpoint=AZURE_EMBEDDING_ENDPOINT,
+    api_key=AZURE_EMBEDDING_KEY,
+)
+
+
+# The vector index returns the nearest chunks of all users, this many times the requested number are fetched so
+# enough are left after the ownership and file filters
+VECTOR_SEARCH_OVERSAMPLE = int(get_secret('VECTOR_SEARCH_OVERSAMPLE', 10))
+
+# Nearest chunks from the vector index. queryNodes scores cosine as (1 + cosine) / 2, it is mapped back so both
+# search paths return the same scale
+VECTOR_INDEX_CANDIDATES = ("CALL db.index.vector.queryNodes('vector', $candidates, $embedding) "
+                           "YIELD node AS c, score WITH c, 2 * score - 1 AS similarity_score ")
+
+
+def _chunk_search_query(username, limit_by, filter_file_name, filter_date_from, filter_date_till, use_index=True):
+    chunk_filter = "WHERE 1=1 "
+    params = {'username': username, 'limit_by': limit_by}
+    if filter_date_from is not None:
+        chunk_filter += " AND f.date >= $filter_date_from"
+        params['filter_date_from'] = filter_date_from
+    if filter_date_till is not None:
+        chunk_filter += " AND f.date <= $filter_date_till"
+        params['filter_date_till'] = filter_date_till
+    if filter_file_name is not None:
+        chunk_filter += " AND f.name IN $filter_file_name"
+        params['filter_file_name'] = filter_file_name
+
+    if use_index:
+        params['candidates'] = limit_by * VECTOR_SEARCH_OVERSAMPLE
+        cypher_query = (VECTOR_INDEX_CANDIDATES
+                        + "MATCH (u:User {username: $username})-[:UPLOADED_FILE]->(f:File)-[r:CHUNKED_INTO]->(c) "
+                        + chunk_filter + " "
+                        "WITH c, f, r, similarity_score ")
+    else:
+        # Exact scan over every chunk of the user
+        cypher_query = ("MATCH (u:User {username: $username})-[:UPLOADED_FILE]->(f:File)-[r:CHUNKED_INTO]->(c:Chunk) "
+                        + chunk_filter + " "
+                        "WITH c, f, r, vector.similarity.cosine(c.embedding, $embedding) AS similarity_score ")
+    cypher_query += ("ORDER BY similarity_score DESC "
+                     "WITH c, similarity_score, HEAD(COLLECT({file: f, rel: r})) AS owner "
+                     "ORDER BY similarity_score DESC LIMIT $limit_by "
+                     "RETURN c.text AS content, owner.rel.chunk_no AS chunk_no, owner.file.name AS origin_filename, "
+                     "owner.rel.chunk_create_ts AS chunk_create_ts, similarity_score")
+    return cypher_query, params
+
+
+# Vector similarity over the chunks of files uploaded by the user. Chunks are shared between users, ownership and
+# file filters are applied through the File relationships. Uses async embeddings and the async driver, must run on
+# the background loop of operations_async_runtime
+async def asearch_user_chunks(username, text, limit_by=4, filter_file_name=None, filter_date_from=None,
+                              filter_date_till=None):
+    embedding = await embeddings.aembed_query(text)
+    try:
+        cypher_query, params = _chunk_search_query(username, limit_by, filter_file_name, filter_date_from,
+                                                   filter_date_till)
+        chunks = await aquery(cypher_query, {**params, 'embedding': embedding})
+        # The nearest chunks may belong to other users or files, when too few are left the exact scan decides
+        if len(chunks) >= limit_by:
+            return chunks
+    except Exception as e:
+        # Index missing or not online while it is being rebuilt
+        print(f"[Vector Index Unavailable] {e}")
+    cypher_query, params = _chunk_search_query(username, limit_by, filter_file_name, filter_date_from,
+                                               filter_date_till, use_index=False)
+    return await aquery(cypher_query, {**params, 'embedding': embedding})
+
+
+class PreRetrieval:
+    def __init__(self, username, question, file_names, limit_by=PRE_RETRIEVAL_CHUNKS):
+        self.started = time.perf_counter()
+        self.file_names = file_names
+        self._future = asyncio.run_coroutine_threadsafe(
+            asearch_user_chunks(username, question, limit_by=limit_by, filter_file_name=file_names), get_loop())
+
+    # Waits for the search and returns the excerpts as JSON text, '' when nothing was found
+    def excerpts(self, timeout=PRE_RETRIEVAL_TIMEOUT_SECONDS):
+        wait_started = time.perf_counter()
+        try:
+            chunks = self._future.result(timeout=timeout)
+        except Exception as e:
+            self._future.cancel()
+            print(f"[Pre-retrieval Failed] {e}")
+            chunks = []
+        now = time.perf_counter()
+        # waited_ms is the part of the search not hidden behind prompt assembly
+        metrics = {"search_ms": round((now - self.started) * 1000), "waited_ms": round((now - wait_started) * 1000),
+                   "chunks": len(chunks)}
+        print(f"[Pre-retrieval] {metrics}")
+        return format_excerpts(chunks)
+
+
+# Excerpts as JSON text for excerpts_message, '' when nothing was found
+def format_excerpts(chunks):
+    if not chunks:
+        return ''
+    return json.dumps([{"origin_filename": chunk['origin_filename'], "chunk_no": chunk['chunk_no'],
+                        "content": chunk['content']} for chunk in chunks])
+
+
+def excerpts_message(excerpts):
+    return SystemMessage(content="Excerpts from the files placed in this session that are most related to the "
+                                 "user's latest message. Answer from them when they are sufficient, otherwise "
+                                 f"use the tools: {excerpts}")
+
+
+def placed_file_names(user_placed_files):
+    return [file['name'] for file in user_placed_files or [] if isinstance(file, dict) and 'name' in file]
+
+
+# Starts the search for the latest user message when the session has files and the prompt carries no excerpts yet
+def start_pre_retrieval(human_message, username):
+    if not PRE_RETRIEVAL or human_message.metadata.get('prefetched_excerpts'):
+        return None
+    file_names = placed_file_names(human_message.metadata.get('user_placed_files'))
+    if len(file_names) == 0:
+        return None
+    return PreRetrieval(username, human_message.metadata.get('user_query', human_message.content), file_names)
+
+
+def _words(text):
+    return [word.strip('.,!?;:"\'').lower() for word in text.split() if word.strip('.,!?;:"\'') != '']
+
+
+# Starts chunk searches on stable partial transcripts while the user is still speaking, the final transcript
+# reuses the latest search that matches it. Searches run on the background loop and share its driver. Like
+# pre-retrieval only the files placed in the session are searched, nothing is speculated without them
+class SpeculativeRetriever:
+    def __init__(self, username, file_names, limit_by=PRE_RETRIEVAL_CHUNKS):
+        self.username = username
+        self.file_names = file_names
+        self.limit_by = limit_by
+        self._speculations = []
+        self._lock = threading.Lock()
+        self.stats = {"started": 0, "used": 0, "missed": 0}
+
+    def speculate(self, text):
+        words = _words(text)
+        if len(words) == 0 or len(self.file_names) == 0:
+            return
+        with self._lock:
+            if len(self._speculations) > 0 and self._speculations[-1][0] == words:
+                return
+            self._speculations.append((words, asyncio.run_coroutine_threadsafe(
+                asearch_user_chunks(self.username, text, limit_by=self.limit_by, filter_file_name=self.file_names),
+                get_loop())))
+            self.stats['started'] += 1
+
+    def result_for(self, final_text):
+        final_words = _words(final_text)
+        with self._lock:
+            speculations = list(reversed(self._speculations))
+        for words, future in speculations:
+            if len(final_words) == 0 or final_words[:len(words)] != words \
+                    or len(words) / len(final_words) < SPECULATION_MIN_COVERAGE:
+                continue
+            try:
+                result = future.result(timeout=SPECULATION_WAIT_SECONDS)
+                self.stats['used'] += 1
+                return result
+            except FutureTimeoutError:
+                break
+            except Exception as e:
+                print(f"[Speculative Retrieval Failed] {e}")
+                break
+        self.stats['missed'] += 1
+        return None
+
+    def close(self):
+        with self._lock:
+            for _, future in self._speculations:
+                future.cancel()
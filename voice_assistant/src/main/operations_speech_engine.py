@@ -0,0 +1,219 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import azure.cognitiveservices.speech as speechsdk
+
+from operations_config import get_secret
+
+AZURE_SPEECH_KEY = get_secret('AZURE_SPEECH_KEY')
+AZURE_REGION = get_secret('AZURE_REGION')
+
+# mp3 | opus | wav, compressed formats are a fraction of the WAV size sent to the browser
+TTS_OUTPUT_FORMAT = get_secret('TTS_OUTPUT_FORMAT', 'mp3')
+_OUTPUT_FORMATS = {
+    'mp3': (speechsdk.SpeechSynthesisOutputFormat.Audio24Khz48KBitRateMonoMp3, 'audio/mpeg', '.mp3'),
+    'opus': (speechsdk.SpeechSynthesisOutputFormat.Ogg24Khz16BitMonoOpus, 'audio/ogg', '.ogg'),
+    'wav': (speechsdk.SpeechSynthesisOutputFormat.Riff24Khz16BitMonoPcm, 'audio/wav', '.wav'),
+}
+if TTS_OUTPUT_FORMAT not in _OUTPUT_FORMATS:
+    raise Exception(f'Unsupported TTS_OUTPUT_FORMAT {TTS_OUTPUT_FORMAT}, use one of {list(_OUTPUT_FORMATS)}')
+AUDIO_MIME_TYPE = _OUTPUT_FORMATS[TTS_OUTPUT_FORMAT][1]
+AUDIO_EXTENSION = _OUTPUT_FORMATS[TTS_OUTPUT_FORMAT][2]
+
+# Idle synthesizers kept per voice, concurrent segments beyond this create extra ones that are not kept
+SYNTHESIZER_POOL_SIZE = int(get_secret('SYNTHESIZER_POOL_SIZE', 3))
+# Synthesizers opened per voice at startup
+SYNTHESIZER_WARM_PER_VOICE = int(get_secret('SYNTHESIZER_WARM_PER_VOICE', 1))
+HEALTH_CHECK_INTERVAL_SECONDS = 60
+# Partial recognition results are only reported once they stayed the same for this many updates
+STABLE_PARTIAL_THRESHOLD = 3
+
+
+def create_speech_config():
+    speech_config = speechsdk.SpeechConfig(subscription=AZURE_SPEECH_KEY, region=AZURE_REGION)
+    speech_config.set_speech_synthesis_output_format(_OUTPUT_FORMATS[TTS_OUTPUT_FORMAT][0])
+    return speech_config
+
+
+class _PooledSynthesizer:
+    def __init__(self, synthesizer):
+        self.synthesizer = synthesizer
+        self.connection = speechsdk.Connection.from_speech_synthesizer(synthesizer)
+        self.connected = False
+        self.connection.connected.connect(self._on_connected)
+        self.connection.disconnected.connect(self._on_disconnected)
+        self.last_used = time.monotonic()
+
+    def _on_connected(self, evt):
+        self.connected = True
+
+    def _on_disconnected(self, evt):
+        self.connected = False
+
+    def open(self):
+        self.connection.open(True)
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception as e:
+            print(f"[Speech Engine] closing synthesizer failed {e}")
+
+
+# Keeps connected synthesizers per voice so an utterance does not pay connection setup before its first byte
+class SpeechEngine:
+    def __init__(self, pool_size=SYNTHESIZER_POOL_SIZE):
+        self.pool_size = pool_size
+        self._pools = {}
+        self._synthesis_configs = {}
+        self._recognition_configs = {}
+        self._lock = threading.Lock()
+        self._warmed = set()
+        self._health_thread = None
+        self.counters = {"cold_starts": 0, "warm_starts": 0, "failures": 0, "discarded": 0, "reconnected": 0}
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _pool(self, voice):
+        with self._lock:
+            if voice not in self._pools:
+                self._pools[voice] = queue.LifoQueue()
+                speech_config = create_speech_config()
+                speech_config.speech_synthesis_voice_name = voice
+                self._synthesis_configs[voice] = speech_config
+            return self._pools[voice]
+
+    def _create(self, voice):
+        self._pool(voice)
+        pooled = _PooledSynthesizer(speechsdk.SpeechSynthesizer(speech_config=self._synthesis_configs[voice],
+                                                                audio_config=None))
+        pooled.open()
+        return pooled
+
+    @contextmanager
+    def synthesizer(self, voice):
+        pool = self._pool(voice)
+        try:
+            pooled = pool.get_nowait()
+        except queue.Empty:
+            pooled = None
+        if pooled is not None and pooled.connected:
+            self._count('warm_starts')
+        else:
+            self._count('cold_starts')
+            if pooled is not None:
+                # The service closed the idle connection, it is reopened before use or replaced if that fails
+                try:
+                    pooled.open()
+                    self._count('reconnected')
+                except Exception as e:
+                    print(f"[Speech Engine] reconnect failed {e}")
+                    self._count('discarded')
+                    pooled.close()
+                    pooled = None
+            if pooled is None:
+                pooled = self._create(voice)
+
+        try:
+            yield pooled.synthesizer
+        except Exception:
+            # A synthesizer that failed is not reused
+            self._count('failures')
+            pooled.close()
+            raise
+        pooled.last_used = time.monotonic()
+        if pool.qsize() < self.pool_size:
+            pool.put(pooled)
+        else:
+            self._count('discarded')
+            pooled.close()
+
+    # Opens synthesizers for the given voices in the background, repeated calls only warm new voices
+    def warm_up(self, voices, per_voice=SYNTHESIZER_WARM_PER_VOICE):
+        with self._lock:
+            voices = [voice for voice in dict.fromkeys(voices) if voice not in self._warmed]
+            self._warmed.update(voices)
+            start_health_check = self._health_thread is None
+            if start_health_check:
+                self._health_thread = threading.Thread(target=self._health_loop, name='speech-health', daemon=True)
+
+        def warm():
+            for voice in voices:
+                pool = self._pool(voice)
+                while pool.qsize() < min(per_voice, self.pool_size):
+                    try:
+                        pool.put(self._create(voice))
+                    except Exception as e:
+                        print(f"[Speech Engine] warm up of {voice} failed {e}")
+                        break
+
+        if len(voices) > 0:
+            threading.Thread(target=warm, name='speech-warm-up', daemon=True).start()
+        if start_health_check:
+            self._health_thread.start()
+
+    # Reopens idle synthesizers whose connection the service has closed, broken ones are dropped
+    def health_check(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            idle = []
+            while True:
+                try:
+                    idle.append(pool.get_nowait())
+                except queue.Empty:
+                    break
+            for pooled in idle:
+                if not pooled.connected:
+                    try:
+                        pooled.open()
+                        self._count('reconnected')
+                    except Exception as e:
+                        print(f"[Speech Engine] reconnect failed {e}")
+                        self._count('discarded')
+                        continue
+                pool.put(pooled)
+        return self.stats
+
+    def _health_loop(self):
+        while True:
+            time.sleep(HEALTH_CHECK_INTERVAL_SECONDS)
+            try:
+                self.health_check()
+            except Exception as e:
+                print(f"[Speech Engine] health check failed {e}")
+
+    def recognition_config(self, language):
+        with self._lock:
+            if language not in self._recognition_configs:
+                speech_config = speechsdk.SpeechConfig(subscription=AZURE_SPEECH_KEY, region=AZURE_REGION)
+                speech_config.speech_recognition_language = language
+                speech_config.set_property(speechsdk.PropertyId.SpeechServiceResponse_StablePartialResultThreshold,
+                                           str(STABLE_PARTIAL_THRESHOLD))
+                self._recognition_configs[language] = speech_config
+            return self._recognition_configs[language]
+
+    # Recognizers are bound to their audio input and cannot be pooled, the connection is opened right away so
+    # it is ready by the time the first audio arrives
+    def create_recognizer(self, language, audio_config):
+        recognizer = speechsdk.SpeechRecognizer(speech_config=self.recognition_config(language),
+                                                audio_config=audio_config)
+        try:
+            speechsdk.Connection.from_recognizer(recognizer).open(False)
+        except Exception as e:
+            print(f"[Speech Engine] recognizer pre-connect failed {e}")
+        return recognizer
+
+    @property
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['idle'] = {voice: pool.qsize() for voice, pool in self._pools.items()}
+        return stats
+
+
+speech_engine = SpeechEngine()
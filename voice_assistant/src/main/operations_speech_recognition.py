@@ -0,0 +1,242 @@
+# Continuous speech recognition with partial results. Audio comes from the default microphone, a push stream of
+# PCM bytes, or a WAV file. Headless benchmark with a recorded file and the local stand-in recognizer:
+#   python operations_speech_recognition.py --wav question.wav --stand-in "what does the report say about revenue"
+import argparse
+import io
+import json
+import queue
+import time
+import wave
+
+import azure.cognitiveservices.speech as speechsdk
+
+from operations_speech_engine import speech_engine
+
+# Speculation starts once the stable words reach this length and again every few new words
+SPECULATION_MIN_WORDS = 4
+SPECULATION_STEP_WORDS = 3
+CHUNK_MILLISECONDS = 100
+
+
+class AzureRecognitionBackend:
+    def __init__(self, language, microphone=False, sample_rate=16000, bits_per_sample=16, channels=1):
+        if microphone:
+            self.push_stream = None
+            audio_config = speechsdk.AudioConfig(use_default_microphone=True)
+        else:
+            stream_format = speechsdk.audio.AudioStreamFormat(samples_per_second=sample_rate,
+                                                              bits_per_sample=bits_per_sample, channels=channels)
+            self.push_stream = speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
+            audio_config = speechsdk.audio.AudioConfig(stream=self.push_stream)
+        self.recognizer = speech_engine.create_recognizer(language, audio_config)
+
+    def bind(self, on_partial, on_final, on_stopped):
+        def recognized(evt):
+            if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech and evt.result.text != '':
+                on_final(evt.result.text)
+
+        def canceled(evt):
+            details = evt.cancellation_details
+            # End of a push stream also arrives as a cancellation
+            on_stopped(details.error_details if details.reason == speechsdk.CancellationReason.Error else None)
+
+        self.recognizer.recognizing.connect(lambda evt: on_partial(evt.result.text))
+        self.recognizer.recognized.connect(recognized)
+        self.recognizer.session_stopped.connect(lambda evt: on_stopped(None))
+        self.recognizer.canceled.connect(canceled)
+
+    def start(self):
+        self.recognizer.start_continuous_recognition_async().get()
+
+    def write(self, data):
+        self.push_stream.write(data)
+
+    # No more audio, the service finishes what it has and ends the session
+    def close(self):
+        if self.push_stream is not None:
+            self.push_stream.close()
+
+    def stop(self):
+        self.recognizer.stop_continuous_recognition_async().get()
+
+
+# Local stand-in with the same events, reveals a known transcript at speaking pace as audio is written. Used to
+# drive and benchmark the pipeline without the speech service
+class StandInRecognitionBackend:
+    def __init__(self, transcript, sample_rate=16000, bits_per_sample=16, channels=1, words_per_second=2.5):
+        self.words = transcript.split()
+        self.bytes_per_second = sample_rate * bits_per_sample // 8 * channels
+        self.words_per_second = words_per_second
+        self._audio_bytes = 0
+        self._revealed = 0
+        self._stopped = False
+
+    def bind(self, on_partial, on_final, on_stopped):
+        self._on_partial, self._on_final, self._on_stopped = on_partial, on_final, on_stopped
+
+    def start(self):
+        pass
+
+    def write(self, data):
+        self._audio_bytes += len(data)
+        revealed = min(len(self.words), int(self._audio_bytes / self.bytes_per_second * self.words_per_second))
+        if revealed > self._revealed:
+            self._revealed = revealed
+            self._on_partial(' '.join(self.words[:revealed]))
+
+    def close(self):
+        if len(self.words) > 0:
+            self._on_final(' '.join(self.words))
+        self.stop()
+
+    def stop(self):
+        if not self._stopped:
+            self._stopped = True
+            self._on_stopped(None)
+
+
+# Collects events of a backend into a queue the caller (e.g. the Streamlit script thread) reads from, and calls
+# on_stable_partial as the stable part of the utterance grows
+class StreamingRecognition:
+    def __init__(self, backend, on_stable_partial=None):
+        self.backend = backend
+        self.on_stable_partial = on_stable_partial
+        self.events = queue.Queue()
+        self.final_segments = []
+        self._previous_words = []
+        self._speculated_words = 0
+        self.started = None
+        self.first_partial_at = None
+        self.final_at = None
+        self.error = None
+        backend.bind(self._partial, self._final, self._stopped)
+
+    def _partial(self, text):
+        if self.first_partial_at is None:
+            self.first_partial_at = time.perf_counter()
+        words = (' '.join(self.final_segments + [text])).split()
+        # Words shared with the previous hypothesis are not revised any more
+        stable = 0
+        while stable < min(len(words), len(self._previous_words)) and words[stable] == self._previous_words[stable]:
+            stable += 1
+        self._previous_words = words
+        if self.on_stable_partial is not None and stable >= SPECULATION_MIN_WORDS \
+                and stable - self._speculated_words >= SPECULATION_STEP_WORDS:
+            self._speculated_words = stable
+            try:
+                self.on_stable_partial(' '.join(words[:stable]))
+            except Exception as e:
+                print(f"[Speculation Failed] {e}")
+        self.events.put(('partial', ' '.join(words)))
+
+    def _final(self, text):
+        self.final_segments.append(text)
+        self.final_at = time.perf_counter()
+        self._previous_words = self.transcript.split()
+        self.events.put(('final', text))
+
+    def _stopped(self, error):
+        if error is not None:
+            self.error = error
+        self.events.put(('stopped', error))
+
+    @property
+    def transcript(self):
+        return ' '.join(self.final_segments)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.backend.start()
+        return self
+
+    def write(self, data):
+        self.backend.write(data)
+
+    def close(self):
+        self.backend.close()
+
+    def stop(self):
+        self.backend.stop()
+
+    # Yields (kind, text) events until the session stops, stop_after_final ends after the first complete phrase
+    def iter_events(self, timeout=30, stop_after_final=False):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                kind, text = self.events.get(timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Empty:
+                self.stop()
+                return
+            if kind == 'stopped':
+                return
+            yield kind, text
+            if kind == 'final' and stop_after_final:
+                self.stop()
+                return
+
+    @property
+    def metrics(self):
+        def since_start(moment):
+            return round((moment - self.started) * 1000) if moment is not None and self.started is not None else None
+        return {"first_partial_ms": since_start(self.first_partial_at), "final_ms": since_start(self.final_at),
+                "segments": len(self.final_segments)}
+
+
+def open_wav(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    wav = wave.open(source, 'rb')
+    if wav.getsampwidth() != 2:
+        raise Exception('Only 16-bit PCM WAV audio is supported')
+    return wav
+
+
+# Streams PCM chunks into the recognition, realtime paces them like a live microphone
+def feed_audio(recognition, chunks, bytes_per_second=None, realtime=False):
+    for chunk in chunks:
+        recognition.write(chunk)
+        if realtime and bytes_per_second:
+            time.sleep(len(chunk) / bytes_per_second)
+    recognition.close()
+
+
+def wav_chunks(wav, chunk_milliseconds=CHUNK_MILLISECONDS):
+    frames = max(wav.getframerate() * chunk_milliseconds // 1000, 1)
+    while True:
+        data = wav.readframes(frames)
+        if len(data) == 0:
+            return
+        yield data
+
+
+def recognize_wav(source, language='en-US', stand_in_transcript=None, on_stable_partial=None, realtime=False):
+    with open_wav(source) as wav:
+        audio_format = {"sample_rate": wav.getframerate(), "bits_per_sample": 16, "channels": wav.getnchannels()}
+        if stand_in_transcript is not None:
+            backend = StandInRecognitionBackend(stand_in_transcript, **audio_format)
+        else:
+            backend = AzureRecognitionBackend(language, **audio_format)
+        recognition = StreamingRecognition(backend, on_stable_partial=on_stable_partial).start()
+        feed_audio(recognition, wav_chunks(wav), audio_format['sample_rate'] * 2 * audio_format['channels'], realtime)
+        events = list(recognition.iter_events())
+    return recognition, events
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recognize a WAV file with partial results')
+    parser.add_argument('--wav', required=True, help='16-bit PCM WAV file')
+    parser.add_argument('--language', default='en-US')
+    parser.add_argument('--stand-in', default=None, help='Transcript for the local stand-in recognizer')
+    parser.add_argument('--realtime', action='store_true', help='Feed audio at speaking pace')
+    args = parser.parse_args()
+
+    speculations = []
+    recognition, events = recognize_wav(args.wav, language=args.language, stand_in_transcript=args.stand_in,
+                                        on_stable_partial=speculations.append, realtime=args.realtime)
+    partials = sum(1 for kind, _ in events if kind == 'partial')
+    print(json.dumps({"transcript": recognition.transcript, "partials": partials, "speculations": speculations,
+                      "error": recognition.error, **recognition.metrics}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
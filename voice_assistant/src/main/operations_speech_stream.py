@@ -0,0 +1,183 @@
+import io
+import re
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import azure.cognitiveservices.speech as speechsdk
+
+from operations_config import get_secret
+from operations_speech_engine import speech_engine, TTS_OUTPUT_FORMAT
+from operations_tts_cache import audio_cache
+from operations_voices import build_ssml, detect_emotion
+
+# Speak sentences while the reply is still being generated, set to false to synthesize the whole reply at the end
+STREAMING_TTS = str(get_secret('STREAMING_TTS', 'true')).lower() == 'true'
+# Sentences shorter than this are joined with the next one, very short segments sound choppy
+MIN_SEGMENT_CHARS = 40
+SYNTHESIS_WORKERS = 3
+# Concurrent requests per segmented synthesis
+SEGMENT_SYNTHESIS_WORKERS = 4
+
+# Sentence end followed by whitespace, or a line break (list items, paragraphs)
+_SENTENCE_END = re.compile(r'(?<=[.!?;:।。！？])\s+|\n+')
+
+
+class SentenceSplitter:
+    def __init__(self, min_chars=MIN_SEGMENT_CHARS):
+        self.min_chars = min_chars
+        self._pending = ''
+
+    # Returns sentences completed by the new text, the unfinished tail is kept for the next call
+    def feed(self, text):
+        self._pending += text
+        sentences = []
+        start = 0
+        for match in _SENTENCE_END.finditer(self._pending):
+            if match.start() - start >= self.min_chars:
+                sentences.append(self._pending[start:match.start()].strip())
+                start = match.end()
+        self._pending = self._pending[start:]
+        return [sentence for sentence in sentences if sentence != '']
+
+    def flush(self):
+        rest, self._pending = self._pending.strip(), ''
+        return [rest] if rest != '' else []
+
+    def discard(self):
+        self._pending = ''
+
+
+def synthesize_ssml(voice, ssml):
+    with speech_engine.synthesizer(voice) as synthesizer:
+        result = synthesizer.speak_ssml_async(ssml).get()
+        if result.reason != speechsdk.ResultReason.SynthesizingAudioCompleted:
+            raise Exception(f'Speech synthesis failed: {result.reason}')
+        return result.audio_data
+
+
+# Cached synthesis of one segment, returns the audio and whether it came from the cache
+def synthesize_text(text, voice='en-US-JennyNeural', rate='medium', pitch='default',
+                    volume='default', style='friendly'):
+    key = audio_cache.key(text, voice, style, rate, pitch, volume, TTS_OUTPUT_FORMAT)
+    audio_data = audio_cache.get(key)
+    if audio_data is not None:
+        return audio_data, True
+    ssml = build_ssml(text, voice=voice, rate=rate, pitch=pitch, volume=volume, style=style)
+    audio_data = synthesize_ssml(voice, ssml)
+    audio_cache.put(key, audio_data)
+    return audio_data, False
+
+
+# Concatenates WAV segments of the same format into one stream with a single header
+def join_wav(segments):
+    if len(segments) == 1:
+        return segments[0]
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as joined:
+        for index, segment in enumerate(segments):
+            with wave.open(io.BytesIO(segment), 'rb') as part:
+                if index == 0:
+                    joined.setparams(part.getparams())
+                joined.writeframes(part.readframes(part.getnframes()))
+    return output.getvalue()
+
+
+def join_audio(segments):
+    if TTS_OUTPUT_FORMAT == 'wav':
+        return join_wav(segments)
+    # MP3 frames and chained Ogg pages play back to back when concatenated
+    return b''.join(segments)
+
+
+# Synthesizes text segments concurrently and reassembles the audio in segment order
+def synthesize_segments(segments, max_workers=SEGMENT_SYNTHESIS_WORKERS, **ssml_options):
+    def timed_synthesis(text):
+        started = time.perf_counter()
+        audio_data, cached = synthesize_text(text, **ssml_options)
+        return audio_data, cached, round((time.perf_counter() - started) * 1000)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tts-segment') as executor:
+        results = [future.result() for future in [executor.submit(timed_synthesis, text) for text in segments]]
+    timings = [{"segment": index, "ms": ms, "bytes": len(audio_data), "cached": cached}
+               for index, (audio_data, cached, ms) in enumerate(results)]
+    return join_audio([audio_data for audio_data, _, _ in results]), timings
+
+
+# Synthesizes sentences as soon as they are complete, audio is handed back strictly in sentence order
+class SpeechPipeline:
+    def __init__(self, user_query, voice='en-US-JennyNeural', rate='medium', pitch='default', volume='default'):
+        self.user_query = user_query
+        self.voice = voice
+        self.rate = rate
+        self.pitch = pitch
+        self.volume = volume
+        self.splitter = SentenceSplitter()
+        self._executor = ThreadPoolExecutor(max_workers=SYNTHESIS_WORKERS, thread_name_prefix='tts')
+        self._style = None
+        self._segments = []
+        self._next_segment = 0
+        self.started = time.perf_counter()
+        self.first_audio_at = None
+
+    def _synthesize(self, text):
+        audio_data, _ = synthesize_text(text, voice=self.voice, rate=self.rate, pitch=self.pitch, volume=self.volume,
+                                        style=self._style.result())
+        return audio_data
+
+    def _submit(self, sentences):
+        for sentence in sentences:
+            # Style is detected once from the first sentence so the whole reply keeps one voice
+            if self._style is None:
+                self._style = self._executor.submit(detect_emotion, sentence, self.user_query)
+            self._segments.append(self._executor.submit(self._synthesize, sentence))
+
+    def _collect(self, wait):
+        audio = []
+        while self._next_segment < len(self._segments):
+            future = self._segments[self._next_segment]
+            if not wait and not future.done():
+                break
+            self._next_segment += 1
+            try:
+                audio.append(future.result())
+            except Exception as e:
+                print(f"[Speech Segment Failed] {e}")
+        if len(audio) > 0 and self.first_audio_at is None:
+            self.first_audio_at = time.perf_counter()
+        return audio
+
+    # Feeds reply tokens and returns audio of every segment that is ready, without blocking
+    def feed(self, text):
+        self._submit(self.splitter.feed(text))
+        return self._collect(wait=False)
+
+    # Text streamed ahead of a tool call is not spoken, sentences already submitted are cancelled or skipped
+    def discard(self):
+        self.splitter.discard()
+        for future in self._segments[self._next_segment:]:
+            future.cancel()
+        self._next_segment = len(self._segments)
+
+    # Synthesizes the remaining text and returns all outstanding audio in order
+    def finish(self):
+        self._submit(self.splitter.flush())
+        audio = self._collect(wait=True)
+        self.close()
+        return audio
+
+    # Stops the synthesis threads, sentences not started yet are dropped
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def time_to_first_audio_ms(self):
+        if self.first_audio_at is None:
+            return None
+        return round((self.first_audio_at - self.started) * 1000)
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from operations_config import get_secret
+
+# Served by Streamlit at app/static/ (server.enableStaticServing), must sit next to the app script
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+STATIC_URL_PREFIX = 'app/static'
+# Files not written or reused for this long are removed
+STATIC_TTL_SECONDS = int(get_secret('STATIC_TTL_SECONDS', 24 * 60 * 60))
+CLEANUP_INTERVAL_SECONDS = 10 * 60
+THUMBNAIL_SIZE = (480, 480)
+
+
+# Generated audio and images written once under the hash of their content, pages only carry links to them
+class StaticStore:
+    def __init__(self, directory=STATIC_DIR, url_prefix=STATIC_URL_PREFIX, ttl_seconds=STATIC_TTL_SECONDS):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.ttl_seconds = ttl_seconds
+        self._last_cleanup = 0.0
+        self._lock = threading.Lock()
+        for folder in ('audio', 'images'):
+            os.makedirs(os.path.join(directory, folder), exist_ok=True)
+
+    def put(self, data, folder, extension):
+        name = f"{hashlib.sha256(data).hexdigest()[:32]}{extension}"
+        path = os.path.join(self.directory, folder, name)
+        if os.path.exists(path):
+            # Same content again, only its TTL is renewed
+            os.utime(path)
+        else:
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        self._schedule_cleanup()
+        return f"{self.url_prefix}/{folder}/{name}"
+
+    def put_audio(self, audio_data, extension):
+        return self.put(audio_data, 'audio', extension)
+
+    # Returns links to the image and to a thumbnail of it
+    def put_image(self, image_bytes):
+        image = Image.open(BytesIO(image_bytes))
+        extension = '.png' if image.format == 'PNG' else '.jpg'
+        url = self.put(image_bytes, 'images', extension)
+
+        image.thumbnail(THUMBNAIL_SIZE)
+        thumbnail = BytesIO()
+        if extension == '.png':
+            image.save(thumbnail, format='PNG', optimize=True)
+        else:
+            image.convert('RGB').save(thumbnail, format='JPEG', quality=80)
+        thumbnail_url = self.put(thumbnail.getvalue(), 'images', extension)
+        return url, thumbnail_url
+
+    def _schedule_cleanup(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_cleanup < CLEANUP_INTERVAL_SECONDS:
+                return
+            self._last_cleanup = now
+        threading.Thread(target=self.cleanup, name='static-cleanup', daemon=True).start()
+
+    def cleanup(self):
+        expire_before = time.time() - self.ttl_seconds
+        removed = 0
+        for folder in ('audio', 'images'):
+            folder_path = os.path.join(self.directory, folder)
+            for name in os.listdir(folder_path):
+                path = os.path.join(folder_path, name)
+                try:
+                    if os.path.getmtime(path) < expire_before:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        if removed > 0:
+            print(f"[Static Store] removed {removed} expired files")
+        return removed
+
+
+static_store = StaticStore()
@@ -0,0 +1,90 @@
+import codecs
+import mmap
+from contextlib import contextmanager
+
+from charset_normalizer import from_bytes
+
+TEXT_FILE_EXTENSIONS = ('.txt', '.md', '.log')
+
+# Bytes inspected for encoding detection, the rest of the file is never scanned up front
+ENCODING_PROBE_SIZE = 64 * 1024
+# Bytes decoded per step while walking the mapped file
+DECODE_STEP_SIZE = 1024 * 1024
+
+_BOMS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+
+def is_text_file(file):
+    return file.lower().endswith(TEXT_FILE_EXTENSIONS)
+
+
+def detect_encoding(prefix):
+    prefix = bytes(prefix)
+    for bom, encoding in _BOMS:
+        if prefix.startswith(bom):
+            return encoding
+
+    # Probe may end in the middle of a multibyte character, charset_normalizer tolerates that
+    best_match = from_bytes(prefix).best()
+    if best_match is None:
+        return 'utf-8'
+    return best_match.encoding
+
+
+@contextmanager
+def open_text_buffer(file):
+    # Map the file read-only so pages are loaded lazily by the OS instead of into a Python string
+    with open(file, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            yield b''
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            mapped.close()
+
+
+def _split_point(text, start, chunk_size):
+    # Prefer paragraph boundary, then line boundary, then a hard cut
+    end = start + chunk_size
+    cut = text.rfind('\n\n', start, end)
+    if cut > start:
+        return cut + 2
+    cut = text.rfind('\n', start, end)
+    if cut > start:
+        return cut + 1
+    return end
+
+
+# Yields chunks of at most chunk_size characters from a bytes-like buffer (mmap, memoryview, bytes).
+# Decoding is incremental, so only one decode step plus one chunk is held in memory at a time.
+def iter_text_chunks(buffer, chunk_size=2000):
+    if len(buffer) == 0:
+        return
+
+    encoding = detect_encoding(buffer[:ENCODING_PROBE_SIZE])
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    pending = ''
+
+    for offset in range(0, len(buffer) + 1, DECODE_STEP_SIZE):
+        final = offset + DECODE_STEP_SIZE >= len(buffer)
+        pending += decoder.decode(buffer[offset:offset + DECODE_STEP_SIZE], final=final)
+
+        # Walk the decoded step with a cursor so the pending text is only re-sliced once per step
+        position = 0
+        while len(pending) - position > chunk_size or (final and position < len(pending)):
+            cut = _split_point(pending, position, chunk_size)
+            chunk = pending[position:cut].strip()
+            position = cut
+            if chunk:
+                yield chunk
+        pending = pending[position:]
+        if final:
+            break
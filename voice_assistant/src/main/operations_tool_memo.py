@@ -0,0 +1,151 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from langchain_core.messages import ToolMessage
+from langchain_core.runnables import RunnableConfig
+
+from operations_async_runtime import run_async
+from operations_config import get_secret
+from operations_query_cache import query_cache, QUERY_CACHE_TTL_SECONDS
+
+# Results kept per conversation and number of conversations kept, least recently used are dropped first
+TOOL_MEMO_MAX_ENTRIES = int(get_secret('TOOL_MEMO_MAX_ENTRIES', 32))
+TOOL_MEMO_MAX_CONVERSATIONS = int(get_secret('TOOL_MEMO_MAX_CONVERSATIONS', 256))
+# Data a tool reads, its generation in the query cache is part of the memo key so writes invalidate results
+TOOL_DATA_DOMAINS = {
+    'file-filter-search': 'files',
+    'previous-chat-filter-search': 'chats',
+}
+
+
+def _normalise_value(value):
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, (list, tuple)):
+        values = [_normalise_value(item) for item in value]
+        # File name filters are sets, their order does not change the result
+        return sorted(values, key=str)
+    return value
+
+
+# Arguments as the model may call them: schema defaults filled in, unset values dropped, injected state excluded
+def normalise_args(tool, args):
+    fields = tool.tool_call_schema.model_fields
+    normalised = {}
+    for name, field in fields.items():
+        value = args.get(name, field.default)
+        if value is not None:
+            normalised[name] = _normalise_value(value)
+    return json.dumps(normalised, sort_keys=True, default=str)
+
+
+# Successful tool results per conversation, keyed by (tool name, normalised args, user, data generation)
+class ToolMemo:
+    def __init__(self, max_entries=TOOL_MEMO_MAX_ENTRIES, max_conversations=TOOL_MEMO_MAX_CONVERSATIONS,
+                 ttl_seconds=QUERY_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.max_conversations = max_conversations
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(tool, args, user_details):
+        domain = TOOL_DATA_DOMAINS.get(tool.name)
+        # Admin searches read every user's data
+        scope = None if user_details['role'] == 'Admin' else user_details['username']
+        generation = query_cache.generation(domain, scope) if domain is not None else None
+        return tool.name, normalise_args(tool, args), user_details['username'], generation
+
+    def get(self, thread_id, key):
+        with self._lock:
+            entries = self._conversations.get(thread_id)
+            entry = entries.get(key) if entries is not None else None
+            if entry is None or time.monotonic() - entry[0] >= self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._conversations.move_to_end(thread_id)
+            entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, thread_id, key, content):
+        with self._lock:
+            entries = self._conversations.setdefault(thread_id, OrderedDict())
+            self._conversations.move_to_end(thread_id)
+            entries[key] = (time.monotonic(), content)
+            entries.move_to_end(key)
+            if len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            if len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+
+    @property
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_ratio": round(self.hits / requests, 3) if requests > 0 else None,
+                    "conversations": len(self._conversations)}
+
+
+tool_memo = ToolMemo()
+
+
+# Each pending call goes through the ToolNode on its own so it can be timed, the calls run concurrently
+async def _arun_calls(tool_node, state, ai_message, tool_calls, config):
+    async def run_one(tool_call):
+        started = time.perf_counter()
+        single_state = {**state, "messages": state["messages"][:-1]
+                        + [ai_message.model_copy(update={"tool_calls": [tool_call]})]}
+        messages = (await tool_node.ainvoke(single_state, config))["messages"]
+        for message in messages:
+            message.response_metadata['duration_ms'] = round((time.perf_counter() - started) * 1000)
+        return messages
+
+    return [message for messages in await asyncio.gather(*(run_one(tool_call) for tool_call in tool_calls))
+            for message in messages]
+
+
+# Graph node in place of the ToolNode: repeated calls are answered from the memo without running the tool, the
+# remaining calls run concurrently on the background loop, so the step takes as long as its slowest call
+def memoised_tools(state, config: RunnableConfig, tool_node, tools_by_name):
+    step_started = time.perf_counter()
+    thread_id = config.get('configurable', {}).get('thread_id')
+    user_details = config.get('configurable', {}).get('user_details')
+    ai_message = state["messages"][-1]
+
+    results = {}
+    keys = {}
+    pending_calls = []
+    for tool_call in ai_message.tool_calls:
+        tool = tools_by_name.get(tool_call['name'])
+        if tool is None or thread_id is None or user_details is None:
+            pending_calls.append(tool_call)
+            continue
+        keys[tool_call['id']] = ToolMemo.key(tool, tool_call['args'], user_details)
+        content = tool_memo.get(thread_id, keys[tool_call['id']])
+        if content is None:
+            pending_calls.append(tool_call)
+        else:
+            results[tool_call['id']] = ToolMessage(content=content, name=tool_call['name'],
+                                                   tool_call_id=tool_call['id'],
+                                                   response_metadata={"duration_ms": 0, "memoised": True})
+
+    if len(pending_calls) > 0:
+        for message in run_async(_arun_calls(tool_node, state, ai_message, pending_calls, config)):
+            results[message.tool_call_id] = message
+            # Failed calls are retried for real next time
+            if message.tool_call_id in keys and getattr(message, 'status', 'success') != 'error':
+                tool_memo.put(thread_id, keys[message.tool_call_id], message.content)
+
+    messages = [results[tool_call['id']] for tool_call in ai_message.tool_calls if tool_call['id'] in results]
+    timings = {message.tool_call_id: (message.name, message.response_metadata.get('duration_ms'))
+               for message in messages}
+    print(f"[Tool timing] step {round((time.perf_counter() - step_started) * 1000)} ms, calls {timings}")
+    return {"messages": messages}
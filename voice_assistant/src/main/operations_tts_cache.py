@@ -0,0 +1,91 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from operations_config import get_secret
+
+TTS_CACHE_DIR = get_secret('TTS_CACHE_DIR', os.path.join('tmp', 'voice_assistant_tts_cache'))
+# Least recently used audio is removed once the cache grows past this size
+TTS_CACHE_MAX_BYTES = int(get_secret('TTS_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+
+
+# Synthesized audio on disk, one file per (text, voice, style, prosody, format). File mtime is the recency,
+# so the LRU order survives restarts
+class AudioCache:
+    def __init__(self, directory=TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # key -> size, oldest first
+        self._entries = OrderedDict()
+        self._size = 0
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._size += size
+
+    @staticmethod
+    def key(text, voice, style, rate, pitch, volume, output_format):
+        return hashlib.sha256('\0'.join(
+            str(part) for part in (text, voice, style, rate, pitch, volume, output_format)).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            with open(self._path(key), 'rb') as f:
+                audio_data = f.read()
+            os.utime(self._path(key))
+            return audio_data
+        except FileNotFoundError:
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+            return None
+
+    def put(self, key, audio_data):
+        # Write then rename so a reader never sees a partial file
+        temp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(audio_data)
+        os.replace(temp_path, self._path(key))
+
+        evicted = []
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+            self._entries[key] = len(audio_data)
+            self._size += len(audio_data)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                evicted_key, size = self._entries.popitem(last=False)
+                self._size -= size
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            try:
+                os.remove(self._path(evicted_key))
+            except FileNotFoundError:
+                pass
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._size}
+
+
+audio_cache = AudioCache()
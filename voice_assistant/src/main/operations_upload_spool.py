@@ -0,0 +1,190 @@
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from operations_config import get_secret
+
+# Uploads up to this size are handed to ingestion straight from the uploader's memory, larger ones go to disk
+SPOOL_MEMORY_LIMIT = int(get_secret('UPLOAD_SPOOL_MEMORY_LIMIT', 8 * 1024 * 1024))
+# Bytes a single user may have spooled at the same time, across all running jobs
+USER_UPLOAD_QUOTA = int(get_secret('UPLOAD_USER_QUOTA', 1024 * 1024 * 1024))
+COPY_CHUNK_SIZE = 1024 * 1024
+# Job directories older than this are left over from a crashed process and removed on startup
+STALE_JOB_SECONDS = 6 * 60 * 60
+
+SPOOL_ROOT = os.path.join(tempfile.gettempdir(), 'voice_assistant_uploads')
+
+
+class UploadQuotaExceeded(Exception):
+    pass
+
+
+def _source_size(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    if hasattr(source, 'size'):
+        return source.size
+    position = source.tell()
+    size = source.seek(0, 2)
+    source.seek(position)
+    return size
+
+
+class SpooledUpload:
+    def __init__(self, name, job_dir, index=0):
+        self.name = os.path.basename(name.replace('\\', '/'))
+        self.size = 0
+        # Every upload of a job gets its own directory, uploads with the same name do not overwrite each other and
+        # the file keeps its name for the loaders
+        self._upload_dir = os.path.join(job_dir, str(index))
+        self._memory = None
+        self._path = None
+
+    def spool(self, source, size):
+        self.size = size
+        if size <= SPOOL_MEMORY_LIMIT:
+            # Zero-copy view over the uploader's buffer (Streamlit UploadedFile is a BytesIO)
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                self._memory = memoryview(source)
+                return
+            if hasattr(source, 'getbuffer'):
+                self._memory = source.getbuffer()
+                return
+
+        # Large upload, copy to disk in fixed size chunks so only one chunk is held in memory
+        self._path = self._spool_path()
+        with open(self._path, 'wb') as f:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                view = memoryview(source)
+                for offset in range(0, len(view), COPY_CHUNK_SIZE):
+                    f.write(view[offset:offset + COPY_CHUNK_SIZE])
+            else:
+                source.seek(0)
+                while chunk := source.read(COPY_CHUNK_SIZE):
+                    f.write(chunk)
+
+    def _spool_path(self):
+        os.makedirs(self._upload_dir, exist_ok=True)
+        return os.path.join(self._upload_dir, self.name)
+
+    @property
+    def in_memory(self):
+        return self._memory is not None
+
+    # Loaders that only accept file paths (PyMuPDF, unstructured) get a file materialised on first access
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = self._spool_path()
+            with open(self._path, 'wb') as f:
+                f.write(self._memory)
+        return self._path
+
+    # Read-only view of the contents: memoryview for in-memory uploads, mmap for spooled files
+    @contextmanager
+    def buffer(self):
+        if self._memory is not None:
+            yield self._memory
+            return
+        with open(self._path, 'rb') as f:
+            if self.size == 0:
+                yield b''
+                return
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield mapped
+            finally:
+                mapped.close()
+
+    def release(self):
+        if self._memory is not None:
+            try:
+                self._memory.release()
+            except BufferError:
+                # A view is still exported, it is freed with the last reference instead
+                pass
+            self._memory = None
+
+
+class UploadJob:
+    def __init__(self, spool, username, job_dir):
+        self.username = username
+        self.uploads = []
+        self._spool = spool
+        self._job_dir = job_dir
+        self._reserved = 0
+
+    def add(self, name, source):
+        size = _source_size(source)
+        self._spool.reserve(self.username, size)
+        self._reserved += size
+        upload = SpooledUpload(name, self._job_dir, len(self.uploads))
+        upload.spool(source, size)
+        self.uploads.append(upload)
+        return upload
+
+    def close(self):
+        for upload in self.uploads:
+            upload.release()
+        self.uploads = []
+        shutil.rmtree(self._job_dir, ignore_errors=True)
+        self._spool.release(self.username, self._reserved)
+        self._reserved = 0
+
+
+class UploadSpool:
+    def __init__(self, root=SPOOL_ROOT, user_quota=USER_UPLOAD_QUOTA):
+        self.root = root
+        self.user_quota = user_quota
+        self._usage = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self.remove_stale_jobs()
+
+    def remove_stale_jobs(self):
+        now = time.time()
+        for name in os.listdir(self.root):
+            job_dir = os.path.join(self.root, name)
+            try:
+                if now - os.path.getmtime(job_dir) > STALE_JOB_SECONDS:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+            except OSError:
+                pass
+
+    def reserve(self, username, size):
+        with self._lock:
+            used = self._usage.get(username, 0)
+            if used + size > self.user_quota:
+                raise UploadQuotaExceeded(
+                    f'Upload quota exceeded: {round((used + size) / (1024 * 1024), 1)} MB requested, '
+                    f'limit is {round(self.user_quota / (1024 * 1024), 1)} MB')
+            self._usage[username] = used + size
+
+    def release(self, username, size):
+        with self._lock:
+            remaining = self._usage.get(username, 0) - size
+            if remaining > 0:
+                self._usage[username] = remaining
+            else:
+                self._usage.pop(username, None)
+
+    def usage(self, username):
+        with self._lock:
+            return self._usage.get(username, 0)
+
+    # Everything spooled within the block is deleted and its quota released when the block exits,
+    # including when ingestion raises
+    @contextmanager
+    def job(self, username):
+        job = UploadJob(self, username, tempfile.mkdtemp(prefix='job_', dir=self.root))
+        try:
+            yield job
+        finally:
+            job.close()
+
+
+upload_spool = UploadSpool()
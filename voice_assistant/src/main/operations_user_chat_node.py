@@ -1,53 +1,304 @@
+import argparse
+import atexit
 import os
+import queue
+import threading
+import time
 
-from langchain_neo4j import Neo4jGraph, Neo4jVector
+from langchain_neo4j import Neo4jGraph
 from langchain_openai import AzureOpenAIEmbeddings
-import streamlit as st
 
-NEO4J_URI = st.secrets['NEO4J_URI']
-NEO4J_USER = st.secrets['NEO4J_USER']
-NEO4J_PASSWORD = st.secrets['NEO4J_PASSWORD']
+from operations_config import get_secret
+from operations_query_cache import query_cache
+from operations_rate_limit import embedding_rate_limiter, estimate_tokens
+
+NEO4J_URI = get_secret('NEO4J_URI')
+NEO4J_USER = get_secret('NEO4J_USER')
+NEO4J_PASSWORD = get_secret('NEO4J_PASSWORD')
 os.environ["NEO4J_URI"] = NEO4J_URI
 os.environ["NEO4J_USERNAME"] = NEO4J_USER
 os.environ["NEO4J_PASSWORD"] = NEO4J_PASSWORD
 
-AZURE_EMBEDDING_MODEL = st.secrets['AZURE_EMBEDDING_MODEL']
-AZURE_EMBEDDING_ENDPOINT = st.secrets['AZURE_EMBEDDING_ENDPOINT']
-AZURE_EMBEDDING_KEY = st.secrets['AZURE_EMBEDDING_KEY']
-
-async def save_chat(chat_dict, username, prev_chat_id=None):
-    graph = Neo4jGraph()
-    embeddings = AzureOpenAIEmbeddings(
-        model=AZURE_EMBEDDING_MODEL,
-        azure_endpoint=AZURE_EMBEDDING_ENDPOINT,
-        api_key=AZURE_EMBEDDING_KEY,
-    )
-    embedding_dict = {key: value for key, value in chat_dict.items() if key != 'id'}
-    embedding_vector = embeddings.embed_query(str(embedding_dict))
-    chat_dict['embedding'] = embedding_vector
-
-    properties = ''
-    for k, v in chat_dict.items():
-        properties += k + ":'" + str(v).replace("'", "\\'") + "',"
-    properties = properties[:-1]
-
-    if prev_chat_id is None:
-        cypher_message = ("CREATE (c:Chat {" + properties + "}) WITH c MATCH (u:User{username:'" + username
-                          + "'}) WITH c, u CREATE (u)-[:CONVERSED]->(c)")
-        graph.query(cypher_message)
-    else:
-        cypher_message = ("CREATE (c1:Chat {" + properties + "}) WITH c1 MATCH (c2:Chat{id:'" + prev_chat_id
-                          + "'}) WITH c1, c2 CREATE (c2)-[:FOLLOWED_BY]->(c1)")
-        graph.query(cypher_message)
+AZURE_EMBEDDING_MODEL = get_secret('AZURE_EMBEDDING_MODEL')
+AZURE_EMBEDDING_ENDPOINT = get_secret('AZURE_EMBEDDING_ENDPOINT')
+AZURE_EMBEDDING_KEY = get_secret('AZURE_EMBEDDING_KEY')
+
+# Chat fields that make up the embedded text, in the order they are rendered
+CHAT_EMBEDDING_KEYS = ['user_first_name', 'username', 'user_timezone', 'user_query', 'agent_response', 'timestamp']
+
+# Conversations are Session nodes linked to their chats in turn order, reads never walk FOLLOWED_BY paths:
+# (u:User)-[:HAS_SESSION]->(s:Session {id, username, head_chat_id, tail_chat_id, turn_count, started_at, last_activity})
+# (s)-[:HAS_CHAT {turn_no}]->(c:Chat)
+_SESSION_SCHEMA_QUERIES = [
+    "CREATE CONSTRAINT session_id_unique IF NOT EXISTS FOR (s:Session) REQUIRE s.id IS UNIQUE",
+    "CREATE INDEX session_user_activity IF NOT EXISTS FOR (s:Session) ON (s.username, s.last_activity)",
+]
+# Chats written before Session nodes existed, one session per CONVERSED head and its FOLLOWED_BY chain up to the first
+# chat that already belongs to a session. Heads that already have a session are skipped, so the migration can be
+# re-run and resumed
+_BACKFILL_SESSIONS_QUERY = """MATCH (u:User)-[:CONVERSED]->(h:Chat) WHERE NOT (h)<-[:HAS_CHAT]-(:Session)
+    WITH u, h LIMIT $batch_size
+    MATCH p = (h)-[:FOLLOWED_BY*0..]->(t:Chat)
+    WHERE NONE(c IN nodes(p) WHERE (c)<-[:HAS_CHAT]-(:Session))
+        AND NOT EXISTS { (t)-[:FOLLOWED_BY]->(n:Chat) WHERE NOT (n)<-[:HAS_CHAT]-(:Session) }
+    WITH u, h, t, nodes(p) AS chats
+    MERGE (s:Session {id: h.id})
+    SET s.username = u.username, s.head_chat_id = h.id, s.tail_chat_id = t.id, s.turn_count = size(chats),
+        s.started_at = h.timestamp, s.last_activity = t.timestamp
+    MERGE (u)-[:HAS_SESSION]->(s)
+    WITH s, chats
+    UNWIND range(0, size(chats) - 1) AS i
+    WITH s, chats[i] AS c, i
+    MERGE (s)-[:HAS_CHAT {turn_no: i + 1}]->(c)
+    RETURN count(DISTINCT s) AS sessions, count(c) AS chats"""
+BACKFILL_BATCH_SIZE = 500
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+# Constraint and index the session reads rely on, created once per process
+def ensure_session_schema(graph):
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            for query in _SESSION_SCHEMA_QUERIES:
+                graph.query(query)
+            _schema_ready = True
+
+
+# One time migration, run: python operations_user_chat_node.py --backfill-sessions
+def backfill_sessions(graph=None, batch_size=BACKFILL_BATCH_SIZE):
+    if graph is None:
+        graph = Neo4jGraph()
+    ensure_session_schema(graph)
+    totals = {"sessions": 0, "chats": 0}
+    while True:
+        result = graph.query(_BACKFILL_SESSIONS_QUERY, params={"batch_size": batch_size})
+        if len(result) == 0 or result[0]['sessions'] == 0:
+            break
+        totals['sessions'] += result[0]['sessions']
+        totals['chats'] += result[0]['chats']
+        print(f"[Session backfill] {totals}", flush=True)
+    query_cache.invalidate('chats')
+    return totals
+
+# Queued chats are written when this many are waiting or after this many seconds
+CHAT_FLUSH_BATCH_SIZE = 32
+CHAT_FLUSH_INTERVAL_SECONDS = 2.0
+# A failed batch is retried after this many seconds, doubling up to the maximum. It stays at the head of the queue
+# so chats are written in order and FOLLOWED_BY chains and session turn numbers stay intact
+CHAT_RETRY_INITIAL_SECONDS = 1.0
+CHAT_RETRY_MAX_SECONDS = 60.0
+
+
+def chat_embedding_text(chat_dict):
+    return str({key: chat_dict[key] for key in CHAT_EMBEDDING_KEYS if key in chat_dict})
+
+
+def _chat_rows(batch, vectors):
+    rows = []
+    for (chat_dict, username, prev_chat_id, _), vector in zip(batch, vectors):
+        properties = {k: str(v) for k, v in chat_dict.items()}
+        # Chat vectors are stored as strings, read back with apoc.convert.fromJsonList
+        properties['embedding'] = str(vector)
+        properties['embedding_model'] = AZURE_EMBEDDING_MODEL
+        rows.append({"properties": properties, "username": username, "prev_chat_id": prev_chat_id})
+    return rows
+
+
+# Chats of the batch grouped by session in queue order, each session is then updated once
+def _session_rows(batch):
+    sessions = {}
+    for chat_dict, username, _, session_id in batch:
+        if session_id is None:
+            continue
+        session = sessions.setdefault(session_id, {"id": session_id, "username": username, "chat_ids": [],
+                                                   "started_at": str(chat_dict['timestamp'])})
+        session['chat_ids'].append(str(chat_dict['id']))
+        session['last_activity'] = str(chat_dict['timestamp'])
+    return list(sessions.values())
+
+
+# Chats are written after the reply is shown: queued, embedded in batches and created with one UNWIND, so the
+# next turn never waits for persistence. Queue order is write order, which keeps FOLLOWED_BY chains intact
+class ChatPersister:
+    def __init__(self, batch_size=CHAT_FLUSH_BATCH_SIZE, interval=CHAT_FLUSH_INTERVAL_SECONDS):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue()
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._flush_requested = threading.Event()
+        self._graph = None
+        self._embeddings = None
+        # Batch that failed to write, retried before anything queued after it
+        self._failed_batch = None
+        self._failures = 0
+        self._retry_at = 0.0
+        self._thread = threading.Thread(target=self._run, name='chat-persister', daemon=True)
+        self._thread.start()
 
+    def enqueue(self, chat_dict, username, prev_chat_id=None, session_id=None):
+        with self._condition:
+            self._pending += 1
+        self._queue.put((dict(chat_dict), username, prev_chat_id, session_id))
+        if self._queue.qsize() >= self.batch_size:
+            self._flush_requested.set()
+
+    # Blocks until everything queued so far is written, e.g. on logout and shutdown. Returns False if chats are still
+    # pending after the timeout (e.g. Neo4j is down), they stay queued and are written once it is reachable
+    def flush(self, timeout=30):
+        self._flush_requested.set()
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    # Chats queued or being retried
+    @property
+    def pending(self):
+        with self._condition:
+            return self._pending
+
+    def _run(self):
+        while True:
+            timeout = self.interval
+            if self._failed_batch is not None:
+                timeout = max(0.0, min(timeout, self._retry_at - time.monotonic()))
+            flush_requested = self._flush_requested.wait(timeout=timeout)
+            self._flush_requested.clear()
+            # Backing off, a flush retries right away
+            if self._failed_batch is not None and not flush_requested and time.monotonic() < self._retry_at:
+                continue
+            while self._failed_batch is not None or not self._queue.empty():
+                batch = self._failed_batch
+                if batch is None:
+                    batch = []
+                    while len(batch) < self.batch_size and not self._queue.empty():
+                        batch.append(self._queue.get())
+                if not self._write_batch(batch):
+                    break
+                with self._condition:
+                    self._pending -= len(batch)
+                    self._condition.notify_all()
+
+    # Returns False and keeps the batch for a later retry if the write failed
+    def _write_batch(self, batch):
+        try:
+            self._write(batch)
+        except Exception as e:
+            self._failed_batch = batch
+            self._failures += 1
+            delay = min(CHAT_RETRY_INITIAL_SECONDS * 2 ** (self._failures - 1), CHAT_RETRY_MAX_SECONDS)
+            self._retry_at = time.monotonic() + delay
+            print(f"[Chat Persist Failed] attempt {self._failures}, {len(batch)} chats, retry in {delay}s: {e}")
+            return False
+        self._failed_batch = None
+        self._failures = 0
+        return True
+
+    def _write(self, batch):
+        if self._graph is None:
+            self._graph = Neo4jGraph()
+            ensure_session_schema(self._graph)
+            self._embeddings = AzureOpenAIEmbeddings(
+                model=AZURE_EMBEDDING_MODEL,
+                azure_endpoint=AZURE_EMBEDDING_ENDPOINT,
+                api_key=AZURE_EMBEDDING_KEY,
+            )
+        texts = [chat_embedding_text(chat_dict) for chat_dict, _, _, _ in batch]
+        embedding_rate_limiter.acquire(estimate_tokens(texts))
+        vectors = self._embeddings.embed_documents(texts)
+
+        # All chats are created before any is linked, so a chat can follow one from the same batch. Sessions are
+        # updated incrementally: new chats are appended after the current turn count, head/tail/activity move along
+        self._graph.query("""UNWIND $rows AS row
+            CREATE (c:Chat) SET c = row.properties
+            WITH count(c) AS created
+            UNWIND $rows AS row
+            MATCH (c:Chat {id: row.properties.id})
+            OPTIONAL MATCH (u:User {username: row.username}) WHERE row.prev_chat_id IS NULL
+            OPTIONAL MATCH (p:Chat {id: row.prev_chat_id})
+            FOREACH (_ IN CASE WHEN u IS NULL THEN [] ELSE [1] END | CREATE (u)-[:CONVERSED]->(c))
+            FOREACH (_ IN CASE WHEN p IS NULL THEN [] ELSE [1] END | CREATE (p)-[:FOLLOWED_BY]->(c))
+            WITH count(c) AS linked
+            UNWIND $sessions AS session
+            MERGE (s:Session {id: session.id})
+            ON CREATE SET s.username = session.username, s.head_chat_id = session.chat_ids[0],
+                s.started_at = session.started_at, s.turn_count = 0
+            WITH s, session, s.turn_count AS base
+            CALL {
+                WITH s, session, base
+                UNWIND range(0, size(session.chat_ids) - 1) AS i
+                MATCH (c:Chat {id: session.chat_ids[i]})
+                CREATE (s)-[:HAS_CHAT {turn_no: base + i + 1}]->(c)
+            }
+            SET s.turn_count = base + size(session.chat_ids), s.tail_chat_id = session.chat_ids[-1],
+                s.last_activity = session.last_activity
+            WITH s, session WHERE base = 0
+            MATCH (u:User {username: session.username})
+            MERGE (u)-[:HAS_SESSION]->(s)""",
+                          params={"rows": _chat_rows(batch, vectors), "sessions": _session_rows(batch)})
+        for username in set(username for _, username, _, _ in batch):
+            query_cache.invalidate('chats', username)
+
+
+chat_persister = ChatPersister()
+atexit.register(chat_persister.flush, 10)
+
+
+def _decode_cursor(cursor):
+    if cursor is None:
+        return None, None
+    last_activity, _, session_id = cursor.partition('|')
+    return last_activity, session_id
+
+
+# Newest sessions first, keyset paginated on (last_activity, id). Pass the returned next_cursor for older ones.
+# Served from the query cache until the chat writer stores new chats of the user
+def load_recent_sessions(username, limit=3, cursor=None, graph=None):
+    return query_cache.get_or_load('chats', username, {"query": "recent_sessions", "limit": limit, "cursor": cursor},
+                                   lambda: _query_recent_sessions(username, limit, cursor, graph))
+
+
+def _query_recent_sessions(username, limit, cursor, graph):
+    if graph is None:
+        graph = Neo4jGraph()
+    ensure_session_schema(graph)
+    cursor_activity, cursor_id = _decode_cursor(cursor)
+    sessions = graph.query("""MATCH (s:Session {username: $username})
+        WHERE $cursor_activity IS NULL OR s.last_activity < $cursor_activity
+            OR (s.last_activity = $cursor_activity AND s.id < $cursor_id)
+        WITH s ORDER BY s.last_activity DESC, s.id DESC LIMIT $limit
+        CALL {
+            WITH s
+            MATCH (s)-[h:HAS_CHAT]->(c:Chat)
+            WITH h, c ORDER BY h.turn_no
+            RETURN COLLECT({user_query: c.user_query, agent_response: c.agent_response}) AS chat_content
+        }
+        RETURN s.id AS session_id, s.started_at AS timestamp, s.last_activity AS last_activity,
+            s.turn_count AS turn_count, chat_content
+        ORDER BY last_activity DESC, session_id DESC""",
+                           params={"username": username, "limit": limit, "cursor_activity": cursor_activity,
+                                   "cursor_id": cursor_id})
+    next_cursor = None
+    if len(sessions) == limit:
+        next_cursor = f"{sessions[-1]['last_activity']}|{sessions[-1]['session_id']}"
+    return {"sessions": sessions, "next_cursor": next_cursor}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat storage maintenance')
+    parser.add_argument('--backfill-sessions', action='store_true',
+                        help='Create Session nodes for chats stored before sessions existed')
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE)
+    args = parser.parse_args()
+    if args.backfill_sessions:
+        print(f"[Session backfill] finished {backfill_sessions(batch_size=args.batch_size)}")
+    else:
+        parser.print_help()
 
-def load_last_3_chats(username):
-    graph = Neo4jGraph()
 
-    cypher_message = ("MATCH (u:User{username:'" + username + "'})-[CONVERSED]->(c:Chat) "
-                                                              "WITH u, c ORDER BY c.timestamp DESC LIMIT 3 "
-                                                              "MATCH (c:Chat)-[FOLLOWED_BY*0..]->(d:Chat) "
-                                                              "WITH c.timestamp AS timestamp, {user_query: d.user_query, agent_response: d.agent_response} AS combined "
-                                                              "WITH timestamp, COLLECT(combined) AS chat_content "
-                                                              "RETURN timestamp, chat_content")
-    return graph.query(cypher_message)
+if __name__ == '__main__':
+    main()
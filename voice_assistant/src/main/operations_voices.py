@@ -1,10 +1,55 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+
 from langchain_openai import AzureChatOpenAI
-import streamlit as st
 
-AZURE_OPENAI_MODEL = st.secrets['AZURE_OPENAI_MODEL']
-AZURE_OPENAI_ENDPOINT = st.secrets['AZURE_OPENAI_ENDPOINT']
-AZURE_OPENAI_KEY = st.secrets['AZURE_OPENAI_KEY']
-AZURE_OPENAI_VERSION = st.secrets['AZURE_OPENAI_VERSION']
+from operations_config import get_secret
+
+AZURE_OPENAI_MODEL = get_secret('AZURE_OPENAI_MODEL')
+AZURE_OPENAI_ENDPOINT = get_secret('AZURE_OPENAI_ENDPOINT')
+AZURE_OPENAI_KEY = get_secret('AZURE_OPENAI_KEY')
+AZURE_OPENAI_VERSION = get_secret('AZURE_OPENAI_VERSION')
+
+# Long replies are synthesized as several requests of at most this many characters, well under the service limits
+SSML_SEGMENT_CHARS = int(get_secret('SSML_SEGMENT_CHARS', 1500))
+
+# Ask the LLM when the local classifier is unsure, off by default to keep style selection off the network
+EMOTION_LLM_FALLBACK = str(get_secret('EMOTION_LLM_FALLBACK', 'false')).lower() == 'true'
+EMOTION_CONFIDENCE_THRESHOLD = 0.5
+EMOTION_CACHE_SIZE = 2048
+# Tone is set by the opening of a reply, the rest is not scored
+EMOTION_SCORED_CHARS = 2000
+
+ALLOWED_STYLES = ["cheerful", "sad", "angry", "excited", "friendly", "empathetic", "hopeful", "unfriendly",
+                  "shouting", "whispering", "assistant", "newscast", "customerservice",
+                  "narration-professional", "narration-relaxed"]
+
+# Cue words per style, styles that do not suit an assistant reply (angry, shouting, ...) are left to the LLM
+STYLE_LEXICON = {
+    "cheerful": ["great", "glad", "happy", "congratulations", "wonderful", "awesome", "delighted", "good news",
+                 "well done", "enjoy", "nice"],
+    "excited": ["amazing", "incredible", "fantastic", "exciting", "wow", "thrilled", "can't wait", "record high"],
+    "empathetic": ["sorry", "unfortunately", "apologize", "apologies", "understand", "difficult", "couldn't",
+                   "could not", "unable", "not able", "no results", "don't worry", "not found", "missing"],
+    "sad": ["sadly", "loss", "passed away", "regret", "grief", "tragic", "declined", "lost"],
+    "hopeful": ["hope", "hopefully", "looking forward", "improve", "promising", "optimistic", "opportunity"],
+    "friendly": ["hello", "hi", "welcome", "thanks", "thank you", "feel free", "let me know", "happy to help",
+                 "sure", "of course"],
+    "newscast": ["announced", "reported", "according to", "percent", "revenue", "quarter", "growth", "million",
+                 "billion", "increase", "decrease"],
+    "narration-professional": ["summary", "document", "section", "overview", "key points", "in conclusion",
+                               "contains", "includes", "page", "table", "file", "report"],
+    "customerservice": ["please", "upload", "try again", "steps", "assist", "account", "support", "you can"],
+}
+_STYLE_PATTERNS = {style: re.compile(r"\b(?:" + '|'.join(re.escape(word) for word in words) + r")\b", re.IGNORECASE)
+                   for style, words in STYLE_LEXICON.items()}
+_NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)?%?")
+
+_style_cache = OrderedDict()
+_style_cache_lock = threading.Lock()
 
 model = AzureChatOpenAI(
     model=AZURE_OPENAI_MODEL,
@@ -14,7 +59,7 @@ model = AzureChatOpenAI(
 )
 
 
-def detect_emotion(text: str, user_query: str = '') -> str:
+def detect_emotion_llm(text: str, user_query: str = '') -> str:
     prompt = (
         "Classify the emotional tone of the following sentence into one of the following styles: "
         "cheerful, sad, angry, excited, friendly, empathetic, hopeful, unfriendly, shouting, whispering, assistant, newscast, customerservice, narration-professional, narration-relaxed. Respond only with the style name.\n\n"
@@ -29,16 +74,50 @@ def detect_emotion(text: str, user_query: str = '') -> str:
             {"role": "user", "content": prompt}
         ])
         style = response.content.strip().lower()
-        allowed_styles = ["cheerful", "sad", "angry", "excited", "friendly", "empathetic", "hopeful", "unfriendly",
-                          "shouting", "whispering", "assistant", "newscast", "customerservice",
-                          "narration-professional", "narration-relaxed"]
-        return style if style in allowed_styles else "friendly"
+        return style if style in ALLOWED_STYLES else "friendly"
     except Exception as e:
         print(f"[Emotion Detection Failed] {e}")
         return "friendly"
 
 
+# Scores cue words of the reply (and, at half weight, of the question), returns the style and its share of the score
+def classify_style(text: str, user_query: str = ''):
+    text = text[:EMOTION_SCORED_CHARS]
+    scores = {style: float(len(pattern.findall(text))) for style, pattern in _STYLE_PATTERNS.items()}
+    for style in ("empathetic", "sad", "excited"):
+        scores[style] += 0.5 * len(_STYLE_PATTERNS[style].findall(user_query))
+    scores["excited"] += 0.5 * min(text.count('!'), 4)
+    # Figure heavy replies read best as news
+    scores["newscast"] += 0.25 * min(len(_NUMBER_PATTERN.findall(text)), 8)
+
+    total = sum(scores.values())
+    if total == 0:
+        return "friendly", 0.0
+    style = max(scores, key=scores.get)
+    return style, scores[style] / total
+
+
+def detect_emotion(text: str, user_query: str = '') -> str:
+    key = hashlib.sha256(f"{user_query}\0{text}".encode('utf-8')).hexdigest()
+    with _style_cache_lock:
+        if key in _style_cache:
+            _style_cache.move_to_end(key)
+            return _style_cache[key]
+
+    style, confidence = classify_style(text, user_query)
+    if confidence < EMOTION_CONFIDENCE_THRESHOLD and EMOTION_LLM_FALLBACK:
+        style = detect_emotion_llm(text, user_query)
+
+    with _style_cache_lock:
+        _style_cache[key] = style
+        if len(_style_cache) > EMOTION_CACHE_SIZE:
+            _style_cache.popitem(last=False)
+    return style
+
+
 def build_ssml(text, voice="en-US-JennyNeural", rate="medium", style="friendly", pitch="0%", volume="0dB"):
+    # Replies contain &, < and > (code, comparisons, "R&D"), unescaped they make the SSML invalid
+    text = escape(text)
     if style != "friendly":
         return f"""
         <speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis"
@@ -62,3 +141,45 @@ def build_ssml(text, voice="en-US-JennyNeural", rate="medium", style="friendly",
             </voice>
         </speak>
         """
+
+
+def _split_long(sentence, max_chars):
+    # Sentence over the cap is cut at the last space before it
+    parts = []
+    while len(sentence) > max_chars:
+        cut = sentence.rfind(' ', 0, max_chars)
+        if cut <= 0:
+            cut = max_chars
+        parts.append(sentence[:cut].strip())
+        sentence = sentence[cut:].strip()
+    if sentence != '':
+        parts.append(sentence)
+    return parts
+
+
+# Packs paragraphs, or sentences of paragraphs over the cap, into segments of at most max_chars
+def split_segments(text, max_chars=SSML_SEGMENT_CHARS):
+    segments = []
+    current = ''
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if paragraph == '':
+            continue
+        if len(paragraph) <= max_chars:
+            pieces = [paragraph]
+        else:
+            pieces = []
+            for sentence in re.split(r'(?<=[.!?।。])\s+', paragraph):
+                pieces.extend(_split_long(sentence, max_chars))
+        for piece in pieces:
+            if current == '':
+                current = piece
+            elif len(current) + 1 + len(piece) <= max_chars:
+                current += '\n' + piece
+            else:
+                segments.append(current)
+                current = piece
+    if current != '':
+        segments.append(current)
+    return segments
+
@@ -1,9 +1,6 @@
 import os
 
-STATIC_DIR = 'static'
-if not os.path.exists(STATIC_DIR):
-    os.makedirs(STATIC_DIR)
-
+# static/ for generated audio and images is created by operations_static_store
 import streamlit as st
 import streamlit_ui_home_page
 import streamlit_ui_login
@@ -31,8 +28,8 @@ def main():
     if 'last_chat_id' not in st.session_state:
         st.session_state['last_chat_id'] = None
 
-    if 'react_graph' not in st.session_state:
-        st.session_state['react_graph'] = None
+    if 'thread_id' not in st.session_state:
+        st.session_state['thread_id'] = None
 
     if not st.session_state['logged_in']:
         streamlit_ui_login.login_page()
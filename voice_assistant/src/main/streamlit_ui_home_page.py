@@ -1,30 +1,34 @@
-import asyncio
-import base64
 import datetime
 import hashlib
+import html
 import json
-import os
-import tempfile
-import uuid
-from io import BytesIO
+import time
+from contextlib import nullcontext
 
-import azure.cognitiveservices.speech as speechsdk
 import streamlit as st
-from PIL import Image
-from langchain_core.messages import HumanMessage
+import streamlit.components.v1 as components
+from langchain_core.messages import AIMessageChunk, HumanMessage
 
+from operations_artifact_store import artifact_store
+from operations_checkpointer import new_thread_id
+from operations_compaction import schedule_compaction, thread_lock, wait_for_compaction
 from operations_file_chunk_node import process_given_files
-from operations_langgraph import build_graph
-from operations_user_chat_node import save_chat, load_last_3_chats
-from operations_voices import build_ssml, detect_emotion
-
-# Azure Speech Credentials
-AZURE_SPEECH_KEY = st.secrets['AZURE_SPEECH_KEY']
-AZURE_REGION = st.secrets['AZURE_REGION']
+from operations_langgraph import get_graph, graph_config
+from operations_query_cache import query_cache
+from operations_retrieval import format_excerpts, placed_file_names, SpeculativeRetriever, PRE_RETRIEVAL
+from operations_speech_engine import speech_engine, AUDIO_EXTENSION, AUDIO_MIME_TYPE
+from operations_speech_recognition import AzureRecognitionBackend, StreamingRecognition
+from operations_speech_stream import SpeechPipeline, STREAMING_TTS, synthesize_segments
+from operations_static_store import static_store
+from operations_tool_memo import tool_memo
+from operations_upload_spool import upload_spool, UploadQuotaExceeded
+from operations_user_chat_node import chat_persister, load_recent_sessions
+from operations_tts_cache import audio_cache
+from operations_voices import split_segments, detect_emotion
 
 # Define allowed file types
 ALLOWED_FILE_TYPES = [
-    "text/plain", "application/pdf", "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "text/plain", "text/markdown", "application/pdf", "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
     "application/vnd.ms-excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
     "image/png", "image/jpeg"
 ]
@@ -106,67 +110,90 @@ LANGUAGE_OPTIONS = {
 
 
 def speak(text, user_query, voice='en-US-JennyNeural'):
-    # Azure Speech Config
-    speech_config = speechsdk.SpeechConfig(subscription=AZURE_SPEECH_KEY, region=AZURE_REGION)
-
-    # Synthesize speech to audio stream
-    synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-    # result = synthesizer.speak_text_async(text).get()
-
     # voice_choice = st.session_state['voice_name']  # or "en-US-JennyNeural" etc.
     # voice_choice = "en-US-JennyNeural"
 
     style = detect_emotion(text, user_query)
     print(style)
-    # ssml = build_ssml(text, voice=voice, rate="medium" , style=style)
-    ssml = build_ssml(
-        text,
-        voice=voice,
-        rate=st.session_state["ssml_rate"],
-        pitch=st.session_state["ssml_pitch"],
-        volume=st.session_state["ssml_volume"],
-        style=style
-    )
-    result = synthesizer.speak_ssml_async(ssml).get()
-
-    if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-        # Save audio stream to temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as audio_file:
-            audio_file.write(result.audio_data)
-            audio_path = audio_file.name
-
-        # Read and base64 encode the audio
-        with open(audio_path, "rb") as f:
-            audio_bytes = f.read()
-            b64 = base64.b64encode(audio_bytes).decode()
-
-        # Generate unique ID for audio tag
-        unique_id = str(uuid.uuid4()).replace('-', '')
-
-        # Embed and autoplay in Streamlit
-        st.markdown(
-            f"""
-            <audio id="{unique_id}" autoplay>
-                <source src="data:audio/wav;base64,{b64}" type="audio/wav">
-            </audio>
-            <script>
-                var audioElem = document.getElementById("{unique_id}");
-                if (audioElem) {{
-                    audioElem.load();
-                    audioElem.play();
-                }}
-            </script>
-            """,
-            unsafe_allow_html=True
+    # Long replies are split at paragraph/sentence boundaries and synthesized in parallel, repeated segments
+    # are served from the audio cache
+    try:
+        started = time.perf_counter()
+        audio_data, timings = synthesize_segments(
+            split_segments(text),
+            voice=voice,
+            rate=st.session_state["ssml_rate"],
+            pitch=st.session_state["ssml_pitch"],
+            volume=st.session_state["ssml_volume"],
+            style=style
         )
-
-        # Clean up temp file
-        os.remove(audio_path)
-
+        print(f"[Speech segments] total {round((time.perf_counter() - started) * 1000)} ms, {timings}, "
+              f"cache {audio_cache.stats}, engine {speech_engine.stats}")
+    except Exception as e:
+        print(e)
+        audio_data = None
+
+    if audio_data is not None:
+        queue_audio(audio_data)
     else:
         st.error("Failed to synthesize speech.")
 
 
+# Plays audio segments one after another through a queue kept in the parent page, so segments sent while an
+# earlier one is still playing wait their turn instead of overlapping. Streamlit serves static .mp3/.ogg/.wav files as
+# text/plain with nosniff, the bytes are fetched and played from a Blob carrying the audio type instead
+def queue_audio(audio_data):
+    audio_url = static_store.put_audio(audio_data, AUDIO_EXTENSION)
+    components.html(
+        f"""
+        <script>
+            const root = window.parent;
+            // Queue state lives in the parent page so playback survives this frame being removed on rerun. The
+            // methods are assigned again by every frame, so they always come from a frame that is still mounted
+            const audioQueue = root.voiceAssistantAudioQueue || {{queue: [], playing: false}};
+            root.voiceAssistantAudioQueue = Object.assign(audioQueue, {{
+                push(src, type) {{
+                    this.queue.push({{src, type}});
+                    this.next();
+                }},
+                next() {{
+                    if (this.playing || this.queue.length === 0) return;
+                    this.playing = true;
+                    const item = this.queue.shift();
+                    let blobUrl = null;
+                    const done = () => {{
+                        if (blobUrl) root.URL.revokeObjectURL(blobUrl);
+                        this.playing = false;
+                        root.voiceAssistantAudioQueue.next();
+                    }};
+                    root.fetch(item.src)
+                        .then(response => response.arrayBuffer())
+                        .then(data => {{
+                            blobUrl = root.URL.createObjectURL(new root.Blob([data], {{type: item.type}}));
+                            const audio = new root.Audio(blobUrl);
+                            audio.onended = done;
+                            audio.onerror = done;
+                            return audio.play();
+                        }})
+                        .catch(done);
+                }}
+            }});
+            root.voiceAssistantAudioQueue.push("{audio_url}", "{AUDIO_MIME_TYPE}");
+        </script>
+        """,
+        height=0
+    )
+
+
+# Thumbnail linking to the full size image, both served from the static directory
+def show_image(url, thumbnail_url, name):
+    st.markdown(
+        f'''<a href="{url}" target="_blank"><img src="{thumbnail_url}" alt="{html.escape(name)}" style="max-width: 100%;"></a>
+        <div style="font-size: 0.85em; opacity: 0.7;">{html.escape(name)}</div>''',
+        unsafe_allow_html=True
+    )
+
+
 # Define a callback function to switch labels
 def switch_label():
     if st.session_state["button_state"]:
@@ -177,7 +204,7 @@ def switch_label():
 
 
 # React to user input
-def generate_response(react_graph, chat_container, prompt, output_lang, output_voice):
+def generate_response(react_graph, chat_container, prompt, output_lang, output_voice, prefetched_chunks=None):
     with chat_container:
         # Display user message in chat message container
         with st.chat_message("user"):
@@ -190,6 +217,8 @@ def generate_response(react_graph, chat_container, prompt, output_lang, output_v
 
         # Add user message to chat history
         st.session_state.messages.append({"role": "user", "content": prompt})
+        # File excerpts already retrieved while the user was speaking, the assistant sends them for this turn only
+        prefetched_excerpts = format_excerpts(prefetched_chunks)
         # Stream assistants response
         if st.session_state["button_state"]:
             messages = [
@@ -198,7 +227,8 @@ def generate_response(react_graph, chat_container, prompt, output_lang, output_v
                             f"output_format: user wants response to be short and easy to read out loud as audio, do not include any | or - for tables or any text formatting"
                             f"output_language: {output_lang}, message: {prompt}",
                     metadata={"timestamp": current_timestamp, "user_placed_files": st.session_state['processed_files'],
-                              "output_language": output_lang, "user_details": st.session_state['logged_user_details']}
+                              "output_language": output_lang, "user_details": st.session_state['logged_user_details'],
+                              "user_query": prompt, "prefetched_excerpts": prefetched_excerpts}
                 )
             ]
         else:
@@ -208,70 +238,151 @@ def generate_response(react_graph, chat_container, prompt, output_lang, output_v
                             f"output_format: user wants response in more detail and not in audio format, put bullet points or tables whenever possible, "
                             f"output_language: {output_lang}, message: {prompt}",
                     metadata={"timestamp": current_timestamp, "user_placed_files": st.session_state['processed_files'],
-                              "output_language": output_lang, "user_details": st.session_state['logged_user_details']}
+                              "output_language": output_lang, "user_details": st.session_state['logged_user_details'],
+                              "user_query": prompt, "prefetched_excerpts": prefetched_excerpts}
                 )
             ]
         messages[0].pretty_print()
-        config = {"configurable": {"thread_id": "1"}}
-
-        with st.spinner("Waiting for response...", show_time=True):
-            for response in react_graph.stream({"messages": messages}, config=config):
+        config = graph_config(st.session_state['logged_user_details'], st.session_state['thread_id'])
+        wait_for_compaction(config["configurable"]["thread_id"])
+
+        turn_started = time.perf_counter()
+        first_token_at, answered_at = None, None
+        tool_statuses = {}
+        tool_timings = []
+        model_calls = 0
+        # Voice output is synthesized sentence by sentence while the reply is generated
+        speech_pipeline = None
+        if st.session_state["button_state"] and STREAMING_TTS:
+            speech_pipeline = SpeechPipeline(prompt, voice=output_voice, rate=st.session_state["ssml_rate"],
+                                             pitch=st.session_state["ssml_pitch"],
+                                             volume=st.session_state["ssml_volume"])
+        # The pipeline's synthesis threads are stopped even when the graph stream raises, compaction of this thread
+        # waits until the turn is written
+        with thread_lock(config["configurable"]["thread_id"]), st.chat_message("assistant"), \
+                speech_pipeline or nullcontext():
+            # Tool progress is listed above the reply, the reply itself is rendered token by token
+            progress_container = st.container()
+            reply_placeholder = st.empty()
+            reply_placeholder.caption("Waiting for response...")
+            streamed_text = ''
+            for mode, payload in react_graph.stream({"messages": messages}, config=config,
+                                                    stream_mode=["messages", "updates"]):
+                # Token chunks, only the assistant node produces reply text. Complete messages a node returns are
+                # sent in this mode as well and are skipped
+                if mode == 'messages':
+                    chunk, chunk_metadata = payload
+                    if chunk_metadata.get('langgraph_node') != 'assistant' or not isinstance(chunk, AIMessageChunk) \
+                            or not isinstance(chunk.content, str) or chunk.content == '':
+                        continue
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    streamed_text += chunk.content
+                    reply_placeholder.markdown(streamed_text.replace("$", "\\$") + "▌")
+                    if speech_pipeline is not None:
+                        for audio_data in speech_pipeline.feed(chunk.content):
+                            queue_audio(audio_data)
+                    continue
+
+                response = payload
                 if 'tools' in response:
-                    response['tools']['messages'][0].pretty_print()
-                    try:
-                        tool_response = json.loads(response['tools']['messages'][0].content)
-                        if 'metadata' in tool_response and 'image_data' in tool_response['metadata'] and isinstance(
-                                tool_response['metadata']['image_data'], dict):
-                            for name, image_utf in tool_response['metadata']['image_data'].items():
-                                image_bytes = BytesIO(base64.b64decode(image_utf))
-                                image = Image.open(image_bytes)
-                                st.image(image, caption=name)
-                                st.session_state.messages.append(
-                                    {"role": "image", "content": image_bytes, "name": name})
-                    except Exception as ee:
-                        print(ee)
+                    for tool_message in response['tools']['messages']:
+                        tool_message.pretty_print()
+                        if tool_message.tool_call_id in tool_statuses:
+                            tool_statuses[tool_message.tool_call_id].update(
+                                label=f"Finished {tool_message.name}", state="complete")
+                        tool_timings.append((tool_message.name, tool_message.response_metadata.get('duration_ms')))
+                        try:
+                            tool_response = json.loads(tool_message.content)
+                            if 'metadata' in tool_response and isinstance(
+                                    tool_response['metadata'].get('artifacts'), list):
+                                for artifact in tool_response['metadata']['artifacts']:
+                                    image_bytes = artifact_store.get(artifact['artifact_id'])
+                                    if artifact['kind'] != 'image' or image_bytes is None:
+                                        continue
+                                    # Written once, history reruns only render the links
+                                    url, thumbnail_url = static_store.put_image(image_bytes)
+                                    with progress_container:
+                                        show_image(url, thumbnail_url, artifact['name'])
+                                    st.session_state.messages.append({"role": "image", "content": url,
+                                                                      "thumbnail": thumbnail_url,
+                                                                      "name": artifact['name']})
+                        except Exception as ee:
+                            print(ee)
                 # Response coming from assistant
                 elif 'assistant' in response:
-                    content = response['assistant']['messages'][0].content
-                    response['assistant']['messages'][0].pretty_print()
+                    model_calls += 1
+                    # Excerpts added by pre-retrieval come before the model response
+                    content = response['assistant']['messages'][-1].content
+                    response['assistant']['messages'][-1].pretty_print()
                     # Thinking message generation
                     if isinstance(content, list):
                         pass
-                    # Tool call message
-                    elif response['assistant']['messages'][0].tool_calls:
-                        pass
+                    # Tool call message, text streamed ahead of the call is replaced by its progress
+                    elif response['assistant']['messages'][-1].tool_calls:
+                        for tool_call in response['assistant']['messages'][-1].tool_calls:
+                            tool_statuses[tool_call['id']] = progress_container.status(
+                                f"Running {tool_call['name']}...", state="running")
+                        streamed_text = ''
+                        reply_placeholder.caption("Waiting for response...")
+                        if speech_pipeline is not None:
+                            speech_pipeline.discard()
                     else:
-                        with st.chat_message("assistant"):
-                            st.markdown(content.replace("$", "\\$"))
-                            st.session_state.messages.append(
-                                {"role": "assistant", "content": content.replace("$", "\\$")})
-
-                            # Store query-response in db
-                            chat = {'user_first_name': st.session_state['logged_user_details']['first_name'],
-                                    'username': st.session_state['logged_user_details']['username'],
-                                    'user_timezone': datetime.datetime.now().astimezone().tzname(),
-                                    'user_query': prompt,
-                                    'agent_response': content,
-                                    'id': current_chat_id,
-                                    'timestamp': current_timestamp}
-                            asyncio.run(save_chat(chat, st.session_state['logged_user_details']['username'],
-                                                  st.session_state['last_chat_id']))
-                            st.session_state['last_chat_id'] = current_chat_id
-
-                            # Speech output when st.session_state["button_state"] == True
-                            if st.session_state["button_state"]:
-                                speak(content, prompt, output_voice)
+                        answered_at = time.perf_counter()
+                        reply_placeholder.markdown(content.replace("$", "\\$"))
+                        if speech_pipeline is not None:
+                            for audio_data in speech_pipeline.finish():
+                                queue_audio(audio_data)
+                        st.session_state.messages.append(
+                            {"role": "assistant", "content": content.replace("$", "\\$")})
+
+                        # Store query-response in db
+                        chat = {'user_first_name': st.session_state['logged_user_details']['first_name'],
+                                'username': st.session_state['logged_user_details']['username'],
+                                'user_timezone': datetime.datetime.now().astimezone().tzname(),
+                                'user_query': prompt,
+                                'agent_response': content,
+                                'id': current_chat_id,
+                                'timestamp': current_timestamp}
+                        # Written in the background, off the interactive path
+                        chat_persister.enqueue(chat, st.session_state['logged_user_details']['username'],
+                                               st.session_state['last_chat_id'], st.session_state['thread_id'])
+                        st.session_state['last_chat_id'] = current_chat_id
+
+                        # Speech output when st.session_state["button_state"] == True, unless already streamed
+                        if st.session_state["button_state"] and speech_pipeline is None:
+                            speak(content, prompt, output_voice)
 
                 else:
                     pass
                     # print(response)
 
+        # Latency of the turn as the user perceives it, speech and persistence are not included
+        if answered_at is not None:
+            turn_metrics = {
+                "ttft_ms": round(((first_token_at or answered_at) - turn_started) * 1000),
+                "total_ms": round((answered_at - turn_started) * 1000),
+                "tool_calls": len(tool_statuses),
+                "tool_ms": tool_timings,
+                "model_calls": model_calls,
+                "pre_retrieval": PRE_RETRIEVAL,
+            }
+            if speech_pipeline is not None:
+                turn_metrics["ttfa_ms"] = speech_pipeline.time_to_first_audio_ms
+            st.session_state['last_turn_metrics'] = turn_metrics
+            print(f"[Turn latency] {turn_metrics}")
+            print(f"[Query cache] {query_cache.stats}")
+            print(f"[Tool memo] {tool_memo.stats}")
+
+        # Older turns are folded into a running summary in the background once the answer is shown
+        schedule_compaction(react_graph, config)
+
 
 def home_page():
     st.title(f"Welcome {st.session_state['logged_user_details']['first_name']}")
 
-    # Azure Speech Config
-    speech_config = speechsdk.SpeechConfig(subscription=AZURE_SPEECH_KEY, region=AZURE_REGION)
+    # Synthesizers for every output voice are connected in the background, only the first call starts anything
+    speech_engine.warm_up(option['voice'] for option in LANGUAGE_OPTIONS.values())
 
     # Create 2 columns for chat box and microphone button
     with st._bottom:
@@ -295,16 +406,14 @@ def home_page():
     if 'ssml_volume' not in st.session_state:
         st.session_state["ssml_volume"] = 'default'
 
-    if 'last_3_chat_contents' not in st.session_state:
-        st.session_state['last_3_chat_contents'] = load_last_3_chats(
-            st.session_state['logged_user_details']['username'])
-    elif st.session_state['last_3_chat_contents'] is None:
-        st.session_state['last_3_chat_contents'] = load_last_3_chats(
-            st.session_state['logged_user_details']['username'])
+    if 'last_3_chat_contents' not in st.session_state or st.session_state['last_3_chat_contents'] is None:
+        recent_sessions = load_recent_sessions(st.session_state['logged_user_details']['username'])
+        st.session_state['last_3_chat_contents'] = recent_sessions['sessions']
+        st.session_state['chat_history_cursor'] = recent_sessions['next_cursor']
 
     # Display sidebar for file upload
     st.sidebar.title("Upload Files for Insights")
-    st.sidebar.badge("ℹ️ Supported file types: PDF, Word Doc, Excel Doc, JPEG, PNG")
+    st.sidebar.badge("ℹ️ Supported file types: PDF, Word Doc, Excel Doc, JPEG, PNG, Text, Markdown, Log")
 
     with chat_container:
         # Display chat messages from history on app rerun
@@ -312,7 +421,7 @@ def home_page():
             if message['content'] is None or message['content'] == '':
                 pass
             elif message['role'] == 'image':
-                st.image(Image.open(message["content"]), caption=message["name"])
+                show_image(message["content"], message["thumbnail"], message["name"])
             else:
                 with st.chat_message(message["role"]):
                     st.markdown(message["content"])
@@ -335,20 +444,24 @@ def home_page():
         else:
             new_files = [x for x in uploaded_files if x.name not in processed_file_set]
 
-        new_files_path = []
-        for new_file in new_files:
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.'+new_file.name.split('.')[-1]) as audio_file:
-                audio_file.write(new_file.getbuffer())
-                new_files_path.append(audio_file.name)
+        if len(new_files) > 0:
+            username = st.session_state['logged_user_details']['username']
+            try:
+                # Spooled uploads and their temp files are removed as soon as processing finishes
+                with upload_spool.job(username) as upload_job:
+                    for new_file in new_files:
+                        upload_job.add(new_file.name, new_file)
+                    response = process_given_files(upload_job.uploads, username)
+            except UploadQuotaExceeded as e:
+                st.error(str(e))
+                response = None
 
-        if len(new_files_path) > 0:
-            response = process_given_files(new_files_path, st.session_state['logged_user_details']['username'])
             if (isinstance(response, list)) and len(response) > 0:
                 if response[0] is None:
                     st.error('Files processing failed!')
                 else:
                     st.success(', '.join(str(x['name']) for x in response) + ' processed successfully!')
-            else:
+            elif response is not None:
                 st.error('Files processing failed!')
 
             # Update st.session_state['processed_files'] from response
@@ -359,7 +472,7 @@ def home_page():
             else:
                 for user_file in response:
                     if user_file['name'] not in processed_file_set:
-                        st.session_state['processed_files'].extend(user_file)
+                        st.session_state['processed_files'].append(user_file)
 
     input_lang = st.sidebar.selectbox("🎤 Select Input Language (speech recognition)", list(LANGUAGE_OPTIONS.keys()),
                                       index=0)
@@ -397,8 +510,16 @@ def home_page():
     st.session_state["ssml_pitch"] = ssml_pitch
     st.session_state["ssml_volume"] = ssml_volume
 
-    # Last 3 chats
-    st.sidebar.write('Conversation History (Recent 3):')
+    # Recent conversations, older ones are loaded a page at a time
+    st.sidebar.write('Conversation History:')
+    if st.session_state.get('chats_unsaved', False):
+        if chat_persister.pending > 0:
+            st.sidebar.caption('Latest chats are still being saved and may be missing here.')
+        else:
+            # Saved since, the history is reloaded with them
+            st.session_state['chats_unsaved'] = False
+            st.session_state['last_3_chat_contents'] = None
+            st.rerun()
     for conversation in st.session_state['last_3_chat_contents']:
         with st.sidebar.expander(conversation['timestamp'][:19] + ' - '
                                  + (conversation['chat_content'][0]['user_query']
@@ -410,27 +531,39 @@ def home_page():
                             + ']: ' + chat['user_query'])
                 st.markdown(':green[Assistant]: ' + chat['agent_response'].replace("$", "\\$"))
                 st.divider()
+    if st.session_state.get('chat_history_cursor') is not None:
+        if st.sidebar.button("Older conversations", use_container_width=True):
+            older_sessions = load_recent_sessions(st.session_state['logged_user_details']['username'],
+                                                  cursor=st.session_state['chat_history_cursor'])
+            st.session_state['last_3_chat_contents'] += older_sessions['sessions']
+            st.session_state['chat_history_cursor'] = older_sessions['next_cursor']
+            st.rerun()
 
     side_col1, side_col2 = st.sidebar.columns([2, 1])
 
     # Start new session button
     with side_col1:
         if st.button("Start New Session", use_container_width=True):
+            # Recent chats are reloaded from the database, pending writes go first
+            st.session_state['chats_unsaved'] = not chat_persister.flush()
             st.session_state.messages = []
             st.session_state['last_chat_id'] = None
             st.session_state['last_3_chat_contents'] = None
-            st.session_state['react_graph'] = build_graph(st.session_state['logged_user_details'])
+            st.session_state['thread_id'] = new_thread_id(st.session_state['logged_user_details']['username'])
             st.rerun()
 
     # Logout button
     with side_col2:
         if st.button("Logout", use_container_width=True):
+            if not chat_persister.flush():
+                print("[Chat Persist] chats still queued at logout, they are written in the background")
             st.session_state['logged_in'] = False
             st.session_state.messages = []
             st.session_state['processed_files'] = []
             st.session_state['logged_user_details'] = {}
             st.session_state['last_chat_id'] = None
             st.session_state['last_3_chat_contents'] = None
+            st.session_state['thread_id'] = None
             st.rerun()
 
     input_lang_code = LANGUAGE_OPTIONS[input_lang]["code"]
@@ -438,24 +571,35 @@ def home_page():
 
     with col1:
         if prompt := st.chat_input("Ask your questions here"):
-            generate_response(st.session_state['react_graph'], chat_container, prompt, output_lang, output_voice)
+            generate_response(get_graph(), chat_container, prompt, output_lang, output_voice)
 
     with col2:
         if st.button("🎤", use_container_width=True):
-            # Speech to Text
-            audio_config = speechsdk.AudioConfig(use_default_microphone=True)
-            speech_config.speech_recognition_language = input_lang_code
+            # Speech to Text, partial results are shown while the user speaks and file retrieval starts on the
+            # stable part of the question
+            retriever = SpeculativeRetriever(st.session_state['logged_user_details']['username'],
+                                             placed_file_names(st.session_state['processed_files']))
+            recognition = StreamingRecognition(AzureRecognitionBackend(input_lang_code, microphone=True),
+                                               on_stable_partial=retriever.speculate)
             with chat_container:
-                st.info('Listening...')
-            recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
-            result = recognizer.recognize_once_async().get()
-
-            if result.reason == speechsdk.ResultReason.RecognizedSpeech:
-                prompt = result.text
-                generate_response(st.session_state['react_graph'], chat_container, prompt, output_lang, output_voice)
+                listening_placeholder = st.empty()
+                listening_placeholder.info('Listening...')
+            recognition.start()
+            for kind, text in recognition.iter_events(stop_after_final=True):
+                listening_placeholder.info(f"🎤 {text}" if kind == 'partial' else text)
+            listening_placeholder.empty()
+            print(f"[Speech recognition] {recognition.metrics}")
+
+            if recognition.transcript != '':
+                prompt = recognition.transcript
+                prefetched_chunks = retriever.result_for(prompt)
+                print(f"[Speculative retrieval] {retriever.stats}")
+                retriever.close()
+                generate_response(get_graph(), chat_container, prompt, output_lang, output_voice, prefetched_chunks)
             else:
+                retriever.close()
                 with chat_container:
-                    st.error("Speech not recognized")
+                    st.error(f"Speech not recognized {recognition.error or ''}")
                     # time.sleep(2)
             # st.rerun()
 
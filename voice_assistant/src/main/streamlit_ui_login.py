@@ -1,7 +1,7 @@
 import hashlib
 import streamlit as st
 from langchain_neo4j import Neo4jGraph
-from operations_langgraph import build_graph
+from operations_checkpointer import new_thread_id
 
 
 # Function to handle login
@@ -94,7 +94,7 @@ def login_page():
         if st.button("Login"):
             if login(username, password):
                 st.session_state['logged_in'] = True
-                st.session_state['react_graph'] = build_graph(st.session_state['logged_user_details'])
+                st.session_state['thread_id'] = new_thread_id(username)
                 st.rerun()
             elif password == '':
                 st.error("Password is empty")
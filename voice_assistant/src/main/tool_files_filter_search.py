@@ -1,27 +1,28 @@
+import base64
 import os
 import re
 from typing import List, Optional, Dict
-import streamlit as st
 
 from langchain_core.messages import HumanMessage
 from langchain_core.tools import tool
-from langchain_neo4j import Neo4jGraph, Neo4jVector
-from langchain_openai import AzureOpenAIEmbeddings
 from langgraph.prebuilt import InjectedState
 from pydantic import BaseModel, Field
 from typing_extensions import Annotated
 
-NEO4J_URI = st.secrets['NEO4J_URI']
-NEO4J_USER = st.secrets['NEO4J_USER']
-NEO4J_PASSWORD = st.secrets['NEO4J_PASSWORD']
+from operations_artifact_store import artifact_store
+from operations_async_runtime import aquery
+from operations_config import get_secret
+from operations_context_packer import pack_whole_files, fill_packed_files
+from operations_query_cache import query_cache
+from operations_retrieval import asearch_user_chunks
+
+NEO4J_URI = get_secret('NEO4J_URI')
+NEO4J_USER = get_secret('NEO4J_USER')
+NEO4J_PASSWORD = get_secret('NEO4J_PASSWORD')
 os.environ["NEO4J_URI"] = NEO4J_URI
 os.environ["NEO4J_USERNAME"] = NEO4J_USER
 os.environ["NEO4J_PASSWORD"] = NEO4J_PASSWORD
 
-AZURE_EMBEDDING_MODEL = st.secrets['AZURE_EMBEDDING_MODEL']
-AZURE_EMBEDDING_ENDPOINT = st.secrets['AZURE_EMBEDDING_ENDPOINT']
-AZURE_EMBEDDING_KEY = st.secrets['AZURE_EMBEDDING_KEY']
-
 class UserFileFilterSearch(BaseModel):
     # username: Annotated[str, InjectedToolArg] = Field(
     #    description="Username filter, mandatory to check only for current username"
@@ -58,7 +59,7 @@ class UserFileFilterSearch(BaseModel):
 
 
 @tool("file-filter-search", args_schema=UserFileFilterSearch)
-def file_filter_search(
+async def file_filter_search(
         state: Annotated[dict, InjectedState],
         filter_file_name: Optional[List[str]] = None,
         filter_date_from: Optional[str] = None,
@@ -69,7 +70,8 @@ def file_filter_search(
 ) -> Dict:
     """This tool allows agents to search for current or previously uploaded files by the user. It supports:
     - Date Range Search: Use from_date and to_date (in UTC) to retrieve up to 4 of the latest files within that range.
-    - Filename Search: Provide a list of filenames to fetch full file contents directly.
+    - Filename Search: Provide a list of filenames to fetch full file contents directly. Files too long for the context
+        come back with coverage 'partial' (most relevant parts only) or 'summary_only', listed under 'packing'.
     - Similarity Search: Use similarity_search_message with keywords/phrases to find contextually similar files. This can be
         combined with date filters to narrow results.
     - Time Interpretation: User message timestamps are in UTC. Use them to resolve relative time references (e.g., "last week")
@@ -92,11 +94,6 @@ def file_filter_search(
         abc.png and xyz.png use this True with filter_file_name = ['abc.png', 'xyz.png'].
         You do not need to use ![chart]() format for this.
     """
-    embeddings = AzureOpenAIEmbeddings(
-        model=AZURE_EMBEDDING_MODEL,
-        azure_endpoint=AZURE_EMBEDDING_ENDPOINT,
-        api_key=AZURE_EMBEDDING_KEY,
-    )
     if 'messages' not in state:
         raise Exception('Could not fetch current session state')
 
@@ -113,89 +110,88 @@ def file_filter_search(
     username = human_message.metadata['user_details']['username']
     access_role = human_message.metadata['user_details']['role']
     date_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}$')
-    graph = Neo4jGraph()
 
     # Normal neo4j search
     if similarity_search_message is None:
-        if access_role == 'Admin':
-            file_filter = f"WHERE 1=1 "
-        elif access_role == 'User':
-            file_filter = f"WHERE u.username = '{username}' "
-        else:
-            file_filter = f"WHERE u.username = '{username}' "
+        file_filter = "WHERE 1=1 "
+        params = {'username': username, 'limit_by': limit_by, 'show_image': bool(show_image)}
+        if access_role != 'Admin':
+            file_filter += " AND u.username = $username"
 
         if filter_file_name is not None:
-            file_filter += f''' AND f.name IN [{",".join("'" + x + "'" for x in filter_file_name)}]'''
+            file_filter += " AND f.name IN $filter_file_name"
+            params['filter_file_name'] = filter_file_name
 
-        if filter_date_from is None and filter_date_till is None:
-            pass
-        elif filter_date_from is not None:
+        if filter_date_from is not None:
             if not date_pattern.match(filter_date_from):
                 raise ValueError('filter_date_from must be in yyyy-MM-dd format')
-            file_filter += f" AND f.timestamp >= '{filter_date_from}'"
-        elif filter_date_till is not None:
+            file_filter += " AND f.timestamp >= $filter_date_from"
+            params['filter_date_from'] = filter_date_from
+        if filter_date_till is not None:
             if not date_pattern.match(filter_date_till):
                 raise ValueError('filter_date_till must be in yyyy-MM-dd format')
-            file_filter += f" AND f.timestamp <= '{filter_date_till}'"
+            file_filter += " AND f.timestamp <= $filter_date_till"
+            params['filter_date_till'] = filter_date_till
 
         cypher_query = ("MATCH (u:User)-[:UPLOADED_FILE]->(f:File) "
                         + file_filter + " "
-                                        "WITH u, f ORDER BY f.timestamp DESC "
-                                        "LIMIT " + str(limit_by) + " "
-                                                                   "WITH f ORDER BY f.timestamp DESC "
-                                                                   "MATCH (f:File)-[:CHUNKED_INTO]->(c:Chunk) "
-                                                                   "ORDER BY c.chunk_no ASC "
-                                                                   "WITH f, COLLECT(c.text) AS texts "
-                                                                   "RETURN f as file_details, REDUCE(s = '', p IN texts | s + ' ' + p) AS file_contents")
-
-        graph_response = graph.query(cypher_query)
+                                        "WITH DISTINCT f ORDER BY f.timestamp DESC "
+                                        "LIMIT $limit_by "
+                                        "RETURN f {.name, .type, .summary, .timestamp, .date, .username} AS file_details, "
+                                        "COUNT { (f)-[:CHUNKED_INTO]->(:Chunk) } AS chunk_count, "
+                                        # Image bytes are only read from the database when they are shown
+                                        "CASE WHEN $show_image THEN f.data END AS image_data "
+                                        "ORDER BY f.timestamp DESC")
+
+        async def load_files():
+            files = await aquery(cypher_query, params)
+            return {"packing": await pack_whole_files(files), "image_data": [file['image_data'] for file in files]}
+
+        # File listings and the whole files that fit are served from the query cache until the user uploads again,
+        # the question is not part of the key
+        graph_response = await query_cache.aget_or_load('files', None if access_role == 'Admin' else username,
+                                                        {"query": "file_contents", **params}, load_files)
+
+        # Latest question of the user, ranks the chunks of files that do not fit the budget
+        latest_message = next((msg for msg in reversed(state['messages']) if isinstance(msg, HumanMessage)), None)
+        question = latest_message.metadata.get('user_query', latest_message.content)
+        packed_files, packing_report = await fill_packed_files(graph_response['packing'], question)
         return_dict = {}
 
+        # Images go to the artifact store, the response only carries handles the UI resolves
+        artifacts = []
+        for res, image_data in zip(packed_files, graph_response['image_data']):
+            if image_data is not None:
+                artifacts.append(artifact_store.put(base64.b64decode(image_data), res['file_details']['name'],
+                                                    'image'))
         if show_image:
-            return_dict['metadata'] = {}
-            return_dict['metadata']['image_data'] = {res['file_details']['name']: res['file_details']['data'] for res in
-                                                     graph_response if
-                                                     'data' in res['file_details'].keys()}
-
-        for res in graph_response:
-            if 'data' in res['file_details'].keys():
-                del res['file_details']['data']
-        return_dict['readable'] = graph_response
+            return_dict['metadata'] = {'artifacts': artifacts}
+        return_dict['readable'] = packed_files
+        # Files cut to fit the token budget, coverage 'partial' holds the most relevant chunks and 'summary_only'
+        # only the file summary
+        if len(packing_report['dropped']) > 0:
+            return_dict['packing'] = packing_report
 
         return return_dict
 
     # Neo4j similarity/Hybrid search
     else:
-        filters = {'username': username}
-        if filter_date_from is not None and filter_date_till is not None:
-            if not date_pattern.match(filter_date_from):
-                raise ValueError('filter_date_from must be in yyyy-MM-dd format')
-            if not date_pattern.match(filter_date_till):
-                raise ValueError('filter_date_from must be in yyyy-MM-dd format')
-            filters['timestamp'] = {'$between': [filter_date_from, filter_date_till]}
-        elif filter_date_from is not None:
-            if not date_pattern.match(filter_date_from):
-                raise ValueError('filter_date_from must be in yyyy-MM-dd format')
-            filters['timestamp'] = {'$gte': filter_date_from}
-        elif filter_date_till is not None:
-            if not date_pattern.match(filter_date_till):
-                raise ValueError('filter_date_from must be in yyyy-MM-dd format')
-            filters['timestamp'] = {'$lte': filter_date_till}
-
-        if filter_file_name is not None:
-            filters['name'] = {'$in': filter_file_name}
-
-        db = Neo4jVector(embedding=embeddings, node_label='Chunk', embedding_node_property='embedding')
-        search_result = db.similarity_search_with_score(query=similarity_search_message, k=limit_by, filter=filters)
+        if filter_date_from is not None and not date_pattern.match(filter_date_from):
+            raise ValueError('filter_date_from must be in yyyy-MM-dd format')
+        if filter_date_till is not None and not date_pattern.match(filter_date_till):
+            raise ValueError('filter_date_till must be in yyyy-MM-dd format')
+        search_result = await asearch_user_chunks(username, similarity_search_message, limit_by=limit_by,
+                                                  filter_file_name=filter_file_name,
+                                                  filter_date_from=filter_date_from, filter_date_till=filter_date_till)
 
         return_dict = {'readable': []}
         for res in search_result:
             formatted_doc_dict = {
-                "content": res[0].page_content,
-                "chunk_no": res[0].metadata['chunk_no'],
-                "origin_filename": res[0].metadata['origin_filename'],
-                "chunk_create_ts": res[0].metadata['chunk_create_ts']
+                "content": res['content'],
+                "chunk_no": res['chunk_no'],
+                "origin_filename": res['origin_filename'],
+                "chunk_create_ts": res['chunk_create_ts']
             }
-            return_dict['readable'].append({"chunk": formatted_doc_dict, "similarity_score": res[1]})
+            return_dict['readable'].append({"chunk": formatted_doc_dict, "similarity_score": res['similarity_score']})
 
         return return_dict
@@ -1,27 +1,25 @@
 import os
 import re
 from typing import Dict, Optional
-import streamlit as st
 
 from langchain_core.messages import HumanMessage
 from langchain_core.tools import tool
-from langchain_neo4j import Neo4jGraph
-from langchain_openai import AzureOpenAIEmbeddings
 from langgraph.prebuilt import InjectedState
 from pydantic import BaseModel, Field
 from typing_extensions import Annotated
 
-NEO4J_URI = st.secrets['NEO4J_URI']
-NEO4J_USER = st.secrets['NEO4J_USER']
-NEO4J_PASSWORD = st.secrets['NEO4J_PASSWORD']
+from operations_async_runtime import aquery
+from operations_config import get_secret
+from operations_query_cache import query_cache
+from operations_retrieval import embeddings
+
+NEO4J_URI = get_secret('NEO4J_URI')
+NEO4J_USER = get_secret('NEO4J_USER')
+NEO4J_PASSWORD = get_secret('NEO4J_PASSWORD')
 os.environ["NEO4J_URI"] = NEO4J_URI
 os.environ["NEO4J_USERNAME"] = NEO4J_USER
 os.environ["NEO4J_PASSWORD"] = NEO4J_PASSWORD
 
-AZURE_EMBEDDING_MODEL = st.secrets['AZURE_EMBEDDING_MODEL']
-AZURE_EMBEDDING_ENDPOINT = st.secrets['AZURE_EMBEDDING_ENDPOINT']
-AZURE_EMBEDDING_KEY = st.secrets['AZURE_EMBEDDING_KEY']
-
 class UserPreviousChatFilterSearch(BaseModel):
     state: Annotated[dict, InjectedState] = Field(
         description="Current conversation state"
@@ -43,15 +41,20 @@ class UserPreviousChatFilterSearch(BaseModel):
         default=10,
         le=10
     )
+    cursor: Optional[str] = Field(
+        description="next_cursor returned by a previous call, fetches the next older conversations",
+        default=None
+    )
 
 
 @tool("previous-chat-filter-search", args_schema=UserPreviousChatFilterSearch)
-def previous_chat_filter_search(
+async def previous_chat_filter_search(
         state: Annotated[dict, InjectedState],
         filter_date_from: Optional[str] = None,
         filter_date_till: Optional[str] = None,
         similarity_search_message: Optional[str] = None,
-        limit_by: Optional[int] = 10
+        limit_by: Optional[int] = 10,
+        cursor: Optional[str] = None
 ) -> Dict:
     """This tool allows agents to search past conversations with the current user. It supports:
     - Date Range Search: Use from_date and to_date (in UTC) to retrieve up to 10 recent messages within that range.
@@ -67,12 +70,9 @@ def previous_chat_filter_search(
     3. similarity_search_message - (optional) A text statement/phrase/set of keywords for which similarity search will
         be performed. This is optional, if you need all previous chat messages don't use this.
     4. limit_by - (optional) Defines how many messages can be fetched. By default, it will be 10 and at most it can be 10
+    5. cursor - (optional) When a result contains next_cursor, pass it here with the same filters to fetch older
+        conversations. Only used without similarity_search_message.
     """
-    embeddings = AzureOpenAIEmbeddings(
-        model=AZURE_EMBEDDING_MODEL,
-        azure_endpoint=AZURE_EMBEDDING_ENDPOINT,
-        api_key=AZURE_EMBEDDING_KEY,
-    )
     if 'messages' not in state:
         raise Exception('Could not fetch current session state')
 
@@ -89,77 +89,67 @@ def previous_chat_filter_search(
     username = human_message.metadata['user_details']['username']
     access_role = human_message.metadata['user_details']['role']
     date_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}$')
-    graph = Neo4jGraph()
 
-    if access_role == 'Admin':
-        chat_filter = f"WHERE 1=1 "
-    elif access_role == 'User':
-        chat_filter = f"WHERE u.username = '{username}' "
-    else:
-        chat_filter = f"WHERE u.username = '{username}' "
-
-    if filter_date_from is None and filter_date_till is None:
-        pass
-    elif filter_date_from is not None:
+    # Sessions are filtered on their activity window, Admin users search all sessions
+    session_filter = "WHERE 1=1 "
+    params = {'username': username, 'limit_by': limit_by}
+    if access_role != 'Admin':
+        session_filter += " AND s.username = $username"
+    if filter_date_from is not None:
         if not date_pattern.match(filter_date_from):
             raise ValueError('filter_date_from must be in yyyy-MM-dd format')
-        chat_filter += f" AND c.timestamp >= '{filter_date_from}'"
-    elif filter_date_till is not None:
+        session_filter += " AND s.last_activity >= $filter_date_from"
+        params['filter_date_from'] = filter_date_from
+    if filter_date_till is not None:
         if not date_pattern.match(filter_date_till):
             raise ValueError('filter_date_till must be in yyyy-MM-dd format')
-        chat_filter += f" AND c.timestamp <= '{filter_date_till}'"
+        # Dates are compared as prefixes of the stored 'yyyy-MM-dd HH:mm:ss' timestamps
+        session_filter += " AND s.started_at < $filter_date_till + 'z'"
+        params['filter_date_till'] = filter_date_till
 
-    # Normal neo4j search
+    # Chats of a session in turn order, one hop from the Session node
+    session_chats = ("CALL { WITH s MATCH (s)-[h:HAS_CHAT]->(d:Chat) WITH h, d ORDER BY h.turn_no "
+                     "RETURN COLLECT({user_query: d.user_query, agent_response: d.agent_response}) AS chat_content } ")
+
+    # Normal neo4j search, newest sessions first with keyset pagination
     if similarity_search_message is None:
-        cypher_query = ("MATCH (u:User)-[:CONVERSED]->(c:Chat) "
-                        + chat_filter + " "
-                                        "WITH u, c ORDER BY c.timestamp DESC "
-                                        "LIMIT " + str(limit_by) + " "
-                                                                   "MATCH (c:Chat)-[FOLLOWED_BY*0..]->(d:Chat) "
-                                                                   "WITH c.timestamp AS timestamp, {user_query: d.user_query, agent_response: d.agent_response} AS combined "
-                                                                   "WITH timestamp, COLLECT(combined) AS chat_content "
-                                                                   "RETURN timestamp, chat_content")
-
-        return_dict = {'readable': graph.query(cypher_query)}
+        if cursor is not None:
+            cursor_activity, _, cursor_id = cursor.partition('|')
+            session_filter += (" AND (s.last_activity < $cursor_activity "
+                               "OR (s.last_activity = $cursor_activity AND s.id < $cursor_id))")
+            params['cursor_activity'] = cursor_activity
+            params['cursor_id'] = cursor_id
+        cypher_query = ("MATCH (s:Session) " + session_filter + " "
+                        "WITH s ORDER BY s.last_activity DESC, s.id DESC LIMIT $limit_by "
+                        + session_chats +
+                        "RETURN s.started_at AS timestamp, s.last_activity AS last_activity, s.id AS session_id, "
+                        "chat_content ORDER BY last_activity DESC, session_id DESC")
+        # Repeated history reads are served from the query cache until new chats are stored
+        search_result = await query_cache.aget_or_load('chats', None if access_role == 'Admin' else username,
+                                                       {"query": "session_history", **params},
+                                                       lambda: aquery(cypher_query, params))
+
+        return_dict = {'readable': [{"timestamp": res['timestamp'], "chat_content": res['chat_content']}
+                                    for res in search_result]}
+        if len(search_result) == limit_by:
+            # Pass as cursor to get older conversations
+            return_dict['next_cursor'] = f"{search_result[-1]['last_activity']}|{search_result[-1]['session_id']}"
         return return_dict
 
-    # Neo4j similarity/Hybrid search
+    # Neo4j similarity/Hybrid search, a session scores as its best matching chat
     else:
-        #   filters = {'username': username}
-        #   if filter_date_from is not None and filter_date_till is not None:
-        #       if not date_pattern.match(filter_date_from):
-        #           raise ValueError('filter_date_from must be in yyyy-MM-dd format')
-        #       if not date_pattern.match(filter_date_till):
-        #           raise ValueError('filter_date_from must be in yyyy-MM-dd format')
-        #       filters['timestamp'] = {'$between': [filter_date_from, filter_date_till]}
-        #   elif filter_date_from is not None:
-        #       if not date_pattern.match(filter_date_from):
-        #           raise ValueError('filter_date_from must be in yyyy-MM-dd format')
-        #       filters['timestamp'] = {'$gte': filter_date_from}
-        #   elif filter_date_till is not None:
-        #       if not date_pattern.match(filter_date_till):
-        #           raise ValueError('filter_date_from must be in yyyy-MM-dd format')
-        #       filters['timestamp'] = {'$lte': filter_date_till}
-        #   db = Neo4jVector(embedding=embeddings, node_label='Chat', embedding_node_property='embedding')
-        #   search_result = db.similarity_search_with_score(query=similarity_search_message, k=limit_by, filter=filters)
-
-        embedding_vector = embeddings.embed_query(similarity_search_message)
-        cypher_message = ("MATCH (u:User)-[:CONVERSED]->(c:Chat) "
-                          + chat_filter + " "
-                                          "WITH u, c, apoc.convert.fromJsonList(c.embedding) AS embedding "
-                                          "WITH u, c, vector.similarity.cosine(embedding, " + str(
-                    embedding_vector) + ") AS similarity_score "
-                                        "ORDER BY similarity_score DESC LIMIT " + str(limit_by) + " "
-                                                                                                  "WITH c AS chat, similarity_score "
-                                                                                                  "MATCH (chat)-[FOLLOWED_BY*0..]->(d:Chat) "
-                                                                                                  "WITH chat.timestamp AS timestamp, similarity_score, {user_query: d.user_query, agent_response: d.agent_response} AS single_chat "
-                                                                                                  "WITH timestamp, similarity_score, COLLECT(single_chat) AS chat_flow "
-                                                                                                  "RETURN timestamp, similarity_score, chat_flow ")
-
-        search_result = graph.query(cypher_message)
+        params['embedding'] = await embeddings.aembed_query(similarity_search_message)
+        cypher_message = ("MATCH (s:Session)-[:HAS_CHAT]->(c:Chat) " + session_filter + " "
+                          "WITH s, MAX(vector.similarity.cosine(apoc.convert.fromJsonList(c.embedding), $embedding)) "
+                          "AS similarity_score "
+                          "ORDER BY similarity_score DESC LIMIT $limit_by "
+                          + session_chats +
+                          "RETURN s.started_at AS timestamp, similarity_score, chat_content AS chat_flow "
+                          "ORDER BY similarity_score DESC")
+
+        search_result = await aquery(cypher_message, params)
 
         return_dict = {'readable': []}
-        print(search_result)
         for res in search_result:
             formatted_doc_dict = {
                 "full_chat": res['chat_flow'],
@@ -0,0 +1,27 @@
+import os
+import sys
+import tempfile
+
+# Modules are imported the way the app runs them, from src/main
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'main'))
+
+# Configuration read at import time, environment variables take precedence over secrets.toml. The tests never
+# reach these services
+_TEST_SECRETS = {
+    'NEO4J_URI': 'bolt://localhost:7687',
+    'NEO4J_USER': 'neo4j',
+    'NEO4J_PASSWORD': 'test',
+    'AZURE_OPENAI_MODEL': 'test',
+    'AZURE_OPENAI_ENDPOINT': 'https://localhost',
+    'AZURE_OPENAI_KEY': 'test',
+    'AZURE_OPENAI_VERSION': '2024-10-21',
+    'AZURE_EMBEDDING_MODEL': 'test',
+    'AZURE_EMBEDDING_ENDPOINT': 'https://localhost',
+    'AZURE_EMBEDDING_KEY': 'test',
+    'OPENAI_API_VERSION': '2024-10-21',
+    'AZURE_SPEECH_KEY': 'test',
+    'AZURE_REGION': 'westeurope',
+    'TTS_CACHE_DIR': os.path.join(tempfile.gettempdir(), 'voice_assistant_tests_tts_cache'),
+}
+for key, value in _TEST_SECRETS.items():
+    os.environ.setdefault(key, value)
@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip('streamlit')
+
+import operations_artifact_store
+from operations_artifact_store import ArtifactStore
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(operations_artifact_store.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_handle_resolves_to_the_bytes():
+    store = ArtifactStore()
+    handle = store.put(b'image bytes', 'chart.png', 'image')
+    assert handle['name'] == 'chart.png' and handle['kind'] == 'image'
+    assert store.get(handle['artifact_id']) == b'image bytes'
+    assert store.get('unknown') is None
+
+
+def test_same_content_is_stored_once():
+    store = ArtifactStore()
+    first = store.put(b'image bytes', 'a.png', 'image')
+    second = store.put(b'image bytes', 'b.png', 'image')
+    assert first['artifact_id'] == second['artifact_id']
+    assert store.stats == {"artifacts": 1, "bytes": len(b'image bytes')}
+
+
+def test_artifacts_expire(clock):
+    store = ArtifactStore(ttl_seconds=60)
+    handle = store.put(b'image bytes', 'a.png', 'image')
+    clock[0] += 59
+    assert store.get(handle['artifact_id']) == b'image bytes'
+    clock[0] += 1
+    assert store.get(handle['artifact_id']) is None
+    assert store.stats == {"artifacts": 0, "bytes": 0}
+
+
+def test_storing_again_renews_the_ttl(clock):
+    store = ArtifactStore(ttl_seconds=60)
+    handle = store.put(b'image bytes', 'a.png', 'image')
+    clock[0] += 50
+    store.put(b'image bytes', 'a.png', 'image')
+    clock[0] += 50
+    assert store.get(handle['artifact_id']) == b'image bytes'
+
+
+def test_least_recently_used_are_evicted_over_the_size_limit():
+    store = ArtifactStore(max_bytes=25)
+    first = store.put(b'a' * 10, 'a', 'image')
+    second = store.put(b'b' * 10, 'b', 'image')
+    # Read recently, kept over the second one
+    store.get(first['artifact_id'])
+    third = store.put(b'c' * 10, 'c', 'image')
+    assert store.get(second['artifact_id']) is None
+    assert store.get(first['artifact_id']) is not None and store.get(third['artifact_id']) is not None
+    assert store.stats['bytes'] == 20
+
+
+def test_artifact_over_the_limit_is_kept_alone():
+    store = ArtifactStore(max_bytes=25)
+    store.put(b'a' * 10, 'a', 'image')
+    large = store.put(b'b' * 40, 'b', 'image')
+    assert store.get(large['artifact_id']) == b'b' * 40
+    assert store.stats == {"artifacts": 1, "bytes": 40}
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('fitz')
+pytest.importorskip('langchain_community')
+pytest.importorskip('langchain_neo4j')
+
+import operations_batch_ingest
+from operations_batch_ingest import collect_files, duplicate_names, file_signature, load_checkpoint, run_ingestion
+
+
+def write(path, text='text'):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+def test_collect_files_walks_supported_extensions(tmp_path):
+    write(tmp_path / 'docs' / 'b.pdf')
+    write(tmp_path / 'docs' / 'a.txt')
+    write(tmp_path / 'docs' / 'nested' / 'c.md')
+    write(tmp_path / 'docs' / 'skip.exe')
+    files = collect_files(directory=str(tmp_path / 'docs'))
+    assert [os.path.relpath(file, tmp_path) for file in files] == [
+        os.path.join('docs', 'a.txt'), os.path.join('docs', 'b.pdf'), os.path.join('docs', 'nested', 'c.md')]
+    assert all(os.path.isabs(file) for file in files)
+
+
+def test_collect_files_reads_manifest_without_repeats(tmp_path):
+    first = write(tmp_path / 'docs' / 'a.txt')
+    manifest = tmp_path / 'files.txt'
+    manifest.write_text(f'# comment\n\n{first}\n{first}\n', encoding='utf-8')
+    assert collect_files(directory=str(tmp_path / 'docs'), manifest=str(manifest)) == [first]
+
+
+def test_duplicate_names_keep_the_first_file(tmp_path):
+    files = [str(tmp_path / 'a' / 'report.pdf'), str(tmp_path / 'b' / 'report.pdf'), str(tmp_path / 'c.pdf')]
+    assert duplicate_names(files) == {files[1]: files[0]}
+
+
+def test_load_checkpoint_keeps_done_files_only(tmp_path):
+    checkpoint = tmp_path / 'checkpoint.jsonl'
+    checkpoint.write_text(json.dumps({"file": "a", "signature": "a|1|1", "status": "done"}) + '\n'
+                          + json.dumps({"file": "b", "signature": "b|1|1", "status": "failed"}) + '\n'
+                          # Cut short by a crash
+                          + '{"file": "c", "signa', encoding='utf-8')
+    assert load_checkpoint(str(checkpoint)) == {"a|1|1"}
+    assert load_checkpoint(str(tmp_path / 'missing.jsonl')) == set()
+    assert load_checkpoint(None) == set()
+
+
+@pytest.fixture
+def ingested(monkeypatch):
+    ingested = []
+
+    def process_file(file, username):
+        ingested.append(file)
+        return {"name": os.path.basename(file)}
+
+    monkeypatch.setattr(operations_batch_ingest, 'process_file', process_file)
+    return ingested
+
+
+def test_run_ingestion_resumes_from_checkpoint(tmp_path, ingested):
+    files = [write(tmp_path / 'a.txt'), write(tmp_path / 'b.txt')]
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    summary = asyncio.run(run_ingestion(files, 'user', checkpoint_path=checkpoint, ingest_workers=2))
+    assert summary['files_done'] == 2 and summary['files_failed'] == 0
+    assert load_checkpoint(checkpoint) == {file_signature(file) for file in files}
+
+    # A changed file is ingested again, the other one is skipped
+    write(tmp_path / 'b.txt', 'changed text')
+    ingested.clear()
+    summary = asyncio.run(run_ingestion(files, 'user', checkpoint_path=checkpoint, ingest_workers=2))
+    assert ingested == [files[1]]
+    assert summary['files_skipped'] == 1 and summary['files_done'] == 1
+
+
+def test_run_ingestion_fails_duplicate_names_and_missing_files(tmp_path, ingested):
+    first = write(tmp_path / 'a' / 'report.txt')
+    duplicate = write(tmp_path / 'b' / 'report.txt')
+    missing = str(tmp_path / 'missing.txt')
+    summary = asyncio.run(run_ingestion([first, duplicate, missing], 'user', ingest_workers=2))
+    assert ingested == [first]
+    assert summary['files_done'] == 1 and summary['files_failed'] == 2
+
+
+def test_worker_records_unreadable_file_as_failed(tmp_path, monkeypatch, ingested):
+    files = [write(tmp_path / 'a.txt'), write(tmp_path / 'b.txt')]
+
+    # Removed after it was queued
+    def process_file(file, username):
+        raise FileNotFoundError(file)
+
+    monkeypatch.setattr(operations_batch_ingest, 'process_file', process_file)
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    summary = asyncio.run(run_ingestion(files, 'user', checkpoint_path=checkpoint, ingest_workers=1))
+    assert summary['files_failed'] == 2
+    with open(checkpoint, 'r', encoding='utf-8') as f:
+        assert [json.loads(line)['status'] for line in f] == ['failed', 'failed']
@@ -0,0 +1,109 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('langchain_core')
+pytest.importorskip('langchain_openai')
+
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage
+
+import operations_compaction
+from operations_compaction import compact_thread, messages_to_compact, thread_lock
+
+
+# One token per word of the history
+class WordBudget:
+    def count(self, messages):
+        return sum(len(message.content.split()) for message in messages)
+
+
+@pytest.fixture(autouse=True)
+def small_limits(monkeypatch):
+    monkeypatch.setattr(operations_compaction, 'context_budget', WordBudget())
+    monkeypatch.setattr(operations_compaction, 'COMPACTION_TRIGGER_TOKENS', 50)
+    monkeypatch.setattr(operations_compaction, 'KEEP_RECENT_TURNS', 2)
+    monkeypatch.setattr(operations_compaction, 'summarise', lambda summary, messages: f'{len(messages)} folded')
+
+
+def turns(count, words=10):
+    messages = []
+    for i in range(count):
+        messages.append(HumanMessage(content=' '.join(['question'] * words), id=f'h{i}'))
+        messages.append(AIMessage(content=' '.join(['answer'] * words), id=f'a{i}'))
+    return messages
+
+
+def test_few_turns_are_not_compacted():
+    assert messages_to_compact(turns(2, words=100)) == []
+
+
+def test_short_history_is_not_compacted():
+    assert messages_to_compact(turns(4, words=2)) == []
+
+
+def test_turns_before_the_recent_ones_are_compacted():
+    messages = turns(4)
+    assert messages_to_compact(messages) == messages[:4]
+
+
+# Checkpointer replaced by the thread state held in memory
+class FakeGraph:
+    def __init__(self, messages):
+        self.values = {"messages": messages, "summary": ''}
+        self.updates = []
+        # Runs once summarisation has read the state, like a turn answered meanwhile
+        self.during_summary = None
+
+    def get_state(self, config):
+        values = dict(self.values)
+        if self.during_summary is not None:
+            self.during_summary, during_summary = None, self.during_summary
+            during_summary(self)
+        return SimpleNamespace(values=values)
+
+    def update_state(self, config, values, as_node=None):
+        self.updates.append(values)
+        removed = set(message.id for message in values['messages'] if isinstance(message, RemoveMessage))
+        self.values = {"messages": [message for message in self.values['messages'] if message.id not in removed],
+                       "summary": values['summary']}
+
+
+def config(thread_id):
+    return {"configurable": {"thread_id": thread_id}}
+
+
+def test_compaction_replaces_old_turns_with_the_summary():
+    graph = FakeGraph(turns(4))
+    assert compact_thread(graph, config('compact'))
+    assert graph.values['summary'] == '4 folded'
+    assert [message.id for message in graph.values['messages']] == ['h2', 'a2', 'h3', 'a3']
+
+
+def test_turn_answered_during_summarisation_is_kept():
+    graph = FakeGraph(turns(4))
+    graph.during_summary = lambda g: g.values.update(messages=g.values['messages'] + turns(5)[-2:])
+    assert compact_thread(graph, config('appended'))
+    assert [message.id for message in graph.values['messages']] == ['h2', 'a2', 'h3', 'a3', 'h4', 'a4']
+
+
+def test_compaction_is_skipped_when_the_thread_changed():
+    graph = FakeGraph(turns(4))
+    graph.during_summary = lambda g: g.values.update(summary='written elsewhere')
+    assert not compact_thread(graph, config('changed'))
+    assert graph.updates == []
+
+
+def test_compaction_waits_for_the_running_turn():
+    graph = FakeGraph(turns(4))
+    lock = thread_lock('busy')
+    assert lock is thread_lock('busy')
+    with lock:
+        worker = threading.Thread(target=compact_thread, args=(graph, config('busy')))
+        worker.start()
+        worker.join(timeout=0.2)
+        # Summarised, but not written while the turn holds the thread
+        assert worker.is_alive() and graph.updates == []
+    worker.join(timeout=5)
+    assert len(graph.updates) == 1
@@ -0,0 +1,119 @@
+import json
+
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('langchain_core')
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+import operations_context_budget
+from operations_context_budget import ContextBudget, EVICTED_TOOL_OUTPUT, MESSAGE_OVERHEAD_TOKENS
+
+
+# One token per word keeps the budgets in the tests readable
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(operations_context_budget, 'count_text_tokens', lambda text: len(text.split()))
+    monkeypatch.setattr(operations_context_budget, 'truncate_text_tokens',
+                        lambda text, limit: ' '.join(text.split()[:limit]))
+
+
+def words(count, word='w'):
+    return ' '.join([word] * count)
+
+
+def turn(index, tool_words=0):
+    messages = [HumanMessage(content=words(5, 'question'), id=f'h{index}')]
+    if tool_words > 0:
+        messages.append(AIMessage(content='', id=f'a{index}', tool_calls=[
+            {"name": "file-filter-search", "args": {}, "id": f'call{index}'}]))
+        messages.append(ToolMessage(content=words(tool_words), name='file-filter-search',
+                                    tool_call_id=f'call{index}', id=f't{index}'))
+    messages.append(AIMessage(content=words(5, 'answer'), id=f'r{index}'))
+    return messages
+
+
+def test_history_within_budget_is_unchanged():
+    messages = turn(1, tool_words=20) + turn(2)
+    selected, metrics = ContextBudget(budget=1000).fit(messages)
+    assert selected == messages
+    assert metrics['tool_outputs_evicted'] == 0 and metrics['turns_dropped'] == 0 and metrics['truncated'] == 0
+
+
+def test_old_tool_outputs_are_evicted_first():
+    messages = turn(1, tool_words=200) + turn(2)
+    budget = ContextBudget(budget=100)
+    selected, metrics = budget.fit(messages)
+    assert len(selected) == len(messages)
+    assert selected[2].content == EVICTED_TOOL_OUTPUT
+    assert metrics['tool_outputs_evicted'] == 1 and metrics['turns_dropped'] == 0
+    assert metrics['prompt_tokens'] <= 100
+
+
+def test_old_turns_are_dropped_whole():
+    messages = turn(1) + turn(2) + turn(3)
+    per_message = 5 + MESSAGE_OVERHEAD_TOKENS
+    selected, metrics = ContextBudget(budget=4 * per_message).fit(messages)
+    assert selected == messages[2:]
+    assert metrics['turns_dropped'] == 1
+
+
+def test_current_turn_is_kept_and_its_largest_tool_output_truncated():
+    messages = turn(1, tool_words=500)
+    selected, metrics = ContextBudget(budget=200).fit(messages)
+    assert len(selected) == len(messages)
+    assert isinstance(selected[0], HumanMessage)
+    assert metrics['truncated'] >= 1
+    assert len(selected[2].content.split()) < 500
+    assert metrics['prompt_tokens'] <= 200
+
+
+def test_system_tokens_count_against_budget():
+    messages = turn(1) + turn(2)
+    total = ContextBudget().count(messages)
+    _, metrics = ContextBudget(budget=total).fit(messages, system_tokens=1)
+    assert metrics['turns_dropped'] == 1
+
+
+def test_ui_metadata_is_stripped_from_file_search_output():
+    content = json.dumps({"readable": [words(3)], "metadata": {"artifacts": [{"artifact_id": "x" * 32}]}})
+    message = ToolMessage(content=content, name='file-filter-search', tool_call_id='call1', id='t1')
+    selected, _ = ContextBudget(budget=1000).fit([HumanMessage(content='q', id='h1'), message])
+    assert 'metadata' not in json.loads(selected[1].content)
+    # The stored message is left as it was
+    assert 'metadata' in json.loads(message.content)
+
+
+def test_running_total_follows_appended_messages():
+    budget = ContextBudget(budget=1000)
+    messages = turn(1)
+    _, first = budget.fit(messages, thread_id='thread')
+    _, second = budget.fit(messages + turn(2), thread_id='thread')
+    assert second['history_tokens'] == first['history_tokens'] + budget.count(turn(2))
+    # Messages removed from the thread are recounted
+    _, third = budget.fit(turn(2), thread_id='thread')
+    assert third['history_tokens'] == budget.count(turn(2))
+
+
+def test_only_appended_messages_are_prepared(monkeypatch):
+    budget = ContextBudget(budget=1000)
+    prepared = []
+    prepare = budget._prepare
+    monkeypatch.setattr(budget, '_prepare', lambda message: prepared.append(message.id) or prepare(message))
+    messages = turn(1, tool_words=20)
+    budget.fit(messages, thread_id='thread')
+    selected, _ = budget.fit(messages + turn(2), thread_id='thread')
+    assert prepared == [message.id for message in messages + turn(2)]
+    assert [message.id for message in selected] == [message.id for message in messages + turn(2)]
+
+
+def test_evicting_for_one_call_leaves_the_thread_intact():
+    budget = ContextBudget(budget=100)
+    messages = turn(1, tool_words=200) + turn(2)
+    selected, _ = budget.fit(messages, thread_id='thread')
+    assert selected[2].content == EVICTED_TOOL_OUTPUT
+    # A larger budget on the next call sees the original output again
+    budget.budget = 1000
+    selected, metrics = budget.fit(messages + turn(3), thread_id='thread')
+    assert selected[2].content == words(200) and metrics['tool_outputs_evicted'] == 0
@@ -0,0 +1,161 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('langchain_core')
+pytest.importorskip('langchain_openai')
+pytest.importorskip('neo4j')
+
+import operations_context_packer
+from operations_context_packer import fill_packed_files, pack_file_contents, pack_whole_files
+
+
+# Neo4j replaced by chunk rows held in memory, one token per word
+class FakeNeo4j:
+    def __init__(self, chunks):
+        # file name -> chunk texts in order
+        self.chunks = chunks
+        self.rows_streamed = 0
+        self.queries = []
+
+    async def astream(self, cypher, params=None):
+        for file_index, ref in enumerate(params['files']):
+            for chunk_no, text in enumerate(self.chunks[ref['name']], start=1):
+                self.rows_streamed += 1
+                yield {"file_index": file_index, "chunk_no": chunk_no, "text": text}
+
+    async def aquery(self, cypher, params=None):
+        self.queries.append((cypher, params))
+        rows = [{"chunk_no": chunk_no, "text": text}
+                for chunk_no, text in enumerate(self.chunks[params['name']], start=1)]
+        if 'embedding' in params:
+            # Later chunks are the most relevant ones
+            rows.reverse()
+        return rows[:params['limit']]
+
+
+class FakeEmbeddings:
+    async def aembed_query(self, text):
+        return [0.1, 0.2]
+
+
+@pytest.fixture
+def neo4j(monkeypatch):
+    def install(chunks):
+        fake = FakeNeo4j(chunks)
+        monkeypatch.setattr(operations_context_packer, 'astream', fake.astream)
+        monkeypatch.setattr(operations_context_packer, 'aquery', fake.aquery)
+        return fake
+
+    monkeypatch.setattr(operations_context_packer, 'count_text_tokens', lambda text: len(text.split()))
+    monkeypatch.setattr(operations_context_packer, 'embeddings', FakeEmbeddings())
+    return install
+
+
+def files_of(chunks):
+    return [{"file_details": {"name": name, "username": "user"}, "chunk_count": len(texts)}
+            for name, texts in chunks.items()]
+
+
+def chunk(count, word='w'):
+    return ' '.join([word] * count)
+
+
+def test_files_within_budget_are_included_whole(neo4j):
+    chunks = {"a.txt": [chunk(50), chunk(50)], "b.txt": [chunk(100)]}
+    fake = neo4j(chunks)
+    results, report = asyncio.run(pack_file_contents(files_of(chunks), 'question', budget=1000))
+    assert [result['coverage'] for result in results] == ['full', 'full']
+    assert results[0]['file_contents'] == chunk(50) + ' ' + chunk(50)
+    assert report['tokens_used'] == 200 and report['dropped'] == []
+    # Nothing overflowed, relevance is never computed
+    assert fake.queries == []
+
+
+def test_file_over_the_budget_gets_its_most_relevant_chunks(neo4j):
+    chunks = {"a.txt": [chunk(100)], "big.txt": [chunk(100, 'x'), chunk(100, 'y'), chunk(100, 'z')]}
+    fake = neo4j(chunks)
+    results, report = asyncio.run(pack_file_contents(files_of(chunks), 'question', budget=350))
+    assert results[0]['coverage'] == 'full'
+    assert results[1]['coverage'] == 'partial'
+    # Ranked last chunks first, two fit in the 250 tokens left, contents stay in file order
+    assert results[1]['file_contents'] == chunk(100, 'y') + ' ' + chunk(100, 'z')
+    assert report['dropped'] == [{"name": "big.txt", "coverage": "partial", "dropped_chunks": 1}]
+    assert 'embedding' in fake.queries[0][1]
+
+
+def test_without_question_the_start_of_the_file_is_used(neo4j):
+    chunks = {"big.txt": [chunk(100, 'x'), chunk(100, 'y'), chunk(100, 'z')]}
+    fake = neo4j(chunks)
+    results, _ = asyncio.run(pack_file_contents(files_of(chunks), None, budget=150))
+    assert results[0]['file_contents'] == chunk(100, 'x')
+    assert 'embedding' not in fake.queries[0][1]
+
+
+def test_streaming_stops_once_the_budget_is_used(neo4j):
+    chunks = {"a.txt": [chunk(95)], "b.txt": [chunk(10)] * 50}
+    fake = neo4j(chunks)
+    results, report = asyncio.run(pack_file_contents(files_of(chunks), None, budget=150))
+    # Less than MIN_PACK_TOKENS left after the first file, the second is only summarised
+    assert fake.rows_streamed == 1
+    assert [result['coverage'] for result in results] == ['full', 'summary_only']
+    assert report['dropped'] == [{"name": "b.txt", "coverage": "summary_only", "dropped_chunks": 50}]
+
+
+def test_whole_file_pass_is_independent_of_the_question(neo4j):
+    chunks = {"a.txt": [chunk(100)], "big.txt": [chunk(100, 'x'), chunk(100, 'y'), chunk(100, 'z')]}
+    fake = neo4j(chunks)
+    packing = asyncio.run(pack_whole_files(files_of(chunks), budget=350))
+    assert fake.queries == []
+    assert packing['remaining'] == 250
+    assert [file['overflowed'] for file in packing['files']] == [False, True]
+
+    with_question, _ = asyncio.run(fill_packed_files(packing, 'question'))
+    without_question, _ = asyncio.run(fill_packed_files(packing, None))
+    assert with_question[1]['file_contents'] != without_question[1]['file_contents']
+    # The cached pass is not modified by filling it
+    assert packing['files'][1]['chunks'] == []
+
+
+def test_no_files():
+    results, report = asyncio.run(pack_file_contents([], 'question', budget=100))
+    assert results == [] and report['dropped'] == [] and report['tokens_used'] == 0
+
+
+def test_relevant_chunks_come_from_the_vector_index(neo4j):
+    chunks = {"a.txt": [chunk(100)], "big.txt": [chunk(100, 'x'), chunk(100, 'y'), chunk(100, 'z')]}
+    fake = neo4j(chunks)
+    asyncio.run(pack_file_contents(files_of(chunks), 'question', budget=350))
+    assert len(fake.queries) == 1
+    assert 'db.index.vector.queryNodes' in fake.queries[0][0]
+
+
+def test_exact_scan_while_the_index_is_unavailable(neo4j, monkeypatch):
+    chunks = {"a.txt": [chunk(100)], "big.txt": [chunk(100, 'x'), chunk(100, 'y'), chunk(100, 'z')]}
+    fake = neo4j(chunks)
+
+    async def aquery(cypher, params=None):
+        if 'db.index.vector.queryNodes' in cypher:
+            raise Exception('There is no such vector schema index: vector')
+        return await fake.aquery(cypher, params)
+
+    monkeypatch.setattr(operations_context_packer, 'aquery', aquery)
+    results, _ = asyncio.run(pack_file_contents(files_of(chunks), 'question', budget=350))
+    assert results[1]['file_contents'] == chunk(100, 'y') + ' ' + chunk(100, 'z')
+    assert 'vector.similarity.cosine' in fake.queries[0][0]
+
+
+def test_exact_scan_when_other_files_crowd_out_the_index(neo4j, monkeypatch):
+    chunks = {"a.txt": [chunk(100)], "big.txt": [chunk(100, 'x'), chunk(100, 'y'), chunk(100, 'z')]}
+    fake = neo4j(chunks)
+
+    async def aquery(cypher, params=None):
+        rows = await fake.aquery(cypher, params)
+        # Only one chunk of the file is among the nearest ones overall
+        return rows[:1] if 'db.index.vector.queryNodes' in cypher else rows
+
+    monkeypatch.setattr(operations_context_packer, 'aquery', aquery)
+    results, _ = asyncio.run(pack_file_contents(files_of(chunks), 'question', budget=350))
+    assert results[1]['file_contents'] == chunk(100, 'y') + ' ' + chunk(100, 'z')
+    assert 'vector.similarity.cosine' in fake.queries[1][0]
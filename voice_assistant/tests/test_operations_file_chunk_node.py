@@ -0,0 +1,96 @@
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('fitz')
+pytest.importorskip('langchain_community')
+pytest.importorskip('langchain_neo4j')
+
+from langchain_core.documents import Document
+
+import operations_file_chunk_node
+from operations_file_chunk_node import chunk_id, write_chunk_batch
+
+
+# Neo4j replaced by the chunk ids already stored with an embedding
+class FakeGraph:
+    def __init__(self, stored, recreated=()):
+        self.stored = set(stored)
+        # Chunks another upload removed between the lookup and the write
+        self.recreated = list(recreated)
+        self.links = []
+        self.embedded_again = []
+        self.index_dimensions = None
+
+    def query(self, cypher, params=None):
+        if cypher.startswith('MATCH (c:Chunk) WHERE c.id IN $ids'):
+            return [{"id": k} for k in params['ids'] if k in self.stored]
+        if cypher.startswith('CREATE VECTOR INDEX'):
+            self.index_dimensions = params['dimensions']
+            return []
+        if 'UNWIND $links' in cypher:
+            self.links = params['links']
+            self.stored.update(params['vectors'])
+            return [{"id": k} for k in self.recreated]
+        if 'UNWIND $rows' in cypher:
+            self.embedded_again = [row['id'] for row in params['rows']]
+            return []
+        raise AssertionError(cypher)
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.texts = []
+
+    def embed_documents(self, texts):
+        self.texts.extend(texts)
+        return [[0.1, 0.2, 0.3] for _ in texts]
+
+
+class FakeRateLimiter:
+    def acquire(self, tokens):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def rate_limiter(monkeypatch):
+    monkeypatch.setattr(operations_file_chunk_node, 'embedding_rate_limiter', FakeRateLimiter())
+
+
+def documents(*texts):
+    return [Document(page_content=text, metadata={"chunk_no": i, "page": 1, "source": '/spool/a.pdf'})
+            for i, text in enumerate(texts, start=1)]
+
+
+def test_only_new_text_is_embedded():
+    graph = FakeGraph(stored=[chunk_id('known text')])
+    embeddings = FakeEmbeddings()
+    write_chunk_batch(graph, embeddings, 'a.pdf', 'user', documents('known text', 'new text'), 'upload')
+    assert embeddings.texts == ['new text']
+    assert graph.index_dimensions == 3
+    assert [link['chunk_no'] for link in graph.links] == [1, 2]
+    # Spool paths are not kept on the relationship
+    assert graph.links[0]['properties'] == {"chunk_no": 1, "page": 1}
+
+
+def test_repeated_text_in_a_batch_is_embedded_once():
+    graph = FakeGraph(stored=[])
+    embeddings = FakeEmbeddings()
+    write_chunk_batch(graph, embeddings, 'a.pdf', 'user', documents('same text', 'same text'), 'upload')
+    assert embeddings.texts == ['same text']
+    # Both positions are linked to the one chunk
+    assert [link['id'] for link in graph.links] == [chunk_id('same text')] * 2
+
+
+def test_stored_text_makes_no_embedding_call():
+    graph = FakeGraph(stored=[chunk_id('known text')])
+    embeddings = FakeEmbeddings()
+    write_chunk_batch(graph, embeddings, 'a.pdf', 'user', documents('known text'), 'upload')
+    assert embeddings.texts == [] and graph.index_dimensions is None
+
+
+def test_chunk_removed_after_the_lookup_is_embedded_again():
+    graph = FakeGraph(stored=[chunk_id('known text')], recreated=[chunk_id('known text')])
+    embeddings = FakeEmbeddings()
+    write_chunk_batch(graph, embeddings, 'a.pdf', 'user', documents('known text'), 'upload')
+    assert embeddings.texts == ['known text']
+    assert graph.embedded_again == [chunk_id('known text')]
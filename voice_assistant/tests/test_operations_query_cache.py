@@ -0,0 +1,92 @@
+import pytest
+
+pytest.importorskip('streamlit')
+
+import operations_query_cache
+from operations_query_cache import QueryCache
+
+
+class Loader:
+    def __init__(self, result):
+        self.result = result
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.result
+
+
+def test_repeated_read_is_served_from_the_cache():
+    cache = QueryCache()
+    loader = Loader({"rows": [1, 2]})
+    assert cache.get_or_load('files', 'alice', {"q": 1}, loader) == {"rows": [1, 2]}
+    assert cache.get_or_load('files', 'alice', {"q": 1}, loader) == {"rows": [1, 2]}
+    assert loader.calls == 1
+    assert cache.stats['hits'] == 1 and cache.stats['misses'] == 1
+
+
+def test_cached_result_is_a_copy():
+    cache = QueryCache()
+    result = cache.get_or_load('files', 'alice', {"q": 1}, Loader({"rows": [1]}))
+    result['rows'].append(2)
+    assert cache.get_or_load('files', 'alice', {"q": 1}, Loader(None)) == {"rows": [1]}
+
+
+def test_write_by_a_user_invalidates_only_their_reads_and_global_ones():
+    cache = QueryCache()
+    for username in ('alice', 'bob', None):
+        cache.get_or_load('files', username, {"q": 1}, Loader(username))
+    cache.invalidate('files', 'alice')
+    loaders = {username: Loader(username) for username in ('alice', 'bob', None)}
+    for username, loader in loaders.items():
+        cache.get_or_load('files', username, {"q": 1}, loader)
+    assert {username: loader.calls for username, loader in loaders.items()} == {'alice': 1, 'bob': 0, None: 1}
+
+
+def test_domain_wide_invalidation_reaches_every_user():
+    cache = QueryCache()
+    cache.get_or_load('chats', 'alice', {"q": 1}, Loader('old'))
+    generation = cache.generation('chats', 'alice')
+    cache.invalidate('chats')
+    assert cache.generation('chats', 'alice') != generation
+    assert cache.get_or_load('chats', 'alice', {"q": 1}, Loader('new')) == 'new'
+
+
+def test_other_domains_are_kept():
+    cache = QueryCache()
+    cache.get_or_load('files', 'alice', {"q": 1}, Loader('files'))
+    cache.invalidate('chats', 'alice')
+    loader = Loader('reloaded')
+    assert cache.get_or_load('files', 'alice', {"q": 1}, loader) == 'files' and loader.calls == 0
+
+
+def test_result_loaded_during_a_write_is_not_stored():
+    cache = QueryCache()
+
+    def loader():
+        # Written while the read was running
+        cache.invalidate('chats')
+        return 'stale'
+
+    assert cache.get_or_load('chats', 'alice', {"q": 1}, loader) == 'stale'
+    assert cache.get_or_load('chats', 'alice', {"q": 1}, Loader('fresh')) == 'fresh'
+
+
+def test_entries_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(operations_query_cache.time, 'monotonic', lambda: now[0])
+    cache = QueryCache(ttl_seconds=10)
+    cache.get_or_load('files', 'alice', {"q": 1}, Loader('old'))
+    now[0] += 11
+    assert cache.get_or_load('files', 'alice', {"q": 1}, Loader('new')) == 'new'
+
+
+def test_least_recently_used_entries_are_dropped_over_the_size_limit():
+    value = 'x' * 1000
+    cache = QueryCache(max_bytes=2500)
+    for q in range(3):
+        cache.get_or_load('files', 'alice', {"q": q}, Loader(value))
+    assert cache.stats['entries'] == 2 and cache.stats['bytes'] <= 2500
+    loader = Loader(value)
+    cache.get_or_load('files', 'alice', {"q": 0}, loader)
+    assert loader.calls == 1
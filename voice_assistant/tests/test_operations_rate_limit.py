@@ -0,0 +1,73 @@
+import pytest
+
+pytest.importorskip('streamlit')
+
+import operations_rate_limit
+from operations_rate_limit import RateLimiter, estimate_tokens
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(operations_rate_limit.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(operations_rate_limit.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_acquire_within_bucket_does_not_wait(clock):
+    limiter = RateLimiter(requests_per_minute=10, tokens_per_minute=1000)
+    for _ in range(10):
+        limiter.acquire(100)
+    assert clock.sleeps == []
+
+
+def test_request_limit_waits_for_refill(clock):
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=100000)
+    for _ in range(60):
+        limiter.acquire(1)
+    limiter.acquire(1)
+    # One request is refilled every second
+    assert sum(clock.sleeps) == pytest.approx(1.0)
+
+
+def test_token_limit_waits_for_refill(clock):
+    limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=600)
+    limiter.acquire(600)
+    limiter.acquire(300)
+    # 600 tokens per minute refill 300 tokens in 30 seconds
+    assert sum(clock.sleeps) == pytest.approx(30.0)
+
+
+def test_request_larger_than_bucket_passes_once_full(clock):
+    limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=100)
+    limiter.acquire(5000)
+    assert clock.sleeps == []
+    limiter.acquire(5000)
+    assert sum(clock.sleeps) == pytest.approx(60.0)
+
+
+def test_bucket_does_not_grow_past_capacity(clock):
+    limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=1000)
+    clock.now += 3600
+    limiter.acquire(1)
+    limiter.acquire(1)
+    limiter.acquire(1)
+    assert sum(clock.sleeps) == pytest.approx(30.0)
+
+
+def test_estimate_tokens():
+    assert estimate_tokens([]) == 0
+    assert estimate_tokens(['a' * 40, 'b' * 8]) == 12 + 2
@@ -0,0 +1,156 @@
+import json
+
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('langchain_neo4j')
+pytest.importorskip('langchain_openai')
+
+import operations_reembed
+from operations_reembed import ReembeddingJob
+
+
+# Neo4j replaced by Chunk and Chat nodes held in memory
+class FakeGraph:
+    def __init__(self, chunks=0, chats=0, index_dimensions=2):
+        self.nodes = {
+            'Chunk': {f'c{i:03}': {"text": f'chunk {i}', "embedding_model": 'old'} for i in range(chunks)},
+            'Chat': {f'h{i:03}': {"user_query": f'question {i}', "embedding_model": 'old'} for i in range(chats)},
+        }
+        self.index_dimensions = index_dimensions
+        # Dimensions an app replica on the old model recreates the index with
+        self.replica_dimensions = None
+        self.queries = []
+
+    def query(self, cypher, params=None):
+        params = params or {}
+        self.queries.append(cypher)
+        if cypher.startswith('MATCH (n:'):
+            label = cypher[len('MATCH (n:'):cypher.index(')')]
+            ids = sorted(k for k, node in self.nodes[label].items() if k > params['cursor']
+                         and node['embedding_model'] != params['model'] and 'embedding_shadow' not in node)
+            return [{"id": k, "text": self.nodes[label][k].get('text'), "properties": self.nodes[label][k]}
+                    for k in ids[:params['batch_size']]]
+        if cypher.startswith('UNWIND $rows'):
+            label = 'Chunk' if ':Chunk' in cypher else 'Chat'
+            for row in params['rows']:
+                self.nodes[label][row['id']]['embedding_shadow'] = row['embedding']
+            return []
+        if 'RETURN size(' in cypher:
+            return [{"dimensions": 3}]
+        if 'IN TRANSACTIONS' in cypher:
+            label = 'Chunk' if ':Chunk' in cypher else 'Chat'
+            for node in self.nodes[label].values():
+                if 'embedding_shadow' in node:
+                    node['embedding'] = node.pop('embedding_shadow')
+                    node['embedding_model'] = params['model']
+            return []
+        if cypher.startswith('SHOW VECTOR INDEXES'):
+            return [{"dimensions": self.index_dimensions}] if self.index_dimensions is not None else []
+        if cypher.startswith('DROP INDEX'):
+            self.index_dimensions = self.replica_dimensions
+            return []
+        if cypher.startswith('CREATE VECTOR INDEX'):
+            if self.index_dimensions is None:
+                self.index_dimensions = params['dimensions']
+            return []
+        raise AssertionError(cypher)
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return [[0.1, 0.2, 0.3] for _ in texts]
+
+
+class FakeRateLimiter:
+    def acquire(self, tokens):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def rate_limiter(monkeypatch):
+    monkeypatch.setattr(operations_reembed, 'embedding_rate_limiter', FakeRateLimiter())
+
+
+def test_checkpoint_is_saved_after_every_batch(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    graph, embeddings = FakeGraph(chunks=5), FakeEmbeddings()
+    job = ReembeddingJob(model='new', batch_size=2, checkpoint_path=checkpoint, cutover=False)
+    job._reembed_label(graph, embeddings, 'Chunk')
+    with open(checkpoint, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    assert state['labels']['Chunk'] == {"cursor": 'c004', "processed": 5, "done": True}
+    assert embeddings.calls == 3
+    assert all('embedding_shadow' in node for node in graph.nodes['Chunk'].values())
+
+
+def test_resume_continues_after_the_cursor(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    graph = FakeGraph(chunks=6)
+    job = ReembeddingJob(model='new', batch_size=2, checkpoint_path=checkpoint, cutover=False)
+
+    # Stopped after the first batch
+    class StopAfterFirstBatch(FakeEmbeddings):
+        def embed_documents(self, texts):
+            job.stop()
+            return super().embed_documents(texts)
+
+    job._reembed_label(graph, StopAfterFirstBatch(), 'Chunk')
+    assert job.state['labels']['Chunk']['cursor'] == 'c001'
+
+    resumed = ReembeddingJob(model='new', batch_size=2, checkpoint_path=checkpoint, cutover=False)
+    assert resumed.state['labels']['Chunk']['cursor'] == 'c001'
+    embeddings = FakeEmbeddings()
+    resumed._reembed_label(graph, embeddings, 'Chunk')
+    assert embeddings.calls == 2
+    assert resumed.state['labels']['Chunk']['processed'] == 6
+
+
+def test_checkpoint_of_another_model_starts_over(tmp_path):
+    checkpoint = tmp_path / 'checkpoint.json'
+    checkpoint.write_text(json.dumps({"model": 'other', "cut_over": True, "labels": {
+        "Chunk": {"cursor": 'c009', "processed": 10, "done": True},
+        "Chat": {"cursor": 'h009', "processed": 10, "done": True}}}), encoding='utf-8')
+    job = ReembeddingJob(model='new', checkpoint_path=str(checkpoint))
+    assert job.state['cut_over'] is False
+    assert job.state['labels']['Chunk'] == {"cursor": '', "processed": 0, "done": False}
+
+
+def test_cutover_swaps_in_batched_transactions(tmp_path):
+    graph = FakeGraph(chunks=3, chats=2, index_dimensions=3)
+    job = ReembeddingJob(model='new', checkpoint_path=str(tmp_path / 'checkpoint.json'))
+    for label in ('Chunk', 'Chat'):
+        job._reembed_label(graph, FakeEmbeddings(), label)
+    job.cutover(graph)
+    swaps = [cypher for cypher in graph.queries if 'IN TRANSACTIONS' in cypher]
+    assert len(swaps) == 2
+    assert all(node['embedding_model'] == 'new' and 'embedding_shadow' not in node
+               for label in graph.nodes for node in graph.nodes[label].values())
+    # Unchanged dimensions keep the index
+    assert not any(cypher.startswith('DROP INDEX') for cypher in graph.queries)
+    assert job.state['cut_over'] is True
+
+
+def test_cutover_rebuilds_index_with_new_dimensions(tmp_path):
+    graph = FakeGraph(chunks=2, index_dimensions=2)
+    job = ReembeddingJob(model='new', checkpoint_path=str(tmp_path / 'checkpoint.json'))
+    job._reembed_label(graph, FakeEmbeddings(), 'Chunk')
+    job.cutover(graph)
+    assert graph.index_dimensions == 3
+
+
+def test_index_rebuild_gives_up_when_a_replica_keeps_recreating_it(tmp_path):
+    graph = FakeGraph(chunks=2, index_dimensions=2)
+    graph.replica_dimensions = 2
+    job = ReembeddingJob(model='new', checkpoint_path=str(tmp_path / 'checkpoint.json'))
+    job._reembed_label(graph, FakeEmbeddings(), 'Chunk')
+    with pytest.raises(Exception, match='keeps recreating it'):
+        job.cutover(graph)
+    drops = [cypher for cypher in graph.queries if cypher.startswith('DROP INDEX')]
+    assert len(drops) == operations_reembed.REEMBED_INDEX_REBUILD_ATTEMPTS
+    # Not marked as cut over, re-running the job rebuilds the index
+    assert job.state['cut_over'] is False
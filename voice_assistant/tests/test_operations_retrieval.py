@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('langchain_core')
+pytest.importorskip('langchain_openai')
+pytest.importorskip('neo4j')
+
+import operations_retrieval
+from operations_retrieval import asearch_user_chunks, format_excerpts, placed_file_names, SpeculativeRetriever
+
+
+class FakeEmbeddings:
+    async def aembed_query(self, text):
+        return [0.1, 0.2]
+
+
+def rows(count):
+    return [{"content": f'chunk {i}', "chunk_no": i, "origin_filename": 'a.txt', "chunk_create_ts": None,
+             "similarity_score": 1 - i / 10} for i in range(count)]
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    queries = []
+    monkeypatch.setattr(operations_retrieval, 'embeddings', FakeEmbeddings())
+
+    def install(index_rows):
+        async def aquery(cypher, params=None):
+            queries.append((cypher, params))
+            if 'db.index.vector.queryNodes' in cypher:
+                if isinstance(index_rows, Exception):
+                    raise index_rows
+                return index_rows
+            return rows(params['limit_by'])
+
+        monkeypatch.setattr(operations_retrieval, 'aquery', aquery)
+        return queries
+
+    return install
+
+
+def test_search_uses_the_vector_index(queries):
+    sent = queries(rows(4))
+    chunks = asyncio.run(asearch_user_chunks('user', 'question', limit_by=4, filter_file_name=['a.txt']))
+    assert len(chunks) == 4 and len(sent) == 1
+    cypher, params = sent[0]
+    assert params['candidates'] == 4 * operations_retrieval.VECTOR_SEARCH_OVERSAMPLE
+    assert params['filter_file_name'] == ['a.txt'] and params['embedding'] == [0.1, 0.2]
+    assert 'vector.similarity.cosine' not in cypher
+
+
+def test_too_few_owned_chunks_fall_back_to_the_exact_scan(queries):
+    sent = queries(rows(1))
+    chunks = asyncio.run(asearch_user_chunks('user', 'question', limit_by=4))
+    assert len(chunks) == 4
+    assert 'vector.similarity.cosine' in sent[1][0] and 'candidates' not in sent[1][1]
+
+
+def test_index_being_rebuilt_falls_back_to_the_exact_scan(queries):
+    sent = queries(Exception('index is not online'))
+    chunks = asyncio.run(asearch_user_chunks('user', 'question', limit_by=2))
+    assert len(chunks) == 2 and len(sent) == 2
+
+
+@pytest.fixture
+def searches(monkeypatch):
+    searches = []
+
+    async def search(username, text, limit_by=4, filter_file_name=None, **kwargs):
+        searches.append((text, filter_file_name))
+        return rows(limit_by)
+
+    monkeypatch.setattr(operations_retrieval, 'asearch_user_chunks', search)
+    return searches
+
+
+def test_speculation_searches_the_placed_files_only(searches):
+    retriever = SpeculativeRetriever('user', placed_file_names([{"name": 'a.pdf'}, {"name": 'b.txt'}]), limit_by=2)
+    retriever.speculate('what was the revenue')
+    # Same words again start no second search
+    retriever.speculate('What was the revenue?')
+    assert len(retriever.result_for('what was the revenue today')) == 2
+    assert searches == [('what was the revenue', ['a.pdf', 'b.txt'])]
+    retriever.close()
+
+
+def test_nothing_is_speculated_without_placed_files(searches):
+    retriever = SpeculativeRetriever('user', placed_file_names([]))
+    retriever.speculate('what was the revenue')
+    assert retriever.result_for('what was the revenue') is None
+    assert searches == []
+
+
+def test_speculation_for_other_words_is_not_used(searches):
+    retriever = SpeculativeRetriever('user', ['a.pdf'])
+    retriever.speculate('what was the revenue')
+    assert retriever.result_for('show me the weather forecast for today') is None
+    assert retriever.stats['missed'] == 1
+    retriever.close()
+
+
+def test_excerpts_text():
+    assert format_excerpts([]) == '' and format_excerpts(None) == ''
+    assert '"origin_filename": "a.txt", "chunk_no": 0, "content": "chunk 0"' in format_excerpts(rows(1))
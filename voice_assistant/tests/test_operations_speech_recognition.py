@@ -0,0 +1,73 @@
+import io
+import wave
+
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('azure.cognitiveservices.speech')
+
+from operations_speech_recognition import recognize_wav, StandInRecognitionBackend, StreamingRecognition
+
+TRANSCRIPT = 'what does the quarterly report say about revenue in march'
+
+
+def silence_wav(seconds, sample_rate=16000):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(b'\x00\x00' * int(sample_rate * seconds))
+    return buffer.getvalue()
+
+
+def test_partials_grow_until_the_final_transcript():
+    recognition, events = recognize_wav(silence_wav(5), stand_in_transcript=TRANSCRIPT)
+    partials = [text for kind, text in events if kind == 'partial']
+    assert [len(text.split()) for text in partials] == list(range(1, 11))
+    assert events[-1] == ('final', TRANSCRIPT)
+    assert recognition.transcript == TRANSCRIPT and recognition.error is None
+    assert recognition.metrics['segments'] == 1
+
+
+def test_speculation_follows_the_stable_words():
+    speculations = []
+    recognize_wav(silence_wav(5), stand_in_transcript=TRANSCRIPT, on_stable_partial=speculations.append)
+    # A word is stable once the next partial repeats it, speculation starts at four and repeats every three more
+    assert speculations == ['what does the quarterly', 'what does the quarterly report say about']
+
+
+def test_short_utterance_is_not_speculated():
+    speculations = []
+    recognition, _ = recognize_wav(silence_wav(2), stand_in_transcript='open the report',
+                                   on_stable_partial=speculations.append)
+    assert speculations == [] and recognition.transcript == 'open the report'
+
+
+def test_revised_words_are_not_stable():
+    speculations = []
+    backend = StandInRecognitionBackend('')
+    recognition = StreamingRecognition(backend, on_stable_partial=speculations.append).start()
+    backend._on_partial('what does the report')
+    backend._on_partial('what does their report say')
+    # Only the first two words survived the revision
+    assert speculations == []
+    backend._on_partial('what does their report say about the')
+    assert speculations == ['what does their report say']
+
+
+def test_failing_speculation_does_not_stop_recognition():
+    def speculate(text):
+        raise Exception('search failed')
+
+    recognition, events = recognize_wav(silence_wav(5), stand_in_transcript=TRANSCRIPT, on_stable_partial=speculate)
+    assert recognition.transcript == TRANSCRIPT
+
+
+def test_events_stop_after_the_first_final():
+    backend = StandInRecognitionBackend(TRANSCRIPT)
+    recognition = StreamingRecognition(backend).start()
+    backend._on_final('first phrase')
+    backend._on_final('second phrase')
+    events = list(recognition.iter_events(timeout=1, stop_after_final=True))
+    assert events == [('final', 'first phrase')]
@@ -0,0 +1,59 @@
+import io
+import wave
+
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('langchain_openai')
+pytest.importorskip('azure.cognitiveservices.speech')
+
+from operations_speech_stream import SentenceSplitter, join_wav
+
+
+def test_complete_sentences_are_returned_as_they_arrive():
+    splitter = SentenceSplitter(min_chars=10)
+    assert splitter.feed('This is the first sentence') == []
+    assert splitter.feed('. And a second') == ['This is the first sentence.']
+    assert splitter.flush() == ['And a second']
+    assert splitter.flush() == []
+
+
+def test_short_sentences_are_joined_with_the_next():
+    splitter = SentenceSplitter(min_chars=20)
+    assert splitter.feed('Yes. Sure. This one is long enough. ') == ['Yes. Sure. This one is long enough.']
+
+
+def test_line_breaks_end_a_segment():
+    splitter = SentenceSplitter(min_chars=5)
+    assert splitter.feed('- first item\n- second item\n') == ['- first item', '- second item']
+
+
+def test_discard_drops_the_unfinished_tail():
+    splitter = SentenceSplitter(min_chars=5)
+    splitter.feed('Text streamed ahead of a tool call')
+    splitter.discard()
+    assert splitter.flush() == []
+
+
+def _wav(frames, rate=16000):
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(frames)
+    return output.getvalue()
+
+
+def test_join_wav_keeps_one_header_and_all_frames():
+    first, second = b'\x01\x00' * 100, b'\x02\x00' * 50
+    joined = join_wav([_wav(first), _wav(second)])
+    with wave.open(io.BytesIO(joined), 'rb') as f:
+        assert f.getnframes() == 150
+        assert f.getframerate() == 16000
+        assert f.readframes(150) == first + second
+
+
+def test_join_wav_single_segment_is_unchanged():
+    segment = _wav(b'\x01\x00' * 10)
+    assert join_wav([segment]) is segment
@@ -0,0 +1,56 @@
+import codecs
+
+import pytest
+
+pytest.importorskip('charset_normalizer')
+
+import operations_text_files
+from operations_text_files import _split_point, iter_text_chunks
+
+
+def test_split_point_prefers_paragraph_boundary():
+    text = 'first line\nsecond line\n\nthird paragraph'
+    assert _split_point(text, 0, 30) == text.index('\n\n') + 2
+
+
+def test_split_point_falls_back_to_line_boundary():
+    text = 'first line\nsecond line continues'
+    assert _split_point(text, 0, 20) == text.index('\n') + 1
+
+
+def test_split_point_cuts_hard_without_boundary():
+    assert _split_point('x' * 50, 10, 20) == 30
+
+
+def test_split_point_ignores_boundary_at_start():
+    # A boundary right at the start would make an empty chunk
+    text = '\n' + 'x' * 30
+    assert _split_point(text, 0, 20) == 20
+
+
+def test_empty_buffer_yields_nothing():
+    assert list(iter_text_chunks(b'')) == []
+
+
+def test_chunks_respect_size_and_keep_text():
+    paragraphs = [f'Paragraph {i} ' + 'word ' * 30 for i in range(20)]
+    text = '\n\n'.join(paragraphs)
+    chunks = list(iter_text_chunks(codecs.BOM_UTF8 + text.encode('utf-8'), chunk_size=200))
+    assert all(0 < len(chunk) <= 200 for chunk in chunks)
+    assert ' '.join(' '.join(chunks).split()) == ' '.join(text.split())
+
+
+def test_multibyte_characters_across_decode_steps(monkeypatch):
+    # Steps of 7 bytes split the two byte characters between steps
+    monkeypatch.setattr(operations_text_files, 'DECODE_STEP_SIZE', 7)
+    text = 'héllo wörld ' * 40
+    chunks = list(iter_text_chunks(codecs.BOM_UTF8 + text.encode('utf-8'), chunk_size=50))
+    assert '�' not in ''.join(chunks)
+    # No line breaks, chunks are cut hard within words
+    assert ''.join(''.join(chunks).split()) == ''.join(text.split())
+
+
+def test_utf16_with_bom():
+    text = 'line one\nline two\n'
+    chunks = list(iter_text_chunks(text.encode('utf-16'), chunk_size=100))
+    assert chunks == ['line one\nline two']
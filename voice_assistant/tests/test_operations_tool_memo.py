@@ -0,0 +1,78 @@
+from typing import List, Optional
+
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('langchain_core')
+pytest.importorskip('neo4j')
+
+from langchain_core.tools import tool
+
+import operations_tool_memo
+from operations_query_cache import query_cache
+from operations_tool_memo import normalise_args, ToolMemo
+
+
+@tool('file-filter-search')
+def file_search(question: str, filter_file_name: Optional[List[str]] = None, limit_by: int = 4) -> str:
+    """Searches the user's files."""
+    return question
+
+
+USER = {"username": 'alice', "role": 'User'}
+
+
+def test_defaults_whitespace_and_file_order_do_not_change_the_key():
+    called = normalise_args(file_search, {"question": ' revenue ', "filter_file_name": ['b.pdf', 'a.pdf']})
+    same = normalise_args(file_search, {"question": 'revenue', "filter_file_name": ['a.pdf', 'b.pdf'], "limit_by": 4})
+    assert called == same
+
+
+def test_unset_arguments_are_dropped():
+    assert normalise_args(file_search, {"question": 'revenue', "filter_file_name": None}) == \
+        '{"limit_by": 4, "question": "revenue"}'
+
+
+def test_different_arguments_make_different_keys():
+    assert normalise_args(file_search, {"question": 'revenue', "limit_by": 8}) != \
+        normalise_args(file_search, {"question": 'revenue'})
+
+
+def test_memo_is_kept_per_conversation():
+    memo = ToolMemo()
+    key = ToolMemo.key(file_search, {"question": 'revenue'}, USER)
+    memo.put('thread1', key, 'result')
+    assert memo.get('thread1', key) == 'result'
+    assert memo.get('thread2', key) is None
+    assert memo.stats['hits'] == 1 and memo.stats['misses'] == 1
+
+
+def test_write_to_the_tool_data_changes_the_key():
+    memo = ToolMemo()
+    key = ToolMemo.key(file_search, {"question": 'revenue'}, USER)
+    memo.put('thread', key, 'result')
+    query_cache.invalidate('files', 'alice')
+    assert ToolMemo.key(file_search, {"question": 'revenue'}, USER) != key
+
+
+def test_entries_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(operations_tool_memo.time, 'monotonic', lambda: now[0])
+    memo = ToolMemo(ttl_seconds=10)
+    memo.put('thread', 'key', 'result')
+    now[0] += 11
+    assert memo.get('thread', 'key') is None
+
+
+def test_least_recently_used_entries_and_conversations_are_dropped():
+    memo = ToolMemo(max_entries=2, max_conversations=2)
+    memo.put('thread1', 'a', 1)
+    memo.put('thread1', 'b', 2)
+    memo.get('thread1', 'a')
+    memo.put('thread1', 'c', 3)
+    assert memo.get('thread1', 'b') is None and memo.get('thread1', 'a') == 1
+
+    memo.put('thread2', 'a', 1)
+    memo.get('thread1', 'a')
+    memo.put('thread3', 'a', 1)
+    assert memo.get('thread2', 'a') is None and memo.get('thread1', 'a') == 1
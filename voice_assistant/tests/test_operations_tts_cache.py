@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+pytest.importorskip('streamlit')
+
+from operations_tts_cache import AudioCache
+
+
+def test_put_and_get(tmp_path):
+    cache = AudioCache(directory=str(tmp_path), max_bytes=1000)
+    key = AudioCache.key('hello', 'en-US-JennyNeural', 'friendly', 'medium', 'default', 'default', 'wav')
+    assert cache.get(key) is None
+    cache.put(key, b'audio')
+    assert cache.get(key) == b'audio'
+    assert cache.stats == {"hits": 1, "misses": 1, "entries": 1, "bytes": 5}
+
+
+def test_key_depends_on_every_part():
+    parts = ['hello', 'en-US-JennyNeural', 'friendly', 'medium', 'default', 'default', 'wav']
+    keys = {AudioCache.key(*parts)}
+    for i in range(len(parts)):
+        keys.add(AudioCache.key(*(parts[:i] + ['other'] + parts[i + 1:])))
+    assert len(keys) == len(parts) + 1
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    cache = AudioCache(directory=str(tmp_path), max_bytes=25)
+    cache.put('a', b'x' * 10)
+    cache.put('b', b'x' * 10)
+    # Reading a makes b the least recently used
+    assert cache.get('a') is not None
+    cache.put('c', b'x' * 10)
+    assert cache.get('b') is None
+    assert not os.path.exists(tmp_path / 'b')
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.stats['bytes'] == 20
+
+
+def test_entry_larger_than_cache_is_kept_alone(tmp_path):
+    cache = AudioCache(directory=str(tmp_path), max_bytes=10)
+    cache.put('a', b'x' * 5)
+    cache.put('big', b'x' * 50)
+    assert cache.get('a') is None
+    assert cache.get('big') == b'x' * 50
+
+
+def test_order_survives_restart(tmp_path):
+    cache = AudioCache(directory=str(tmp_path), max_bytes=25)
+    cache.put('a', b'x' * 10)
+    cache.put('b', b'x' * 10)
+    # File mtime is the recency
+    os.utime(tmp_path / 'a', (2000, 2000))
+    os.utime(tmp_path / 'b', (1000, 1000))
+    (tmp_path / 'c.123.tmp').write_bytes(b'partial')
+
+    restarted = AudioCache(directory=str(tmp_path), max_bytes=25)
+    assert not os.path.exists(tmp_path / 'c.123.tmp')
+    assert restarted.stats['entries'] == 2
+    restarted.put('c', b'x' * 10)
+    assert restarted.get('b') is None
+    assert restarted.get('a') == b'x' * 10
+
+
+def test_file_removed_outside_the_cache_is_a_miss(tmp_path):
+    cache = AudioCache(directory=str(tmp_path), max_bytes=100)
+    cache.put('a', b'x' * 10)
+    os.remove(tmp_path / 'a')
+    assert cache.get('a') is None
+    assert cache.stats['bytes'] == 0
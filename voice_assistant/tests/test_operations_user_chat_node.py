@@ -0,0 +1,113 @@
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('langchain_neo4j')
+pytest.importorskip('langchain_openai')
+
+from operations_user_chat_node import _decode_cursor, _query_recent_sessions, _session_rows, ChatPersister
+
+
+def chat(i):
+    return {"id": f'chat{i}', "timestamp": f'2024-01-0{i}', "user_query": f'question {i}'}
+
+
+def test_session_rows_group_chats_in_queue_order():
+    batch = [(chat(1), 'alice', None, 's1'), (chat(2), 'bob', None, 's2'), (chat(3), 'alice', 'chat1', 's1'),
+             (chat(4), 'alice', None, None)]
+    assert _session_rows(batch) == [
+        {"id": 's1', "username": 'alice', "chat_ids": ['chat1', 'chat3'], "started_at": '2024-01-01',
+         "last_activity": '2024-01-03'},
+        {"id": 's2', "username": 'bob', "chat_ids": ['chat2'], "started_at": '2024-01-02',
+         "last_activity": '2024-01-02'},
+    ]
+
+
+# Batches are recorded instead of written to Neo4j
+class RecordingPersister(ChatPersister):
+    def __init__(self, failures=0, **kwargs):
+        self.batches = []
+        self.failures_left = failures
+        super().__init__(**kwargs)
+
+    def _write(self, batch):
+        if self.failures_left > 0:
+            self.failures_left -= 1
+            raise Exception('Neo4j unavailable')
+        self.batches.append([chat_dict['id'] for chat_dict, _, _, _ in batch])
+
+
+def test_queued_chats_are_written_in_batches_in_order():
+    persister = RecordingPersister(batch_size=2, interval=60)
+    for i in range(1, 6):
+        persister.enqueue(chat(i), 'alice')
+    assert persister.flush(timeout=5)
+    assert [chat_id for batch in persister.batches for chat_id in batch] == [f'chat{i}' for i in range(1, 6)]
+    assert all(len(batch) <= 2 for batch in persister.batches)
+    assert persister.pending == 0
+
+
+def test_enqueued_chat_is_copied():
+    persister = RecordingPersister(batch_size=2, interval=60)
+    chat_dict = chat(1)
+    persister.enqueue(chat_dict, 'alice')
+    chat_dict['id'] = 'changed'
+    assert persister.flush(timeout=5)
+    assert persister.batches == [['chat1']]
+
+
+def test_failed_batch_is_retried_before_later_chats():
+    persister = RecordingPersister(failures=1, batch_size=2, interval=60)
+    persister.enqueue(chat(1), 'alice')
+    persister.enqueue(chat(2), 'alice')
+    # The first attempt fails, the flush waits out the backoff and retries
+    assert not persister.flush(timeout=0.2)
+    persister.enqueue(chat(3), 'alice')
+    assert persister.flush(timeout=5)
+    assert persister.batches[0] == ['chat1', 'chat2']
+    assert [chat_id for batch in persister.batches for chat_id in batch] == ['chat1', 'chat2', 'chat3']
+
+
+
+# Sessions ordered newest first on (last_activity, id), the way the keyset query reads them
+class SessionGraph:
+    def __init__(self, sessions):
+        self.sessions = sorted(sessions, key=lambda s: (s['last_activity'], s['session_id']), reverse=True)
+
+    def query(self, cypher, params=None):
+        if not cypher.startswith('MATCH (s:Session'):
+            # Schema statements
+            return []
+        rows = self.sessions
+        if params['cursor_activity'] is not None:
+            rows = [s for s in rows if (s['last_activity'], s['session_id'])
+                    < (params['cursor_activity'], params['cursor_id'])]
+        return rows[:params['limit']]
+
+
+def session(i, last_activity):
+    return {"session_id": f'{i:064x}', "timestamp": last_activity, "last_activity": last_activity, "turn_count": 1,
+            "chat_content": []}
+
+
+def test_cursor_decodes_what_the_query_encodes():
+    assert _decode_cursor(None) == (None, None)
+    page = _query_recent_sessions('alice', 1, None, SessionGraph([session(1, '2024-01-02 10:00:00 UTC Tuesday')]))
+    assert _decode_cursor(page['next_cursor']) == ('2024-01-02 10:00:00 UTC Tuesday', f'{1:064x}')
+
+
+def test_pages_follow_the_cursor_without_gaps_or_repeats():
+    # Two sessions share a last activity, the id breaks the tie
+    graph = SessionGraph([session(i, f'2024-01-0{min(i, 3)} 10:00:00 UTC') for i in range(1, 6)])
+    seen, cursor = [], None
+    while True:
+        page = _query_recent_sessions('alice', 2, cursor, graph)
+        seen.extend(s['session_id'] for s in page['sessions'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert seen == [s['session_id'] for s in graph.sessions]
+
+
+def test_short_page_has_no_cursor():
+    page = _query_recent_sessions('alice', 3, None, SessionGraph([session(1, '2024-01-01 10:00:00 UTC')]))
+    assert page['next_cursor'] is None
@@ -0,0 +1,66 @@
+from xml.etree import ElementTree
+
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('langchain_openai')
+
+from operations_voices import build_ssml, classify_style, split_segments
+
+
+def test_short_text_is_one_segment():
+    assert split_segments('Hello there.\n\nHow can I help?', max_chars=100) == ['Hello there.\nHow can I help?']
+
+
+def test_paragraphs_are_packed_up_to_the_cap():
+    paragraphs = [f'Paragraph number {i} is here.' for i in range(10)]
+    segments = split_segments('\n\n'.join(paragraphs), max_chars=70)
+    assert all(len(segment) <= 70 for segment in segments)
+    assert '\n'.join(segments).split('\n') == paragraphs
+
+
+def test_long_paragraph_is_split_at_sentences():
+    paragraph = ' '.join(f'Sentence {i} ends here.' for i in range(20))
+    segments = split_segments(paragraph, max_chars=60)
+    assert all(len(segment) <= 60 for segment in segments)
+    assert all(line.endswith('.') for segment in segments for line in segment.split('\n'))
+    assert ' '.join(' '.join(segments).split()) == paragraph
+
+
+def test_long_sentence_is_cut_at_spaces():
+    sentence = ' '.join(['word'] * 100)
+    segments = split_segments(sentence, max_chars=48)
+    assert all(len(segment) <= 48 for segment in segments)
+    assert ' '.join(segments).split() == sentence.split()
+
+
+def test_blank_text_has_no_segments():
+    assert split_segments('  \n\n  ', max_chars=100) == []
+
+
+def test_apology_is_empathetic():
+    style, confidence = classify_style("I'm sorry, unfortunately I could not find that file.")
+    assert style == 'empathetic'
+    assert confidence > 0.5
+
+
+def test_figures_read_as_news():
+    style, _ = classify_style('Revenue grew 12% to 4.5 billion in the quarter, according to the report.')
+    assert style == 'newscast'
+
+
+def test_no_cues_defaults_to_friendly_without_confidence():
+    assert classify_style('The sky over the harbour.') == ('friendly', 0.0)
+
+
+def test_question_cues_count_at_half_weight():
+    text = 'Here is what I have on that.'
+    assert classify_style(text, user_query='My dog passed away, sadly')[0] == 'sad'
+    assert classify_style(text)[0] != 'sad'
+
+
+def test_ssml_escapes_reply_text():
+    ssml = build_ssml('R&D spend <b>grew</b> > 5%')
+    assert 'R&amp;D spend &lt;b&gt;grew&lt;/b&gt; &gt; 5%' in ssml
+    # Still well formed
+    ElementTree.fromstring(ssml.strip())